@@ -0,0 +1,131 @@
+import statistics
+import time
+
+
+class AdaptiveController:
+    # Closed loop over JPEG quality, input size and send rate, each kept between
+    # a configured minimum and its starting value. Every `interval` seconds it
+    # looks at what happened since the last decision. Timeouts, or network time
+    # (round trip minus server processing time) above max_rtt, step quality
+    # down first, then input size, then frame rate, so the frame rate holds its
+    # target the longest. Timeouts while responses cross the network quickly
+    # mean the server is behind rather than the network, so the frame rate
+    # drops to the rate responses arrive at instead. After `recover_after`
+    # intervals in a row with network time under half of max_rtt, settings
+    # step back up in the reverse order. The server can also cap the frame rate
+    # when it can't keep up. Every adjustment is printed.
+    def __init__(
+        self,
+        jpeg_quality=90,
+        image_size=256,
+        target_fps=30,
+        min_jpeg_quality=40,
+        min_image_size=128,
+        min_fps=5,
+        max_rtt=0.5,
+        interval=1.0,
+        recover_after=3,
+    ):
+        self.max_jpeg_quality = jpeg_quality
+        self.max_image_size = image_size
+        self.max_fps = target_fps
+        self.min_jpeg_quality = min(min_jpeg_quality, jpeg_quality)
+        self.min_image_size = min(min_image_size, image_size)
+        self.min_fps = min(min_fps, target_fps)
+        self.max_rtt = max_rtt
+        self.interval = interval
+        self.recover_after = recover_after
+        self.jpeg_quality = jpeg_quality
+        self.image_size = image_size
+        self.target_fps = target_fps
+        self.server_max_fps = None
+        self.adjustments = 0
+        self._network_times = []
+        self._last_update = time.time()
+        self._last_expired = 0
+        self._healthy = 0
+
+    def observe(self, round_trip_time, server_time=0.0):
+        self._network_times.append(max(0.0, round_trip_time - server_time))
+
+    def server_hint(self, max_fps):
+        # None lifts the cap
+        self.server_max_fps = max_fps
+        if max_fps is not None and self.target_fps > max_fps:
+            self._set("target_fps", max(self.min_fps, max_fps), "server hint")
+
+    def update(self, expired):
+        # Called from the send loop with the window's timeout count
+        now = time.time()
+        elapsed = now - self._last_update
+        if elapsed < self.interval:
+            return
+        self._last_update = now
+        timeouts = expired - self._last_expired
+        self._last_expired = expired
+        responses = len(self._network_times)
+        network_time = None
+        if self._network_times:
+            network_time = statistics.median(self._network_times)
+            self._network_times = []
+
+        fast_network = network_time is not None and network_time < self.max_rtt / 2
+        if timeouts > 0 and fast_network:
+            self._healthy = 0
+            # Some headroom below the server's rate lets its queue drain
+            rate = responses / elapsed
+            if self.target_fps > rate * 0.9:
+                self._set(
+                    "target_fps",
+                    max(self.min_fps, rate * 0.9),
+                    f"{timeouts} timeouts, server answering at {rate:.1f} FPS",
+                )
+        elif timeouts > 0 or (network_time is not None and network_time > self.max_rtt):
+            self._healthy = 0
+            reason = f"{timeouts} timeouts"
+            if network_time is not None:
+                reason += f", network {network_time:.3f}s"
+            self._step_down(reason)
+        elif fast_network:
+            self._healthy += 1
+            if self._healthy >= self.recover_after:
+                self._healthy = 0
+                self._step_up(f"network {network_time:.3f}s")
+        else:
+            self._healthy = 0
+
+    def _step_down(self, reason):
+        if self.jpeg_quality > self.min_jpeg_quality:
+            self._set(
+                "jpeg_quality", max(self.min_jpeg_quality, self.jpeg_quality - 10), reason
+            )
+        elif self.image_size > self.min_image_size:
+            size = int(self.image_size * 0.8) // 8 * 8
+            self._set("image_size", max(self.min_image_size, size), reason)
+        elif self.target_fps > self.min_fps:
+            self._set("target_fps", max(self.min_fps, self.target_fps * 0.75), reason)
+
+    def _step_up(self, reason):
+        max_fps = self.max_fps
+        if self.server_max_fps is not None:
+            max_fps = min(max_fps, self.server_max_fps)
+        if self.target_fps < max_fps:
+            self._set("target_fps", min(max_fps, self.target_fps / 0.75), reason)
+        elif self.image_size < self.max_image_size:
+            size = int(self.image_size / 0.8 + 7) // 8 * 8
+            self._set("image_size", min(self.max_image_size, size), reason)
+        elif self.jpeg_quality < self.max_jpeg_quality:
+            self._set(
+                "jpeg_quality", min(self.max_jpeg_quality, self.jpeg_quality + 5), reason
+            )
+
+    def _set(self, name, value, reason):
+        old = getattr(self, name)
+        if value == old:
+            return
+        setattr(self, name, value)
+        self.adjustments += 1
+        if name == "target_fps":
+            print(f"Adaptive: {name} {old:.1f} -> {value:.1f} ({reason})")
+        else:
+            print(f"Adaptive: {name} {old} -> {value} ({reason})")
@@ -0,0 +1,598 @@
+import copy
+import hashlib
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from model_cache import ModelCache
+
+# A backend turns decoded BGR frames into output BGR frames for the scheduler:
+#   prepare_state(prompt, negative_prompt, num_inference_steps, guidance_scale)
+#       -> (conditioning, temporal), without touching the state used for inference
+#   infer(image, state) -> output, run on the scheduler thread only. Returns
+#       REUSED when inference was skipped and the state's previous output stands
+#   infer_batch(images, states) -> outputs, optional single batched call for
+#       frames of several states
+#   to_input(img_bgr) / postprocess(output) convert around infer(). to_input
+#       must not keep a reference to img_bgr: preprocessed frames live in
+#       scratch buffers that are reused for the next frame. postprocess returns
+#       a BGR array that stays valid until the thread's next postprocess call
+#   synchronize() waits for queued device work, for accurate timings
+#   input_copies / output_copies: full-frame host copies made around infer()
+
+# Returned by infer() for frames the similar-image filter skipped
+REUSED = object()
+
+# Fused into every model, and part of the snapshot key
+LCM_LORA = "latent-consistency/lcm-lora-sdv1-5"
+TINY_VAE = "madebyollin/taesd"
+
+# Attributes StreamDiffusion.prepare() sets for a prompt
+CONDITIONING_ATTRS = [
+    "generator",
+    "guidance_scale",
+    "delta",
+    "prompt_embeds",
+    "timesteps",
+    "sub_timesteps",
+    "sub_timesteps_tensor",
+    "init_noise",
+    "c_skip",
+    "c_out",
+    "alpha_prod_t_sqrt",
+    "beta_prod_t_sqrt",
+]
+
+# Attributes stream() updates from frame to frame. The similar-image filter
+# keeps its own history (last frame let through, frames skipped since), so
+# each state gets its own filter
+TEMPORAL_ATTRS = [
+    "x_t_latent_buffer",
+    "stock_noise",
+    "prev_image_result",
+    "similar_filter",
+]
+
+
+def capture_state(stream, attrs):
+    return {attr: getattr(stream, attr) for attr in attrs if hasattr(stream, attr)}
+
+
+def apply_state(stream, state):
+    for attr, value in state.items():
+        setattr(stream, attr, value)
+
+
+def load_model(
+    base_model_path,
+    acceleration,
+    lora_path=None,
+    lora_scale=1.0,
+    t_index_list=None,
+    engines_dir="engines",
+    model_cache=True,
+    max_batch_size=2,
+):
+    # Imported here so the rest of the server runs without the GPU stack
+    import torch
+    from diffusers import AutoencoderTiny, StableDiffusionPipeline
+    from streamdiffusion import StreamDiffusion
+    from streamdiffusion.acceleration.tensorrt import accelerate_with_tensorrt
+
+    # With model_cache, the fused pipeline is saved under engines_dir the first
+    # time and later starts load it directly, skipping the LoRA fusing
+    cache = snapshot_key = snapshot_path = None
+    if model_cache:
+        t_start = time.time()
+        cache = ModelCache(engines_dir)
+        snapshot_key = cache.snapshot_key(
+            base_model=cache.fingerprint(base_model_path),
+            lcm_lora=cache.fingerprint(LCM_LORA),
+            lora=cache.fingerprint(lora_path),
+            lora_scale=lora_scale if lora_path is not None else None,
+            vae=cache.fingerprint(TINY_VAE),
+            dtype="float16",
+        )
+        snapshot_path = cache.snapshot(snapshot_key)
+        print(
+            f"Model fingerprint time: {time.time() - t_start:.4f}s "
+            f"(snapshot {snapshot_key}, {'cached' if snapshot_path else 'not cached'})"
+        )
+
+    t_start = time.time()
+    if snapshot_path is not None:
+        # Saved as float16 safetensors, which are memory-mapped while loading
+        pipe = StableDiffusionPipeline.from_pretrained(
+            snapshot_path, torch_dtype=torch.float16, use_safetensors=True
+        ).to(device=torch.device("cuda"))
+    else:
+        pipe = StableDiffusionPipeline.from_pretrained(base_model_path).to(
+            device=torch.device("cuda"),
+            dtype=torch.float16,
+        )
+    print(f"Pipeline load time: {time.time() - t_start:.4f}s")
+
+    t_start = time.time()
+    stream = StreamDiffusion(
+        pipe,
+        t_index_list=t_index_list,
+        torch_dtype=torch.float16,
+        width=512,
+        height=512,
+    )
+    print(f"Stream initialization time: {time.time() - t_start:.4f}s")
+
+    stream.enable_similar_image_filter(0.99, 5)
+    if snapshot_path is None:
+        t_start = time.time()
+        stream.load_lcm_lora(LCM_LORA)
+        stream.fuse_lora()
+        print(f"LCM LoRA setup time: {time.time() - t_start:.4f}s")
+
+        if lora_path is not None:
+            t_start = time.time()
+            stream.load_lora(lora_path)
+            stream.fuse_lora(lora_scale=lora_scale)
+            print(f"Custom LoRA load time: {time.time() - t_start:.4f}s")
+    else:
+        print("LCM and custom LoRAs already fused in the snapshot")
+    if lora_path is not None:
+        print(f"Using LoRA: {lora_path}")
+
+    t_start = time.time()
+    vae_path = TINY_VAE
+    if snapshot_path is not None:
+        vae_path = os.path.join(snapshot_path, "vae_tiny")
+    stream.vae = AutoencoderTiny.from_pretrained(vae_path).to(
+        device=pipe.device, dtype=pipe.dtype
+    )
+    print(f"VAE load time: {time.time() - t_start:.4f}s")
+
+    if cache is not None and snapshot_path is None:
+        t_start = time.time()
+
+        def save(directory):
+            # Fusing leaves the weights in the base layers, so dropping the
+            # LoRA layers afterwards gives a plain pipeline that loads without
+            # any LoRA support
+            pipe.unload_lora_weights()
+            pipe.save_pretrained(directory, safe_serialization=True)
+            stream.vae.save_pretrained(
+                os.path.join(directory, "vae_tiny"), safe_serialization=True
+            )
+
+        try:
+            cache.save_snapshot(
+                snapshot_key,
+                save,
+                {
+                    "base_model": base_model_path,
+                    "lora": lora_path,
+                    "lora_scale": lora_scale,
+                },
+            )
+            print(f"Snapshot save time: {time.time() - t_start:.4f}s")
+        except Exception as e:
+            print(f"Failed to save model snapshot: {e}")
+
+    t_start = time.time()
+    if acceleration == "tensorrt":
+        # The scheduler runs up to max_batch_size frames in one UNet call, each
+        # with a row per denoising step
+        engine_batch_size = max_batch_size * stream.trt_unet_batch_size
+        engine_dir = engines_dir
+        if cache is not None:
+            # Engines are built for fixed weights, shapes and GPU, so each
+            # combination gets its own directory instead of sharing one
+            engine_dir = cache.engine_dir(
+                snapshot_key,
+                t_index_list=list(t_index_list or ()),
+                width=stream.width,
+                height=stream.height,
+                batch_size=engine_batch_size,
+                device=torch.cuda.get_device_name(),
+                tensorrt=_tensorrt_version(),
+            )
+            print(
+                f"Engines: {engine_dir} "
+                f"({'cached' if os.path.isdir(engine_dir) else 'building'})"
+            )
+        stream = accelerate_with_tensorrt(
+            stream,
+            engine_dir,
+            max_batch_size=engine_batch_size,
+        )
+    else:
+        pipe.enable_xformers_memory_efficient_attention()
+    print(f"Acceleration setup time: {time.time() - t_start:.4f}s")
+
+    return stream
+
+
+def _tensorrt_version():
+    try:
+        import tensorrt
+    except ImportError:
+        return None
+    return tensorrt.__version__
+
+
+class StreamDiffusionBackend:
+    # With zero_copy, frames skip PIL entirely: the BGR frame is copied once into
+    # a pinned staging buffer, uploaded on a side CUDA stream and converted to a
+    # normalized RGB tensor there, and the output is converted to BGR uint8 on
+    # the GPU and downloaded into a pinned buffer that is encoded directly.
+    # Without it, frames take the original PIL round trip.
+    def __init__(self, stream, zero_copy=True):
+        import torch
+        import PIL.Image
+        from streamdiffusion.image_utils import postprocess_image
+
+        self.stream = stream
+        self.device = stream.device
+        self.zero_copy = zero_copy
+        self._torch = torch
+        self._pil_image = PIL.Image
+        self._postprocess_image = postprocess_image
+        self._local = threading.local()
+        if zero_copy:
+            self.input_copies = 1  # Frame into the pinned staging buffer
+            self.output_copies = 1  # Device to pinned host buffer
+        else:
+            # BGR to RGB, PIL image, PIL to numpy and numpy to float tensor on the
+            # way in; tensor to numpy, PIL image, back to numpy and RGB to BGR out
+            self.input_copies = 4
+            self.output_copies = 4
+
+    def _pinned(self, name, shape):
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        buffer = buffers.get((name, shape))
+        if buffer is None:
+            buffer = buffers[(name, shape)] = self._torch.empty(
+                shape, dtype=self._torch.uint8, pin_memory=True
+            )
+        return buffer
+
+    def _side_stream(self):
+        side_stream = getattr(self._local, "stream", None)
+        if side_stream is None:
+            side_stream = self._local.stream = self._torch.cuda.Stream(self.device)
+        return side_stream
+
+    def prepare_state(self, prompt, negative_prompt, num_inference_steps, guidance_scale):
+        # prepare() reassigns its attributes rather than mutating them, so running
+        # it on a shallow copy leaves the instance used for inference untouched
+        shadow = copy.copy(self.stream)
+        shadow.prepare(
+            prompt,
+            negative_prompt=negative_prompt,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+        )
+        temporal = capture_state(shadow, TEMPORAL_ATTRS)
+        similar_filter = copy.copy(self.stream.similar_filter)
+        similar_filter.prev_tensor = None
+        similar_filter.skip_count = 0
+        temporal["similar_filter"] = similar_filter
+        return capture_state(shadow, CONDITIONING_ATTRS), temporal
+
+    def _uploaded(self, image):
+        if not self.zero_copy:
+            return image
+        image, uploaded = image
+        current_stream = self._torch.cuda.current_stream(self.device)
+        current_stream.wait_event(uploaded)
+        image.record_stream(current_stream)
+        return image
+
+    def infer(self, image, state):
+        # StreamDiffusion keeps prompt embeddings and latent buffers on the
+        # instance, so each frame runs with its owner's state swapped in
+        image = self._uploaded(image)
+        apply_state(self.stream, state.conditioning)
+        apply_state(self.stream, state.temporal)
+        previous = getattr(self.stream, "prev_image_result", None)
+        output = self.stream(image)
+        state.temporal = capture_state(self.stream, TEMPORAL_ATTRS)
+        # The similar-image filter hands back the previous output tensor itself
+        if previous is not None and output is previous:
+            return REUSED
+
+        if self.zero_copy:
+            done = self._torch.cuda.Event()
+            done.record()
+            return output, done
+        return output
+
+    def infer_batch(self, images, states):
+        # Frames of several connections share one UNet call and one VAE decode.
+        # Each frame still goes through StreamDiffusion's predict_x0_batch with
+        # its owner's state swapped in, twice: first to collect the UNet inputs
+        # it builds from the state's latent buffer, noise and embeddings, then,
+        # after the batched UNet call, to finish the step with its share of the
+        # output. Skipped frames don't sleep like stream() does.
+        if len(images) == 1 or not self.stream.use_denoising_batch:
+            # Without the denoising batch the UNet runs once per step, each
+            # step depending on the previous one
+            return [self.infer(image, state) for image, state in zip(images, states)]
+
+        torch = self._torch
+        stream = self.stream
+        unet = stream.unet
+        outputs = [None] * len(images)
+        latents = {}
+        calls = {}
+        try:
+            with torch.no_grad():
+                for i, (image, state) in enumerate(zip(images, states)):
+                    apply_state(stream, state.conditioning)
+                    apply_state(stream, state.temporal)
+                    x = stream.image_processor.preprocess(
+                        self._uploaded(image), stream.height, stream.width
+                    ).to(device=stream.device, dtype=stream.dtype)
+                    if stream.similar_image_filter:
+                        # The filter is the state's own and keeps its history
+                        x = stream.similar_filter(x)
+                        if x is None:
+                            outputs[i] = REUSED
+                            continue
+                    latents[i] = stream.encode_image(x)
+                    stream.unet = calls[i] = _UNetCall()
+                    stream.predict_x0_batch(latents[i])
+
+                if not latents:
+                    return outputs
+                samples, timesteps, embeddings = zip(
+                    *(call.inputs for call in calls.values())
+                )
+                predictions = unet(
+                    torch.cat(samples),
+                    torch.cat(timesteps),
+                    encoder_hidden_states=torch.cat(embeddings),
+                    return_dict=False,
+                )[0]
+                sizes = [sample.shape[0] for sample in samples]
+                for call, prediction in zip(calls.values(), predictions.split(sizes)):
+                    call.output = prediction
+
+                predicted = []
+                for i, x_t_latent in latents.items():
+                    state = states[i]
+                    apply_state(stream, state.conditioning)
+                    apply_state(stream, state.temporal)
+                    stream.unet = calls[i]
+                    predicted.append(stream.predict_x0_batch(x_t_latent))
+                    state.temporal = capture_state(stream, TEMPORAL_ATTRS)
+
+                decoded = stream.decode_image(torch.cat(predicted)).detach().clone()
+        finally:
+            stream.unet = unet
+
+        if self.zero_copy:
+            done = torch.cuda.Event()
+            done.record()
+        for i, output in zip(latents, decoded.split(1)):
+            states[i].temporal["prev_image_result"] = output
+            outputs[i] = (output, done) if self.zero_copy else output
+        return outputs
+
+    def to_input(self, img_bgr):
+        if not self.zero_copy:
+            return self._pil_image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB))
+
+        torch = self._torch
+        # The previous upload from this thread's staging buffer must be done
+        # before it is overwritten
+        previous = getattr(self._local, "uploaded", None)
+        if previous is not None:
+            previous.synchronize()
+
+        staging = self._pinned("input", img_bgr.shape)
+        np.copyto(staging.numpy(), img_bgr)
+        side_stream = self._side_stream()
+        with torch.cuda.stream(side_stream):
+            image = staging.to(self.device, non_blocking=True)
+            # HWC BGR uint8 -> NCHW RGB in [0, 1] at the stream resolution
+            image = image.permute(2, 0, 1).flip(0).unsqueeze(0).float() / 255
+            size = (self.stream.height, self.stream.width)
+            if image.shape[2:] != size:
+                image = torch.nn.functional.interpolate(
+                    image, size=size, mode="bicubic", align_corners=False
+                ).clamp_(0, 1)
+            image = image.to(self.stream.dtype)
+            uploaded = torch.cuda.Event()
+            uploaded.record(side_stream)
+        self._local.uploaded = uploaded
+        return image, uploaded
+
+    def postprocess(self, output):
+        if not self.zero_copy:
+            output = self._postprocess_image(output, output_type="pil")[0]
+            return cv2.cvtColor(np.array(output), cv2.COLOR_RGB2BGR)
+
+        torch = self._torch
+        output, done = output
+        # Runs on a side stream so the download doesn't queue behind inference
+        # the scheduler thread has issued since
+        side_stream = self._side_stream()
+        with torch.cuda.stream(side_stream):
+            side_stream.wait_event(done)
+            output.record_stream(side_stream)
+            # NCHW RGB in [-1, 1] -> HWC BGR uint8
+            image = ((output[0] / 2 + 0.5).clamp(0, 1) * 255).round()
+            image = image.to(torch.uint8).flip(0).permute(1, 2, 0).contiguous()
+            host = self._pinned("output", tuple(image.shape))
+            host.copy_(image, non_blocking=True)
+            downloaded = torch.cuda.Event()
+            downloaded.record(side_stream)
+        downloaded.synchronize()
+        return host.numpy()
+
+    def synchronize(self):
+        self._torch.cuda.synchronize()
+
+    @staticmethod
+    def release_cached_memory():
+        # Hands memory of models nothing references anymore back to the driver
+        import torch
+
+        torch.cuda.empty_cache()
+
+
+class _UNetCall:
+    # Stands in for the UNet inside predict_x0_batch for one frame of a batch:
+    # records the inputs the frame's state produces, then hands back the
+    # frame's share of the batched UNet output
+    def __init__(self):
+        self.inputs = None
+        self.output = None
+
+    def __call__(self, sample, timestep, encoder_hidden_states=None, **kwargs):
+        if self.output is None:
+            self.inputs = (sample, timestep, encoder_hidden_states)
+            return (sample.new_zeros(sample.shape),)
+        return (self.output,)
+
+
+class CpuBackend:
+    # Deterministic stand-in for benchmarking and testing the serving path
+    # without a GPU. Frames are stylized with OpenCV and tinted with a colour
+    # derived from the prompt, then padded with sleep up to `latency` seconds
+    # per batch to mimic diffusion time. Prompt preparation takes
+    # `prepare_latency` seconds. With a similar_threshold, frames whose cosine
+    # similarity to the state's last processed frame reaches it are skipped
+    # like StreamDiffusion's similar-image filter does, at most max_skip_frames
+    # in a row, and batches of skipped frames don't sleep.
+    def __init__(
+        self,
+        latency=0.05,
+        prepare_latency=0.2,
+        style="stylization",
+        width=512,
+        height=512,
+        similar_threshold=0.0,
+        max_skip_frames=5,
+        memory_bytes=0,
+    ):
+        if style not in ("stylization", "edges", "none"):
+            raise ValueError(f"Unknown CPU backend style: {style}")
+        self.latency = latency
+        self.prepare_latency = prepare_latency
+        self.style = style
+        self.width = width
+        self.height = height
+        self.similar_threshold = similar_threshold
+        self.max_skip_frames = max_skip_frames
+        # Pretend model size, for testing the style registry's memory budget
+        self.memory_bytes = memory_bytes
+        self.device = "cpu"
+        self.input_copies = 1
+        self.output_copies = 0
+
+    def prepare_state(self, prompt, negative_prompt, num_inference_steps, guidance_scale):
+        time.sleep(self.prepare_latency)
+        digest = hashlib.sha256(f"{prompt}\0{negative_prompt}".encode("utf-8")).digest()
+        tint = np.array([digest[0], digest[1], digest[2]], dtype=np.float32)
+        return {"tint": tint, "strength": min(guidance_scale, 2.0) / 4.0}, {}
+
+    def infer(self, image, state):
+        return self.infer_batch([image], [state])[0]
+
+    def infer_batch(self, images, states):
+        t_start = time.time()
+        outputs = [
+            REUSED if self._similar(image, state) else self._stylize(image, state)
+            for image, state in zip(images, states)
+        ]
+        remaining = self.latency - (time.time() - t_start)
+        if remaining > 0 and any(output is not REUSED for output in outputs):
+            time.sleep(remaining)
+        return outputs
+
+    def _similar(self, image, state):
+        if self.similar_threshold <= 0:
+            return False
+        vector = image.reshape(-1).astype(np.float32)
+        previous = state.temporal.get("prev_input")
+        skipped = state.temporal.get("skipped", 0)
+        if previous is not None and skipped < self.max_skip_frames:
+            similarity = float(vector @ previous) / max(
+                float(np.linalg.norm(vector) * np.linalg.norm(previous)), 1e-9
+            )
+            if similarity >= self.similar_threshold:
+                state.temporal["skipped"] = skipped + 1
+                return True
+        state.temporal["prev_input"] = vector
+        state.temporal["skipped"] = 0
+        return False
+
+    def _stylize(self, image, state):
+        image = cv2.resize(image, (self.width, self.height))
+        if self.style == "stylization":
+            image = cv2.stylization(image, sigma_s=30, sigma_r=0.3)
+        elif self.style == "edges":
+            image = cv2.edgePreservingFilter(image, flags=cv2.RECURS_FILTER)
+        strength = state.conditioning.get("strength", 0.0)
+        tint = state.conditioning.get("tint")
+        if tint is None:
+            return image
+        output = image.astype(np.float32) * (1 - strength) + tint * strength
+        return output.astype(np.uint8)
+
+    def to_input(self, img_bgr):
+        return img_bgr.copy()
+
+    def postprocess(self, output):
+        return output
+
+    def synchronize(self):
+        pass
+
+
+def load_backend(
+    backend="streamdiffusion",
+    base_model_path=None,
+    acceleration="none",
+    lora_path=None,
+    lora_scale=1.0,
+    t_index_list=None,
+    engines_dir="engines",
+    cpu_latency=0.05,
+    cpu_style="stylization",
+    zero_copy=True,
+    cpu_similar_threshold=0.0,
+    model_cache=True,
+    cpu_model_memory=0.0,
+    max_batch_size=2,
+):
+    if backend == "streamdiffusion":
+        if base_model_path is None:
+            raise ValueError("base_model_path is required for the streamdiffusion backend")
+        import torch
+
+        free_before = torch.cuda.mem_get_info()[0]
+        stream = load_model(
+            base_model_path,
+            acceleration,
+            lora_path,
+            lora_scale,
+            t_index_list,
+            engines_dir,
+            model_cache,
+            max_batch_size,
+        )
+        model = StreamDiffusionBackend(stream, zero_copy=zero_copy)
+        # Device memory the model took, for the style registry's budget
+        model.memory_bytes = max(free_before - torch.cuda.mem_get_info()[0], 0)
+        return model
+    elif backend == "cpu":
+        return CpuBackend(
+            latency=cpu_latency,
+            style=cpu_style,
+            similar_threshold=cpu_similar_threshold,
+            memory_bytes=int(cpu_model_memory * 2**30),
+        )
+    raise ValueError(f"Unknown backend: {backend}")
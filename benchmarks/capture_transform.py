@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+
+import cv2
+import fire
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture_transform import CaptureTransform, crop_window  # noqa: E402
+
+
+def legacy_transform(frame, crop_size, crop_offset_y, rotation, image_size):
+    # The PIL path client_pi.capture_and_send used before CaptureTransform
+    h, w, _ = frame.shape
+    image = Image.fromarray(frame)
+    image = image.convert("RGB")
+    if rotation != 0:
+        image = image.rotate(rotation)
+    image = np.array(image)
+    rows, cols = crop_window(h, w, crop_size, crop_offset_y)
+    return cv2.resize(image[rows, cols], (image_size, image_size))
+
+
+# (camera width, camera height, crop size, crop offset y, rotation, image size)
+CASES = [
+    (1400, 1000, 256, 0, 0, 256),
+    (900, 900, 900, 0, 270, 150),
+    (1400, 1000, 900, 0, 90, 150),
+    (1400, 1000, 800, 40, 180, 256),
+    (1400, 1000, 600, 0, 15, 256),
+    (640, 480, 480, 0, -30, 128),
+]
+
+
+def make_frames(width, height, channels=4, count=4, seed=0):
+    # XBGR8888-like frames as picamera2 returns them by default
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(count):
+        img = np.zeros((height, width, 3), dtype=np.uint8)
+        for _ in range(20):
+            center = tuple(int(v) for v in rng.integers(0, min(width, height), 2))
+            color = tuple(int(v) for v in rng.integers(0, 256, 3))
+            cv2.circle(img, center, int(rng.integers(5, height // 4)), color, -1)
+        img = cv2.add(img, rng.integers(0, 20, img.shape, dtype=np.uint8))
+        if channels == 4:
+            img = np.dstack([img, rng.integers(0, 256, (height, width), dtype=np.uint8)])
+        frames.append(img)
+    return frames
+
+
+def time_per_frame(fn, frames, iterations):
+    t_start = time.perf_counter()
+    for i in range(iterations):
+        fn(frames[i % len(frames)])
+    return (time.perf_counter() - t_start) / iterations
+
+
+def main(iterations=50, channels=4):
+    # Times CaptureTransform against the original PIL path, plus the approximate
+    # single-remap mode and its mean absolute error. That the exact mode matches
+    # the PIL path pixel for pixel is checked in tests/test_capture_transform.py
+    print(
+        f"{'camera':>10}{'crop':>6}{'rot':>5}{'size':>6}{'legacy ms':>11}"
+        f"{'exact ms':>10}{'speedup':>9}{'fast ms':>9}{'fast diff':>11}"
+    )
+    for width, height, crop_size, offset, rotation, size in CASES:
+        frames = make_frames(width, height, channels)
+        exact = CaptureTransform(crop_size, offset, rotation, size)
+        fast = CaptureTransform(crop_size, offset, rotation, size, exact=False)
+
+        fast_diff = 0.0
+        for frame in frames:
+            expected = legacy_transform(frame, crop_size, offset, rotation, size)
+            fast_diff = max(
+                fast_diff, np.abs(expected.astype(float) - fast(frame).astype(float)).mean()
+            )
+
+        legacy_time = time_per_frame(
+            lambda frame: legacy_transform(frame, crop_size, offset, rotation, size),
+            frames,
+            iterations,
+        )
+        exact_time = time_per_frame(exact, frames, iterations)
+        fast_time = time_per_frame(fast, frames, iterations)
+        print(
+            f"{f'{width}x{height}':>10}{crop_size:>6}{rotation:>5}{size:>6}"
+            f"{legacy_time * 1000:>11.3f}{exact_time * 1000:>10.3f}"
+            f"{legacy_time / exact_time:>8.1f}x{fast_time * 1000:>9.3f}{fast_diff:>11.3f}"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+
+import cv2
+import fire
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from display import DisplayTransform  # noqa: E402
+
+
+def legacy_display(image, width, height, crop, rotate):
+    # The per-frame display code of client.py (rotate) and client_pi.py (crop)
+    # before DisplayTransform
+    image = cv2.flip(image, 1)
+    if crop:
+        aspect_ratio = width / height
+        if image.shape[1] / image.shape[0] > aspect_ratio:
+            crop_width = int(image.shape[0] * aspect_ratio)
+            crop_offset = (image.shape[1] - crop_width) // 2
+            image = image[:, crop_offset : crop_offset + crop_width]
+        else:
+            crop_height = int(image.shape[1] / aspect_ratio)
+            crop_offset = (image.shape[0] - crop_height) // 2
+            image = image[crop_offset : crop_offset + crop_height, :]
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_CUBIC)
+    if rotate != 0:
+        (h, w) = image.shape[:2]
+        M = cv2.getRotationMatrix2D((w / 2, h / 2), rotate, 1.0)
+        image = cv2.warpAffine(image, M, (w, h))
+    return image
+
+
+# (name, received size, display width, display height, crop, rotate)
+CASES = [
+    ("client", 512, 1400, 1400, False, 0),
+    ("client", 512, 1400, 1400, False, 90),
+    ("client", 512, 1400, 1400, False, 15),
+    ("client_pi", 512, 800, 480, True, 0),
+    ("client_pi", 511, 1920, 1080, True, 0),
+]
+
+
+def time_per_frame(fn, frames, iterations):
+    t_start = time.perf_counter()
+    for i in range(iterations):
+        fn(frames[i % len(frames)])
+    return (time.perf_counter() - t_start) / iterations
+
+
+def main(iterations=50, interpolations=("cubic", "linear", "nearest")):
+    # Times the display path against the original per-frame code, and checks
+    # the cubic, unrotated output is identical to it
+    if isinstance(interpolations, str):
+        interpolations = (interpolations,)
+    rng = np.random.default_rng(0)
+    failures = 0
+    header = "".join(f"{name + ' ms':>13}" for name in interpolations)
+    print(f"{'client':<11}{'input':>6}{'display':>11}{'rot':>5}{'legacy ms':>11}{header}")
+    for name, size, width, height, crop, rotate in CASES:
+        frames = [
+            cv2.GaussianBlur(rng.integers(0, 256, (size, size, 3), dtype=np.uint8), (9, 9), 0)
+            for _ in range(4)
+        ]
+        legacy_time = time_per_frame(
+            lambda image: legacy_display(image, width, height, crop, rotate),
+            frames,
+            iterations,
+        )
+        row = f"{name:<11}{size:>6}{f'{width}x{height}':>11}{rotate:>5}{legacy_time * 1000:>11.3f}"
+        for interpolation in interpolations:
+            display = DisplayTransform(
+                width, height, crop=crop, rotate=rotate, interpolation=interpolation
+            )
+            if interpolation == "cubic" and rotate == 0:
+                for image in frames:
+                    if not np.array_equal(
+                        display(image), legacy_display(image, width, height, crop, rotate)
+                    ):
+                        print(f"MISMATCH: {name} {size} -> {width}x{height}")
+                        failures += 1
+                        break
+            row += f"{time_per_frame(display, frames, iterations) * 1000:>13.3f}"
+        print(row)
+
+    if failures:
+        print(f"{failures} mismatches")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
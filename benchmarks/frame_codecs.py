@@ -0,0 +1,157 @@
+import io
+import os
+import sys
+import time
+
+import cv2
+import fire
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_codecs import (  # noqa: E402
+    TurboJPEG,
+    JpegCodec,
+    TurboJpegCodec,
+    available_codecs,
+    get_codec,
+)
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets")
+
+
+def load_images(frames=None):
+    # Photos from a directory (the repo's assets by default) so the byte
+    # counts reflect real content rather than synthetic patterns
+    directory = frames or ASSETS
+    return [
+        cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+        for name in sorted(os.listdir(directory))
+        if name.lower().endswith((".jpg", ".jpeg", ".png"))
+    ]
+
+
+def codecs_to_test():
+    # (label, codec, min_scale for decode)
+    cases = [("jpeg (opencv)", JpegCodec(), 1.0), ("jpeg (opencv) 1/2", JpegCodec(), 0.5)]
+    if TurboJPEG is not None:
+        try:
+            turbo = TurboJpegCodec()
+            cases += [("jpeg (turbo)", turbo, 1.0), ("jpeg (turbo) 1/2", turbo, 0.5)]
+        except (OSError, RuntimeError) as e:
+            print(f"Skipping libjpeg-turbo: {e}")
+    else:
+        print("Skipping libjpeg-turbo: PyTurboJPEG is not installed")
+    for name in available_codecs():
+        if name != "jpeg":
+            cases.append((name, get_codec(name), 1.0))
+    return cases
+
+
+def pil_decode(data, scale=1):
+    image = Image.open(io.BytesIO(data))
+    if scale > 1:
+        # Same DCT-domain scaling libjpeg-turbo does
+        image.draft("RGB", (image.width // scale, image.height // scale))
+    return np.asarray(image.convert("RGB"))[:, :, ::-1]
+
+
+def check_turbo(images, quality=90):
+    # libjpeg-turbo has to agree with PIL's JPEG codec: both decode the same
+    # bytes to within one level, full size and at 1/2, and what it encodes
+    # decodes in PIL about as well as PIL's own encoding at the same quality.
+    # Returns the number of mismatches, None without libjpeg-turbo.
+    if TurboJPEG is None:
+        print("Skipping libjpeg-turbo check: PyTurboJPEG is not installed")
+        return None
+    try:
+        turbo = TurboJpegCodec()
+    except (OSError, RuntimeError) as e:
+        print(f"Skipping libjpeg-turbo check: {e}")
+        return None
+    failures = 0
+    for index, image in enumerate(images):
+        data = bytes(JpegCodec().encode(image, quality))
+        for scale in (1, 2):
+            expected = pil_decode(data, scale)
+            actual = turbo.decode(data, min_scale=1 / scale)
+            if expected.shape != actual.shape or (
+                np.abs(expected.astype(int) - actual.astype(int)).max() > 1
+            ):
+                print(f"MISMATCH: decode of image {index} at 1/{scale}")
+                failures += 1
+
+        buffer = io.BytesIO()
+        Image.fromarray(image[:, :, ::-1]).save(
+            buffer, "JPEG", quality=quality, subsampling=2
+        )
+        expected = cv2.PSNR(image, pil_decode(buffer.getvalue()))
+        actual = cv2.PSNR(image, pil_decode(bytes(turbo.encode(image, quality))))
+        if actual < expected - 0.5:
+            print(
+                f"MISMATCH: encode of image {index} "
+                f"({actual:.1f} vs {expected:.1f} dB)"
+            )
+            failures += 1
+    if not failures:
+        print("libjpeg-turbo matches PIL's JPEG codec")
+    return failures
+
+
+def main(sizes=(150, 256, 384, 512), quality=90, iterations=100, frames=None):
+    # Encode and decode time, bytes per frame and PSNR for every codec at the
+    # frame sizes the clients and server use. Reduced JPEG decodes are compared
+    # against the full image shrunk to the same size.
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    images = load_images(frames)
+    if not images:
+        raise ValueError(f"No images found in {frames or ASSETS}")
+    failures = check_turbo(images, quality)
+    cases = codecs_to_test()
+    print(
+        f"{'size':>5} {'codec':<20}{'encode ms':>10}{'decode ms':>10}"
+        f"{'KB/frame':>10}{'PSNR dB':>9}"
+    )
+    for size in sizes:
+        test_images = [
+            cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+            for image in images
+        ]
+        for label, codec, min_scale in cases:
+            t_start = time.perf_counter()
+            encoded = [
+                bytes(codec.encode(test_images[i % len(test_images)], quality))
+                for i in range(iterations)
+            ]
+            encode_time = (time.perf_counter() - t_start) / iterations
+
+            t_start = time.perf_counter()
+            for data in encoded:
+                codec.decode(data, size, size, min_scale)
+            decode_time = (time.perf_counter() - t_start) / iterations
+
+            psnr = []
+            for image, data in zip(test_images, encoded):
+                decoded = codec.decode(data, size, size, min_scale)
+                if decoded.shape != image.shape:
+                    image = cv2.resize(
+                        image, decoded.shape[1::-1], interpolation=cv2.INTER_AREA
+                    )
+                psnr.append(cv2.PSNR(image, decoded))
+            size_kb = np.mean([len(data) for data in encoded]) / 1024
+            # cv2.PSNR reports identical images as 361 dB
+            psnr = "lossless" if min(psnr) > 300 else f"{np.mean(psnr):.1f}"
+            print(
+                f"{size:>5} {label:<20}{encode_time * 1000:>10.3f}"
+                f"{decode_time * 1000:>10.3f}{size_kb:>10.1f}{psnr:>9}"
+            )
+
+    if failures:
+        print(f"{failures} libjpeg-turbo mismatches")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+
+import cv2
+import fire
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocessing import Preprocessor  # noqa: E402
+
+
+def legacy_preprocess(img, preprocessing):
+    # The if/elif chain server.process_image used before the operator registry
+    if preprocessing == "canny":
+        img = cv2.Canny(img, 100, 200)
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif preprocessing == "canny_blur_shift":
+        blur_img = cv2.GaussianBlur(img, (3, 3), 0)
+        canny_img = cv2.Canny(blur_img, 100, 200)
+        canny_img = cv2.cvtColor(canny_img, cv2.COLOR_GRAY2BGR)
+        canny_img[np.where((canny_img == [0, 0, 0]).all(axis=2))] = [
+            255,
+            0,
+            0,
+        ]
+        img = cv2.addWeighted(img, 0.8, canny_img, 0.2, 0)
+    elif preprocessing == "blur":
+        img = cv2.GaussianBlur(img, (5, 5), 0)
+    elif preprocessing == "gray":
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif preprocessing == "contrast":
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        img = clahe.apply(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return img
+
+
+# (legacy mode, equivalent registry spec)
+CASES = [
+    ("canny", "canny"),
+    ("canny_blur_shift", "canny_blur_shift"),
+    ("canny_blur_shift", "blur:3,canny,tint"),
+    ("blur", "blur"),
+    ("gray", "gray"),
+    ("contrast", "contrast"),
+]
+
+
+def make_frames(size, count=8, seed=0):
+    # Smooth shapes plus noise so Canny finds both edges and flat regions
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(count):
+        img = np.zeros((size, size, 3), dtype=np.uint8)
+        for _ in range(12):
+            center = tuple(int(v) for v in rng.integers(0, size, 2))
+            color = tuple(int(v) for v in rng.integers(0, 256, 3))
+            cv2.circle(img, center, int(rng.integers(5, size // 3)), color, -1)
+        noise = rng.integers(0, 20, img.shape, dtype=np.uint8)
+        frames.append(cv2.add(img, noise))
+    return frames
+
+
+def time_per_frame(fn, frames, iterations):
+    t_start = time.perf_counter()
+    for i in range(iterations):
+        fn(frames[i % len(frames)])
+    return (time.perf_counter() - t_start) / iterations
+
+
+def main(sizes=(150, 256, 512), iterations=200, frames=None):
+    # Times every registry spec against the legacy mode it replaces. That they
+    # are pixel-identical is checked in tests/test_preprocessing.py
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    print(f"{'size':>5} {'legacy mode':<18}{'spec':<20}{'legacy ms':>10}{'new ms':>10}{'speedup':>9}")
+    for size in sizes:
+        if frames is not None:
+            names = sorted(os.listdir(frames))
+            test_frames = [
+                cv2.resize(cv2.imread(os.path.join(frames, name)), (size, size))
+                for name in names
+                if name.lower().endswith((".jpg", ".jpeg", ".png"))
+            ]
+        else:
+            test_frames = make_frames(size)
+
+        for mode, spec in CASES:
+            preprocessor = Preprocessor(spec)
+            legacy_time = time_per_frame(
+                lambda img: legacy_preprocess(img, mode), test_frames, iterations
+            )
+            new_time = time_per_frame(preprocessor, test_frames, iterations)
+            print(
+                f"{size:>5} {mode:<18}{spec:<20}{legacy_time * 1000:>10.3f}"
+                f"{new_time * 1000:>10.3f}{legacy_time / new_time:>8.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
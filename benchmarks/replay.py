@@ -0,0 +1,353 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import cv2
+import fire
+import numpy as np
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol  # noqa: E402
+from backends import load_backend  # noqa: E402
+from loopback import LoopbackConnection  # noqa: E402
+from server import create_handler  # noqa: E402
+
+SERVER_STAGES = [
+    "decode",
+    "preprocess",
+    "to_pil",
+    "queue_wait",
+    "diffusion",
+    "postprocess",
+    "encode",
+    "send",
+    "total",
+]
+
+
+def load_frames(frames, image_size=256, jpeg_quality=90, max_frames=300):
+    # A directory of JPEG files is replayed as-is. A video file is decoded and
+    # re-encoded at image_size. Without a source, a moving synthetic pattern is
+    # generated so runs are reproducible anywhere.
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+    if frames is None:
+        encoded = []
+        x, y = np.meshgrid(np.arange(image_size), np.arange(image_size))
+        for i in range(min(max_frames, 60)):
+            img = np.stack(
+                [(x + i * 4) % 256, (y + i * 2) % 256, (x + y + i * 8) % 256], axis=2
+            ).astype(np.uint8)
+            encoded.append(cv2.imencode(".jpg", img, encode_param)[1].tobytes())
+        return encoded
+
+    if os.path.isdir(frames):
+        names = sorted(
+            name
+            for name in os.listdir(frames)
+            if name.lower().endswith((".jpg", ".jpeg"))
+        )[:max_frames]
+        encoded = []
+        for name in names:
+            with open(os.path.join(frames, name), "rb") as f:
+                encoded.append(f.read())
+        return encoded
+
+    cap = cv2.VideoCapture(frames)
+    encoded = []
+    while len(encoded) < max_frames:
+        ret, img = cap.read()
+        if not ret:
+            break
+        img = cv2.resize(img, (image_size, image_size))
+        encoded.append(cv2.imencode(".jpg", img, encode_param)[1].tobytes())
+    cap.release()
+    return encoded
+
+
+async def run_connection(
+    websocket, frames, fps, num_frames, prompt, ingest, timeout, protocol_version
+):
+    config = {"prompt": prompt, "ingest": ingest}
+    if protocol_version:
+        config["protocol"] = protocol_version
+    await websocket.send(json.dumps(config))
+
+    # Raw responses come back in send order, so they are matched first in, first
+    # out; enveloped responses carry the sequence number of their frame
+    send_times = deque()
+    latencies = []
+    server_times = []
+    send_times_all = []
+    errors = 0
+    dropped = 0
+    unchanged = 0
+
+    async def sender():
+        next_send = time.time()
+        for i in range(num_frames):
+            t_start = time.time()
+            message = frames[i % len(frames)]
+            if protocol_version:
+                message = protocol.pack(
+                    protocol.FRAME,
+                    message,
+                    seq=i,
+                    codec=protocol.CODEC_JPEG,
+                    capture_ts=t_start,
+                    version=protocol_version,
+                )
+            else:
+                send_times.append(t_start)
+            await websocket.send(message)
+            send_times_all.append(time.time() - t_start)
+            next_send += 1 / fps
+            await asyncio.sleep(max(0, next_send - time.time()))
+
+    async def receiver():
+        nonlocal errors, dropped, unchanged
+        answered = 0
+        while answered < num_frames:
+            try:
+                response = await asyncio.wait_for(websocket.recv(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if isinstance(response, str):
+                continue
+            answered += 1
+            envelope = protocol.unpack(response)
+            if envelope is None:
+                latencies.append(time.time() - send_times.popleft())
+                if response.startswith(b'{"error"'):
+                    errors += 1
+            elif envelope.type == protocol.DROPPED:
+                dropped += 1
+            else:
+                latencies.append(time.time() - envelope.capture_ts)
+                server_times.append(envelope.send_ts - envelope.recv_ts)
+                if envelope.type == protocol.ERROR:
+                    errors += 1
+                elif envelope.type == protocol.UNCHANGED:
+                    unchanged += 1
+
+    await asyncio.gather(sender(), receiver())
+    await websocket.close()
+    return {
+        "sent": num_frames,
+        "received": len(latencies),
+        "errors": errors,
+        "dropped": dropped,
+        "unchanged": unchanged,
+        "latencies": latencies,
+        "server_times": server_times,
+        "client_send": send_times_all,
+    }
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+        "count": int(values.size),
+    }
+
+
+async def run_benchmark(
+    frames,
+    mode,
+    url,
+    fps,
+    concurrency,
+    num_frames,
+    prompt,
+    ingest,
+    timeout,
+    protocol_version,
+    server_kwargs,
+):
+    server_frames = []
+    server = None
+    if url is None:
+        handler = create_handler(on_frame=server_frames.append, **server_kwargs)
+
+    if mode == "inprocess":
+        if url is not None:
+            raise ValueError("url can only be used in websocket mode")
+        connections = [LoopbackConnection() for _ in range(concurrency)]
+        server_tasks = [asyncio.ensure_future(handler(c)) for c in connections]
+        clients = [c.client() for c in connections]
+    elif mode == "websocket":
+        if url is None:
+            server = await websockets.serve(handler, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            url = f"ws://127.0.0.1:{port}"
+        server_tasks = []
+        clients = [await websockets.connect(url, max_size=None) for _ in range(concurrency)]
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    t_start = time.time()
+    results = await asyncio.gather(
+        *[
+            run_connection(
+                client,
+                frames,
+                fps,
+                num_frames,
+                prompt,
+                ingest,
+                timeout,
+                protocol_version,
+            )
+            for client in clients
+        ]
+    )
+    elapsed = time.time() - t_start
+
+    await asyncio.gather(*server_tasks, return_exceptions=True)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+    received = sum(result["received"] for result in results)
+    stages = {
+        stage: percentiles([f.timings[stage] for f in server_frames if stage in f.timings])
+        for stage in SERVER_STAGES
+    }
+    return {
+        "elapsed_s": elapsed,
+        "sent": sum(result["sent"] for result in results),
+        "received": received,
+        "errors": sum(result["errors"] for result in results),
+        "dropped": sum(result["dropped"] for result in results),
+        "unchanged": sum(result["unchanged"] for result in results),
+        "throughput_fps": received / elapsed,
+        "end_to_end": percentiles([l for r in results for l in r["latencies"]]),
+        "server_time": percentiles([t for r in results for t in r["server_times"]]),
+        "client_send": percentiles([s for r in results for s in r["client_send"]]),
+        "server_stages": stages,
+        "copies_per_frame": float(np.mean([f.copies for f in server_frames]))
+        if server_frames
+        else None,
+    }
+
+
+def main(
+    frames=None,
+    mode="inprocess",
+    url=None,
+    fps=20,
+    concurrency=1,
+    num_frames=300,
+    image_size=256,
+    jpeg_quality=90,
+    prompt="",
+    ingest="queue",
+    timeout=10.0,
+    protocol_version=protocol.VERSION,
+    output="benchmark_results.json",
+    backend="cpu",
+    base_model_path=None,
+    acceleration="none",
+    t_index_list=None,
+    cpu_latency=0.05,
+    cpu_style="stylization",
+    zero_copy=True,
+    cpu_similar_threshold=0.0,
+    **server_kwargs,
+):
+    # Replays frames against the server at `fps` per connection over `concurrency`
+    # connections. "inprocess" feeds process_image through a loopback connection,
+    # "websocket" goes through a real socket: to `url` if given, otherwise to a
+    # server started on a local port. Server stage timings are only available
+    # when the server runs in this process. With protocol_version 0 frames are
+    # sent as raw JPEG; otherwise in the frame envelope, which also gives the
+    # server time per frame from any server.
+    frame_data = load_frames(frames, image_size, jpeg_quality, num_frames)
+    if not frame_data:
+        raise ValueError(f"No frames found in {frames}")
+
+    server_kwargs["prompt"] = prompt
+    if url is None:
+        server_kwargs["model"] = load_backend(
+            backend,
+            base_model_path,
+            acceleration,
+            t_index_list=t_index_list,
+            cpu_latency=cpu_latency,
+            cpu_style=cpu_style,
+            zero_copy=zero_copy,
+            cpu_similar_threshold=cpu_similar_threshold,
+        )
+
+    result = asyncio.run(
+        run_benchmark(
+            frame_data,
+            mode,
+            url,
+            fps,
+            concurrency,
+            num_frames,
+            prompt,
+            ingest,
+            timeout,
+            protocol_version,
+            server_kwargs if url is None else None,
+        )
+    )
+    result["config"] = {
+        "frames": frames,
+        "mode": mode,
+        "url": url,
+        "fps": fps,
+        "concurrency": concurrency,
+        "num_frames": num_frames,
+        "image_size": image_size,
+        "jpeg_quality": jpeg_quality,
+        "ingest": ingest,
+        "protocol_version": protocol_version,
+        "backend": backend if url is None else None,
+        "zero_copy": zero_copy if url is None else None,
+        "server": {
+            key: value for key, value in server_kwargs.items() if key != "model"
+        },
+    }
+
+    print("\nBenchmark results:")
+    print(f"Throughput: {result['throughput_fps']:.2f} FPS")
+    print(
+        f"Frames: {result['received']}/{result['sent']} "
+        f"({result['errors']} errors, {result['dropped']} dropped, "
+        f"{result['unchanged']} unchanged)"
+    )
+    if result["copies_per_frame"] is not None:
+        print(f"Host frame copies per frame: {result['copies_per_frame']:.1f}")
+    rows = [
+        ("end_to_end", result["end_to_end"]),
+        ("server_time", result["server_time"]),
+    ] + list(result["server_stages"].items())
+    print(f"{'stage':<12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in rows:
+        if stats is not None:
+            print(
+                f"{name:<12}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+                f"{stats['p99_ms']:>10.2f}"
+            )
+
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+
+class CaptureThread:
+    # Reads camera frames on a dedicated thread so blocking reads never stall the
+    # event loop. Only the newest frame is kept: a frame nobody picked up before
+    # the next one arrives is overwritten and counted as skipped. read_fn returns
+    # a new frame per call, or None once the camera stops.
+    def __init__(self, read_fn):
+        self.read_fn = read_fn
+        self.frames = 0
+        self.skipped = 0
+        self.read_time = 0.0
+        self.failed = False
+        self._frame = None
+        self._captured_at = 0.0
+        self._taken = True
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def _run(self):
+        while self._running:
+            t_start = time.time()
+            frame = self.read_fn()
+            captured_at = time.time()
+            with self._condition:
+                self.read_time = captured_at - t_start
+                if frame is None:
+                    self.failed = True
+                    self._running = False
+                else:
+                    if not self._taken:
+                        self.skipped += 1
+                    self._frame = frame
+                    self._captured_at = captured_at
+                    self._taken = False
+                    self.frames += 1
+                self._condition.notify_all()
+
+    def get(self, timeout=1.0, after=0.0):
+        # Returns (frame, capture time) for a frame not returned before and
+        # captured after `after`, waiting up to `timeout` seconds for one. None if
+        # nothing arrived or the camera stopped.
+        def ready():
+            return not self._taken and self._captured_at > after
+
+        with self._condition:
+            self._condition.wait_for(lambda: ready() or not self._running, timeout)
+            if not ready():
+                return None
+            self._taken = True
+            return self._frame, self._captured_at
+
+
+class FramePacer:
+    # Sleeps until the next send deadline instead of polling the clock. Deadlines
+    # advance by one frame interval; after falling more than an interval behind,
+    # the schedule restarts from now rather than bursting to catch up.
+    def __init__(self, target_fps):
+        self.interval = 1 / target_fps
+        self._deadline = None
+
+    async def wait(self):
+        now = time.time()
+        if self._deadline is None or now - self._deadline > self.interval:
+            self._deadline = now
+        elif self._deadline > now:
+            await asyncio.sleep(self._deadline - now)
+        self._deadline += self.interval
@@ -0,0 +1,151 @@
+import math
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# cv2.rotate codes for np.rot90(image, k)
+ROTATIONS = {
+    1: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    2: cv2.ROTATE_180,
+    3: cv2.ROTATE_90_CLOCKWISE,
+}
+
+
+def crop_window(height, width, crop_size, crop_offset_y=0):
+    # The square client_pi crops out of the rotated frame, as row and column slices
+    rows = slice(
+        height // 2 - crop_size // 2 - crop_offset_y,
+        height // 2 + crop_size // 2 - crop_offset_y,
+    )
+    cols = slice(width // 2 - crop_size // 2, width // 2 + crop_size // 2)
+    return rows, cols
+
+
+def _rotated_rect(map_x, map_y):
+    # Returns (y0, y1, x0, x1, k) if the crop is np.rot90(frame[y0:y1, x0:x1], k)
+    if (map_y < 0).any():
+        return None
+    for k in range(4):
+        rect_x = np.rot90(map_x, -k)
+        rect_y = np.rot90(map_y, -k)
+        y0, x0 = int(rect_y[0, 0]), int(rect_x[0, 0])
+        rect_h, rect_w = rect_x.shape
+        if (rect_y == y0 + np.arange(rect_h)[:, None]).all() and (
+            rect_x == x0 + np.arange(rect_w)[None, :]
+        ).all():
+            return y0, y0 + rect_h, x0, x0 + rect_w, k
+    return None
+
+
+def _rotation_matrix(rotation, width, height):
+    # Output to input mapping PIL's Image.rotate uses (expand=False)
+    angle = -math.radians(rotation % 360.0)
+    a, b = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    d, e = round(-math.sin(angle), 15), round(math.cos(angle), 15)
+    center_x, center_y = width / 2.0, height / 2.0
+    c = a * -center_x + b * -center_y + center_x
+    f = d * -center_x + e * -center_y + center_y
+    return a, b, c, d, e, f
+
+
+class CaptureTransform:
+    # Turns camera frames into the square model input exactly like client_pi's
+    # original path (PIL convert to RGB, rotate with nearest sampling and no
+    # expansion, crop, cv2 linear resize), but only touches pixels inside the
+    # crop. The source pixel of every crop pixel is found once per frame shape
+    # by rotating an image of pixel indices with PIL itself, so the output is
+    # pixel-identical. A crop that is a plain 90-degree turn of a rectangle of
+    # the frame is cut with slicing and cv2.rotate, anything else goes through a
+    # cached nearest-neighbour remap. The camera's padding channel, if any, is
+    # dropped after resizing, on the small image. With exact=False, rotation, crop and
+    # resize collapse into a single bilinear remap to image_size, which is
+    # faster but not bit-identical. The returned array is reused for the next
+    # frame.
+    def __init__(self, crop_size, crop_offset_y=0, rotation=0, image_size=256, exact=True):
+        self.crop_size = crop_size
+        self.crop_offset_y = crop_offset_y
+        self.rotation = rotation
+        self.image_size = image_size
+        self.exact = exact
+        self._shape = None
+        self._rect = None
+        self._maps = None
+        self._crop = None
+        self._output = None
+        self._rgb = None
+
+    def __call__(self, frame):
+        if frame.shape != self._shape:
+            self._build(frame.shape)
+
+        if not self.exact:
+            output = cv2.remap(
+                frame,
+                self._maps[0],
+                self._maps[1],
+                cv2.INTER_LINEAR,
+                dst=self._output,
+                borderMode=cv2.BORDER_CONSTANT,
+            )
+        else:
+            if self._rect is not None:
+                y0, y1, x0, x1, k = self._rect
+                crop = frame[y0:y1, x0:x1]
+                if k != 0:
+                    crop = cv2.rotate(crop, ROTATIONS[k], dst=self._crop)
+            else:
+                crop = cv2.remap(
+                    frame,
+                    self._maps,
+                    None,
+                    cv2.INTER_NEAREST,
+                    dst=self._crop,
+                    borderMode=cv2.BORDER_CONSTANT,
+                )
+            output = cv2.resize(
+                crop, (self.image_size, self.image_size), dst=self._output
+            )
+
+        if frame.shape[2] == 4:
+            return cv2.cvtColor(output, cv2.COLOR_BGRA2BGR, dst=self._rgb)
+        return output
+
+    def _build(self, shape):
+        height, width, channels = shape
+        rows, cols = crop_window(height, width, self.crop_size, self.crop_offset_y)
+        self._shape = shape
+        self._rect = None
+        self._crop = None
+        self._output = np.empty((self.image_size, self.image_size, channels), np.uint8)
+        self._rgb = np.empty((self.image_size, self.image_size, 3), np.uint8)
+
+        if not self.exact:
+            y0 = rows.indices(height)[0]
+            x0 = cols.indices(width)[0]
+            crop_h = len(range(*rows.indices(height)))
+            crop_w = len(range(*cols.indices(width)))
+            # Sample positions of the linear resize, in rotated frame coordinates
+            u = (np.arange(self.image_size) + 0.5) * crop_w / self.image_size - 0.5 + x0
+            v = (np.arange(self.image_size) + 0.5) * crop_h / self.image_size - 0.5 + y0
+            x, y = np.meshgrid(u, v)
+            a, b, c, d, e, f = _rotation_matrix(self.rotation, width, height)
+            map_x = a * (x + 0.5) + b * (y + 0.5) + c - 0.5
+            map_y = d * (x + 0.5) + e * (y + 0.5) + f - 0.5
+            self._maps = cv2.convertMaps(
+                map_x.astype(np.float32), map_y.astype(np.float32), cv2.CV_16SC2
+            )
+            return
+
+        index = np.arange(1, height * width + 1, dtype=np.int32).reshape(height, width)
+        if self.rotation != 0:
+            index = np.array(Image.fromarray(index).rotate(self.rotation))
+        # 0 marks pixels PIL fills with black, which map outside the frame
+        map_y, map_x = np.divmod(index[rows, cols] - 1, width)
+        crop_h, crop_w = map_x.shape
+
+        self._rect = _rotated_rect(map_x, map_y)
+        self._maps = None
+        if self._rect is None:
+            self._maps = np.dstack([map_x, map_y]).astype(np.int16)
+        self._crop = np.empty((crop_h, crop_w, channels), np.uint8)
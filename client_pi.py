@@ -1,13 +1,15 @@
 import asyncio
 import websockets
-import numpy as np
-from PIL import Image
 import tkinter as tk
-import json
 import os
 import cv2
 from picamera2 import Picamera2
 import time
+import protocol
+from capture_transform import CaptureTransform
+from client_session import run_session
+from frame_codecs import available_codecs
+from display import INTERPOLATIONS, DisplayTransform
 
 # Choose default device
 os.environ["DISPLAY"] = ":0"
@@ -26,6 +28,26 @@ async def capture_and_send(
     jpeg_quality=90,
     rotation=0,
     target_fps=30,
+    ingest="latest",
+    max_in_flight=2,
+    response_timeout=1.0,
+    protocol_version=protocol.VERSION,
+    fast_transform=False,
+    display_interpolation="cubic",
+    adaptive=False,
+    min_jpeg_quality=40,
+    min_image_size=128,
+    min_fps=5,
+    max_rtt=0.5,
+    motion_threshold=0.0,
+    refresh_interval=1.0,
+    codec="jpeg",
+    tiles=False,
+    metrics_file=None,
+    metrics_interval=10.0,
+    trace_file=None,
+    trace_size=10000,
+    style=None,
 ):
     uri = url
     async with websockets.connect(uri) as websocket:
@@ -61,176 +83,62 @@ async def capture_and_send(
 
         print("Connected to server...")
 
-        # Send prompt to server as json
-        await websocket.send(
-            json.dumps(
-                {
-                    "prompt": prompt,
-                    "negative_prompt": negative_prompt,
-                }
-            )
+        # Rotate, crop and resize in one pass over the crop only, rebuilt
+        # when the adaptive mode changes the image size
+        transform = CaptureTransform(
+            crop_size, crop_offset_y, rotation, image_size, exact=not fast_transform
         )
 
-        # Initialize frame management variables
-        frame_count = 0
-        last_send_time = 0
-        min_frame_interval = 1 / target_fps
-        last_stats_time = time.time()
-        frames_since_stats = 0
-        last_displayed_frame = None
-
-        while True:
-            loop_start = time.time()
-
-            # Capture frame
-            t_start = time.time()
-            frame = picam2.capture_array()
-            capture_time = time.time() - t_start
-
-            # Check if we should process this frame based on target FPS
-            current_time = time.time()
-            if current_time - last_send_time < min_frame_interval:
-                # If we have a previous frame, display it to maintain smooth output
-                if last_displayed_frame is not None:
-                    cv2.imshow("image", last_displayed_frame)
-                if cv2.waitKey(1) & 0xFF == ord("q"):
-                    break
-                continue
-
-            t_start = time.time()
-            h, w, _ = frame.shape
-            frame = Image.fromarray(frame)
-            frame = frame.convert("RGB")
-            pil_convert_time = time.time() - t_start
-
-            if rotation != 0:
-                t_start = time.time()
-                frame = frame.rotate(rotation)
-                rotation_time = time.time() - t_start
-            else:
-                rotation_time = 0
-
-            t_start = time.time()
-            frame = np.array(frame)
-            np_convert_time = time.time() - t_start
-
-            # Crop square
+        def prepare(frame, image_size, record):
+            nonlocal transform
             t_start = time.time()
-            frame = frame[
-                h // 2
-                - crop_size // 2
-                - crop_offset_y : h // 2
-                + crop_size // 2
-                - crop_offset_y,
-                w // 2 - crop_size // 2 : w // 2 + crop_size // 2,
-            ]
-            crop_time = time.time() - t_start
-
-            # Reduce size
-            t_start = time.time()
-            frame = cv2.resize(frame, (image_size, image_size))
-            resize_time = time.time() - t_start
-
-            # Encode frame
-            t_start = time.time()
-            compression_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
-            result, buffer = cv2.imencode(".jpg", frame, compression_params)
-            encode_time = time.time() - t_start
-
-            if not result:
-                print("Failed to encode image")
-                continue
-
-            # Send to server
-            t_start = time.time()
-            jpeg_bytes = buffer.tobytes()
-            await websocket.send(jpeg_bytes)
-            last_send_time = current_time
-            send_time = time.time() - t_start
-
-            # Network receive with timeout
-            t_start = time.time()
-            try:
-                response = await asyncio.wait_for(
-                    websocket.recv(), timeout=1 / target_fps
+            if transform.image_size != image_size:
+                transform = CaptureTransform(
+                    crop_size,
+                    crop_offset_y,
+                    rotation,
+                    image_size,
+                    exact=not fast_transform,
                 )
-                receive_time = time.time() - t_start
-
-                # Process received data
-                t_start = time.time()
-                if isinstance(response, bytes):
-                    npimg = np.frombuffer(response, dtype=np.uint8)
-                    source = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
-                    if source is None:
-                        print("Failed to decode received image")
-                        continue
-
-                    source = cv2.flip(source, 1)
-
-                    # Crop to screen aspect ratio and resize
-                    aspect_ratio = screen_width / screen_height
-                    source_aspect_ratio = source.shape[1] / source.shape[0]
-
-                    if source_aspect_ratio > aspect_ratio:
-                        crop_width = int(source.shape[0] * aspect_ratio)
-                        crop_offset = (source.shape[1] - crop_width) // 2
-                        source = source[:, crop_offset : crop_offset + crop_width]
-                    else:
-                        crop_height = int(source.shape[1] / aspect_ratio)
-                        crop_offset = (source.shape[0] - crop_height) // 2
-                        source = source[crop_offset : crop_offset + crop_height, :]
-
-                    source = cv2.resize(
-                        source,
-                        dsize=(screen_width, screen_height),
-                        interpolation=cv2.INTER_CUBIC,
-                    )
-
-                    cv2.imshow("image", source)
-                    last_displayed_frame = source
-                process_display_time = time.time() - t_start
-
-            except asyncio.TimeoutError:
-                receive_time = time.time() - t_start
-                print("Server response timeout - skipping frame")
-                # Display last frame if available
-                if last_displayed_frame is not None:
-                    cv2.imshow("image", last_displayed_frame)
-                continue
-
-            total_loop_time = time.time() - loop_start
-
-            # Update statistics
-            frames_since_stats += 1
-            current_time = time.time()
-            stats_interval = current_time - last_stats_time
-
-            # Print timing every 30 frames or every second, whichever comes first
-            if frames_since_stats >= 30 or stats_interval >= 1.0:
-                print("\nTiming breakdown (seconds):")
-                print(f"Capture: {capture_time:.4f}")
-                print(f"PIL convert: {pil_convert_time:.4f}")
-                print(f"Rotation: {rotation_time:.4f}")
-                print(f"Numpy convert: {np_convert_time:.4f}")
-                print(f"Crop: {crop_time:.4f}")
-                print(f"Resize: {resize_time:.4f}")
-                print(f"Encode: {encode_time:.4f}")
-                print(f"Send: {send_time:.4f}")
-                print(f"Receive: {receive_time:.4f}")
-                print(f"Process & Display: {process_display_time:.4f}")
-                print(f"Total loop time: {total_loop_time:.4f}")
-                print(f"Actual FPS: {frames_since_stats/stats_interval:.2f}")
-                print("-" * 40)
-
-                # Reset statistics
-                frames_since_stats = 0
-                last_stats_time = current_time
-
-            if cv2.waitKey(1) & 0xFF == ord("q"):
-                break
-
-            await asyncio.sleep(0.001)  # Small sleep to prevent CPU overload
+            frame = transform(frame)
+            record("transform", t_start)
+            return frame
 
+        # Flip, crop to the screen aspect ratio and resize
+        display = DisplayTransform(
+            screen_width, screen_height, crop=True, interpolation=display_interpolation
+        )
+        await run_session(
+            websocket,
+            picam2.capture_array,
+            prepare,
+            [("transform", "Rotate, crop & resize")],
+            display,
+            prompt,
+            negative_prompt,
+            image_size=image_size,
+            jpeg_quality=jpeg_quality,
+            target_fps=target_fps,
+            ingest=ingest,
+            max_in_flight=max_in_flight,
+            response_timeout=response_timeout,
+            protocol_version=protocol_version,
+            adaptive=adaptive,
+            min_jpeg_quality=min_jpeg_quality,
+            min_image_size=min_image_size,
+            min_fps=min_fps,
+            max_rtt=max_rtt,
+            motion_threshold=motion_threshold,
+            refresh_interval=refresh_interval,
+            codec=codec,
+            tiles=tiles,
+            metrics_file=metrics_file,
+            metrics_interval=metrics_interval,
+            trace_file=trace_file,
+            trace_size=trace_size,
+            style=style,
+        )
+        picam2.stop()
         cv2.destroyAllWindows()
 
 
@@ -281,7 +189,124 @@ if __name__ == "__main__":
     parser.add_argument(
         "--target_fps", type=int, default=30, help="Target FPS for frame capture"
     )
+    parser.add_argument(
+        "--ingest",
+        type=str,
+        default="latest",
+        choices=["queue", "latest"],
+        help="Server ingest mode: process every frame or only the newest pending one",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=2,
+        help="Maximum number of frames sent but not answered yet",
+    )
+    parser.add_argument(
+        "--response_timeout",
+        type=float,
+        default=1.0,
+        help="Seconds before an unanswered frame gives its slot back",
+    )
+    parser.add_argument(
+        "--protocol",
+        type=int,
+        default=protocol.VERSION,
+        help="Frame envelope protocol version to request, 0 for raw JPEG",
+    )
+    parser.add_argument(
+        "--fast_transform",
+        action="store_true",
+        help="Rotate, crop and resize with one bilinear remap (not pixel-identical)",
+    )
+    parser.add_argument(
+        "--display_interpolation",
+        type=str,
+        default="cubic",
+        choices=list(INTERPOLATIONS),
+        help="Interpolation used to scale received frames to the screen",
+    )
 
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adapt JPEG quality, image size and FPS to network conditions",
+    )
+    parser.add_argument(
+        "--min_jpeg_quality",
+        type=int,
+        default=40,
+        help="Lowest JPEG quality the adaptive mode may use",
+    )
+    parser.add_argument(
+        "--min_image_size",
+        type=int,
+        default=128,
+        help="Smallest image size the adaptive mode may use",
+    )
+    parser.add_argument(
+        "--min_fps", type=float, default=5, help="Lowest FPS the adaptive mode may use"
+    )
+    parser.add_argument(
+        "--max_rtt",
+        type=float,
+        default=0.5,
+        help="Network round trip time (excluding server time) the adaptive mode aims below",
+    )
+    parser.add_argument(
+        "--motion_threshold",
+        type=float,
+        default=0.0,
+        help="Mean luma difference (0-1) below which frames are not sent, 0 to send all",
+    )
+    parser.add_argument(
+        "--refresh_interval",
+        type=float,
+        default=1.0,
+        help="Seconds after which a frame is sent even if the scene did not change",
+    )
+    parser.add_argument(
+        "--codec",
+        type=str,
+        default="jpeg",
+        choices=available_codecs(),
+        help="Image codec to ask the server for, in both directions",
+    )
+    parser.add_argument(
+        "--tiles",
+        action="store_true",
+        help="Receive only the changed tiles of each result, with periodic keyframes",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="File to write Prometheus text metrics to, e.g. for node_exporter",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        default=10.0,
+        help="Seconds between metrics file updates",
+    )
+    parser.add_argument(
+        "--trace_file",
+        type=str,
+        default=None,
+        help="File to write per-frame spans to on exit, as Chrome trace JSON",
+    )
+    parser.add_argument(
+        "--trace_size",
+        type=int,
+        default=10000,
+        help="Number of most recent spans kept for the trace",
+    )
+    parser.add_argument(
+        "--style",
+        type=str,
+        default=None,
+        help="Named style to ask the server for, from its --styles file",
+    )
     args = parser.parse_args()
 
     asyncio.get_event_loop().run_until_complete(
@@ -298,5 +323,25 @@ if __name__ == "__main__":
             args.jpeg_quality,
             args.rotation,
             args.target_fps,
+            args.ingest,
+            args.max_in_flight,
+            args.response_timeout,
+            args.protocol,
+            args.fast_transform,
+            args.display_interpolation,
+            args.adaptive,
+            args.min_jpeg_quality,
+            args.min_image_size,
+            args.min_fps,
+            args.max_rtt,
+            args.motion_threshold,
+            args.refresh_interval,
+            args.codec,
+            args.tiles,
+            args.metrics_file,
+            args.metrics_interval,
+            args.trace_file,
+            args.trace_size,
+            args.style,
         )
     )
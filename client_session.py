@@ -0,0 +1,458 @@
+import asyncio
+import cv2
+import json
+import time
+import protocol
+from adaptive import AdaptiveController
+from capture import CaptureThread, FramePacer
+from frame_codecs import CodecSet
+from inflight import InFlightWindow
+from metrics import ClientMetrics
+from motion_gate import MotionGate
+from tiles import TileCanvas
+from tracing import Tracer, span
+
+
+async def run_session(
+    websocket,
+    read_frame,
+    prepare,
+    stages,
+    display,
+    prompt,
+    negative_prompt,
+    image_size=256,
+    jpeg_quality=90,
+    target_fps=30,
+    ingest="latest",
+    max_in_flight=2,
+    response_timeout=1.0,
+    protocol_version=protocol.VERSION,
+    adaptive=False,
+    min_jpeg_quality=40,
+    min_image_size=128,
+    min_fps=5,
+    max_rtt=0.5,
+    motion_threshold=0.0,
+    refresh_interval=1.0,
+    codec="jpeg",
+    tiles=False,
+    metrics_file=None,
+    metrics_interval=10.0,
+    trace_file=None,
+    trace_size=10000,
+    style=None,
+):
+    # Streams camera frames to the server and shows its results in the "image"
+    # window until the server closes the connection, the camera fails or "q" is
+    # pressed. Shared by client.py and client_pi.py, which bring the camera and
+    # the window: read_frame() returns a camera frame, or None, and runs on a
+    # capture thread. prepare(frame, image_size, record) turns a camera frame
+    # into the image to send, timing its steps with record(name, t_start);
+    # stages lists those steps as (name, label) for the timing breakdown.
+    # display is the DisplayTransform results are shown through.
+    # Send prompt configuration as JSON
+    await websocket.send(
+        json.dumps(
+            {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "ingest": ingest,
+                "protocol": protocol_version,
+                "codecs": [codec],
+                "tiles": tiles,
+            }
+        )
+    )
+    if style is not None:
+        # The server keeps its default style until this one has loaded
+        await websocket.send(json.dumps({"style": style}))
+
+    running = True
+    # Frames go out as raw JPEG until the server confirms it speaks the
+    # envelope protocol; servers that predate it never answer
+    server_protocol = 0
+    # Same for the codec: JPEG until the server names the one it picked
+    codecs = CodecSet()
+    frame_codec = codecs.get("jpeg")
+
+    # Up to max_in_flight frames are sent ahead of their responses; the
+    # sender and receiver run as separate coroutines
+    window = InFlightWindow(max_in_flight, response_timeout)
+    # Set by the receiver whenever a response frees a slot
+    window_room = asyncio.Event()
+    timings = {"capture": 0.0, "capture_to_send": 0.0}
+    timings.update((name, 0.0) for name, _ in stages)
+    timings.update(gate=0.0, encode=0.0, send=0.0)
+    # Per-frame timings from the envelope timestamps
+    latency = {}
+
+    # Quality, input size and frame rate follow network conditions between
+    # the configured minimums and the values given on the command line
+    controller = None
+    if adaptive:
+        controller = AdaptiveController(
+            jpeg_quality,
+            image_size,
+            target_fps,
+            min_jpeg_quality,
+            min_image_size,
+            min_fps,
+            max_rtt,
+        )
+
+    # Latency histograms and frame counts, dumped to metrics_file
+    metrics = ClientMetrics(metrics_file, metrics_interval)
+
+    # Per-frame spans, written to trace_file on exit
+    tracer = Tracer(trace_size) if trace_file else None
+    # Spans of the frame being sent, tagged with its seq once it is
+    spans = []
+
+    def record(name, t_start):
+        # Stage time for the breakdown, plus a span when tracing
+        t_end = time.time()
+        timings[name] = t_end - t_start
+        if tracer is not None:
+            spans.append(span(name, t_start, t_end, "send"))
+
+    def trace_response(
+        seq, envelope, received_at, round_trip_time, outcome, t_display=None
+    ):
+        # Server and network spans are laid out from the round trip with
+        # equal uplink and downlink times, so they need no synced clocks
+        sent_at = received_at - round_trip_time
+        start = sent_at
+        response_spans = []
+        if envelope is not None:
+            start = envelope.capture_ts
+            server_time = envelope.send_ts - envelope.recv_ts
+            network = max(round_trip_time - server_time, 0.0) / 2
+            response_spans += [
+                span("uplink", sent_at, sent_at + network, "network"),
+                span("server", sent_at + network, received_at - network, "server"),
+                span("downlink", received_at - network, received_at, "network"),
+            ]
+        if t_display is not None:
+            response_spans.append(
+                span("process_display", t_display, None, "receive")
+            )
+        tracer.add_frame(
+            "client", seq, start, time.time(), response_spans, outcome=outcome
+        )
+
+    # Frames too close to the last one sent stay on the client
+    gate = None
+    if motion_threshold > 0:
+        gate = MotionGate(motion_threshold, refresh_interval)
+
+    # With tile updates, results are patched into the last full one
+    canvas = TileCanvas() if tiles else None
+
+    def decode_result(envelope, payload):
+        if envelope is None:
+            return codecs.get("jpeg").decode(payload)
+        codec = codecs.by_id(envelope.codec)
+        if envelope.type == protocol.TILES:
+            if canvas is None:
+                return None
+            return canvas.patch(payload, codec, envelope.width, envelope.height)
+        if canvas is not None:
+            # Kept at full size, later tiles are patched into it
+            image = codec.decode(payload, envelope.width, envelope.height)
+            return None if image is None else canvas.keyframe(image)
+        # JPEG can decode straight to a smaller size when the display
+        # needs less than the full frame
+        return codec.decode(
+            payload,
+            envelope.width,
+            envelope.height,
+            display.min_scale(envelope.width, envelope.height),
+        )
+
+    async def receiver():
+        nonlocal running, server_protocol, frame_codec
+        last_stats_time = time.time()
+        frames_since_stats = 0
+        server_dropped = 0
+        server_unchanged = 0
+        receive_start = time.time()
+        async for response in websocket:
+            received_at = time.time()
+            receive_time = received_at - receive_start
+
+            if isinstance(response, str):
+                # Answer to the JSON configuration
+                try:
+                    reply = json.loads(response)
+                except json.JSONDecodeError:
+                    print("Received invalid JSON from server")
+                    continue
+                if protocol_version and reply.get("protocol", 0) >= 1:
+                    server_protocol = reply["protocol"]
+                    print(f"Server protocol version: {reply['protocol']}")
+                if "codec" in reply:
+                    frame_codec = codecs.get(reply["codec"])
+                    print(f"Codec: {reply['codec']}")
+                if "tiles" in reply:
+                    print(f"Tile updates: {reply['tiles']}px tiles")
+                if "style" in reply:
+                    print(f"Style: {reply['style']}")
+                if "error" in reply:
+                    print(f"Server error: {reply['error']}")
+                if "max_fps" in reply and controller is not None:
+                    controller.server_hint(reply["max_fps"])
+                continue
+
+            # Process and display
+            t_start = time.time()
+            try:
+                envelope = protocol.unpack(response)
+            except ValueError as e:
+                print(f"Received invalid message: {e}")
+                continue
+            if envelope is None:
+                match = window.match()
+                payload = response
+            else:
+                match = window.match(envelope.seq)
+                payload = envelope.payload
+            if match is None:
+                if canvas is not None and envelope is not None and envelope.type in (
+                    protocol.RESULT,
+                    protocol.TILES,
+                ):
+                    # Later tiles build on this result even though its
+                    # frame timed out
+                    decode_result(envelope, payload)
+                print("Received response for unknown frame")
+                continue
+            seq, round_trip_time, late = match
+            window_room.set()
+            if late:
+                print("Late server response")
+
+            if envelope is not None and envelope.type == protocol.DROPPED:
+                server_dropped += 1
+                metrics.count("dropped")
+                if tracer is not None:
+                    trace_response(
+                        seq, envelope, received_at, round_trip_time, "dropped"
+                    )
+                continue
+            if envelope is not None and envelope.type == protocol.ERROR:
+                print(f"Server error: {json.loads(bytes(payload))['error']}")
+                metrics.count("error")
+                if tracer is not None:
+                    trace_response(
+                        seq, envelope, received_at, round_trip_time, "error"
+                    )
+                continue
+
+            if envelope is not None and envelope.type == protocol.UNCHANGED:
+                # Same output as before, the frame on screen stays
+                server_unchanged += 1
+                metrics.count("unchanged")
+            else:
+                frame_decoded = decode_result(envelope, payload)
+                if frame_decoded is None:
+                    if envelope is not None and envelope.type == protocol.TILES:
+                        # Nothing to patch the tiles into
+                        await websocket.send(json.dumps({"keyframe": True}))
+                    print("Failed to decode received image")
+                    continue
+
+                # Flip, rotate or crop, and scale to the window
+                frame_decoded = display(frame_decoded)
+                cv2.imshow("image", frame_decoded)
+            process_display_time = time.time() - t_start
+            if tracer is not None:
+                outcome = "received"
+                if envelope is not None and envelope.type == protocol.UNCHANGED:
+                    outcome = "unchanged"
+                trace_response(
+                    seq, envelope, received_at, round_trip_time, outcome, t_start
+                )
+
+            if controller is not None:
+                server_time = 0.0
+                if envelope is not None:
+                    server_time = envelope.send_ts - envelope.recv_ts
+                controller.observe(round_trip_time, server_time)
+
+            if envelope is not None:
+                # Same clock on both ends for glass to glass; one-way
+                # times compare client and server clocks
+                sent_at = received_at - round_trip_time
+                latency["glass_to_glass"] = time.time() - envelope.capture_ts
+                latency["server"] = envelope.send_ts - envelope.recv_ts
+                latency["uplink"] = envelope.recv_ts - sent_at
+                latency["downlink"] = received_at - envelope.send_ts
+                metrics.observe(
+                    {
+                        "glass_to_glass": latency["glass_to_glass"],
+                        "server": latency["server"],
+                    }
+                )
+            metrics.observe(
+                {"round_trip": round_trip_time, "process_display": process_display_time}
+            )
+            metrics.count("received")
+
+            # Update statistics
+            frames_since_stats += 1
+            current_time = time.time()
+            stats_interval = current_time - last_stats_time
+
+            # Print timing every 30 frames or every second, whichever comes first
+            if frames_since_stats >= 30 or stats_interval >= 1.0:
+                print("\nTiming breakdown (seconds):")
+                print(f"Capture: {timings['capture']:.4f}")
+                print(f"Capture to send: {timings['capture_to_send']:.4f}")
+                print(f"Camera frames skipped: {capture.skipped}/{capture.frames}")
+                for name, label in stages:
+                    print(f"{label}: {timings[name]:.4f}")
+                if gate is not None:
+                    print(f"Motion gate: {timings['gate']:.4f}")
+                    print(
+                        f"Suppressed by motion gate: {gate.suppressed}/{gate.checked} "
+                        f"({gate.suppressed_ratio:.0%}, "
+                        f"difference {gate.difference:.4f})"
+                    )
+                print(f"Encode: {timings['encode']:.4f}")
+                print(f"Send: {timings['send']:.4f}")
+                print(f"Receive: {receive_time:.4f}")
+                print(f"Process & Display: {process_display_time:.4f}")
+                print(f"Round trip: {round_trip_time:.4f}")
+                if controller is not None:
+                    print(
+                        f"Adaptive: quality {controller.jpeg_quality}, "
+                        f"size {controller.image_size}, "
+                        f"target FPS {controller.target_fps:.1f}"
+                    )
+                if latency:
+                    print(f"Glass to glass: {latency['glass_to_glass']:.4f}")
+                    print(f"Server processing: {latency['server']:.4f}")
+                    print(
+                        f"Uplink: {latency['uplink']:.4f}, "
+                        f"downlink: {latency['downlink']:.4f} (needs synced clocks)"
+                    )
+                print(f"In flight: {window.in_flight}/{max_in_flight}")
+                print(f"Timed out frames: {window.expired} ({window.late} late)")
+                print(f"Dropped by server: {server_dropped}")
+                print(f"Unchanged from server: {server_unchanged}")
+                if canvas is not None:
+                    print(
+                        f"Tile updates: {canvas.patches}, "
+                        f"keyframes: {canvas.keyframes}"
+                    )
+                print(f"Actual FPS: {frames_since_stats/stats_interval:.2f}")
+                print("-" * 40)
+
+                # Reset statistics
+                frames_since_stats = 0
+                last_stats_time = current_time
+
+            receive_start = time.time()
+        running = False
+
+    receive_task = asyncio.ensure_future(receiver())
+
+    # The camera is read on its own thread; the loop below only wakes up at
+    # send deadlines and picks the newest frame
+    capture = CaptureThread(read_frame).start()
+    pacer = FramePacer(target_fps)
+    loop = asyncio.get_running_loop()
+
+    while running:
+        # Wait for the next send deadline and for room in the window
+        await pacer.wait()
+        while running and not window.has_room():
+            window_room.clear()
+            try:
+                await asyncio.wait_for(window_room.wait(), window.time_to_expiry())
+            except asyncio.TimeoutError:
+                pass
+
+        if controller is not None:
+            controller.update(window.expired)
+            pacer.interval = 1 / controller.target_fps
+            image_size = controller.image_size
+            if controller.jpeg_quality != jpeg_quality:
+                jpeg_quality = controller.jpeg_quality
+                # The server encodes its output at the same quality
+                await websocket.send(json.dumps({"jpeg_quality": jpeg_quality}))
+
+        # A frame captured after the deadline is fresher than the one
+        # already waiting, at the cost of waiting up to one camera interval
+        captured = await loop.run_in_executor(None, capture.get, 1.0, time.time())
+        if captured is None:
+            if capture.failed:
+                break
+            continue
+        frame, capture_ts = captured
+        timings["capture"] = capture.read_time
+        spans.clear()
+        if tracer is not None:
+            spans.append(
+                span("capture", capture_ts - capture.read_time, capture_ts, "capture")
+            )
+
+        frame = prepare(frame, image_size, record)
+
+        if gate is not None:
+            t_start = time.time()
+            send = gate(frame)
+            record("gate", t_start)
+            if not send:
+                metrics.count("suppressed")
+                if cv2.waitKey(1) & 0xFF == ord("q"):
+                    break
+                continue
+
+        # Encode frame
+        t_start = time.time()
+        encoder = frame_codec if server_protocol else codecs.get("jpeg")
+        encoded = encoder.encode(frame, jpeg_quality)
+        record("encode", t_start)
+
+        if encoded is None:
+            print("Failed to encode image")
+            continue
+
+        # Network send
+        t_start = time.time()
+        seq = window.sent()
+        if server_protocol:
+            message = protocol.pack(
+                protocol.FRAME,
+                encoded,
+                seq=seq,
+                codec=encoder.id,
+                width=image_size,
+                height=image_size,
+                capture_ts=capture_ts,
+                version=server_protocol,
+            )
+        else:
+            message = bytes(encoded)
+        await websocket.send(message)
+        record("send", t_start)
+        timings["capture_to_send"] = time.time() - capture_ts
+        metrics.observe(timings)
+        if tracer is not None:
+            tracer.add_spans("client", seq, spans)
+        metrics.count("sent")
+        metrics.frames.labels("timed_out").set(window.expired)
+        metrics.maybe_write()
+
+        # Also lets the window show frames the receiver passed to imshow
+        if cv2.waitKey(1) & 0xFF == ord("q"):
+            break
+
+    receive_task.cancel()
+    metrics.maybe_write(force=True)
+    if tracer is not None:
+        tracer.write(trace_file)
+        print(f"Trace written to {trace_file}")
+    capture.stop()
@@ -0,0 +1,110 @@
+import cv2
+import numpy as np
+
+INTERPOLATIONS = {
+    "cubic": cv2.INTER_CUBIC,
+    "linear": cv2.INTER_LINEAR,
+    "nearest": cv2.INTER_NEAREST,
+}
+
+
+class DisplayTransform:
+    # Maps received frames to the display: horizontal flip, centre crop to the
+    # display aspect ratio, scaling to the display size and rotation about the
+    # display centre. The geometry is worked out once per received frame size.
+    # Flip, crop and rotation are folded into one affine map and applied at the
+    # received resolution, which is much smaller than the display, and a single
+    # resize then writes the display-sized image into a reused buffer. Without
+    # rotation the output is identical to flipping, cropping and resizing each
+    # frame. The returned array is reused for the next frame.
+    def __init__(
+        self, width, height, flip=True, crop=False, rotate=0, interpolation="cubic"
+    ):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f"Unknown display interpolation: {interpolation}")
+        self.width = width
+        self.height = height
+        self.flip = flip
+        self.crop = crop
+        self.rotate = rotate
+        self.interpolation = INTERPOLATIONS[interpolation]
+        self._shape = None
+        self._window = None
+        self._matrix = None
+        self._source = None
+        self._output = np.empty((height, width, 3), np.uint8)
+
+    def __call__(self, image):
+        if image.shape != self._shape:
+            self._build(image.shape)
+        y0, y1, x0, x1 = self._window
+        source = image[y0:y1, x0:x1]
+        if self._matrix is not None:
+            source = cv2.warpAffine(
+                source,
+                self._matrix,
+                (x1 - x0, y1 - y0),
+                dst=self._source,
+                flags=cv2.INTER_LINEAR,
+            )
+        elif self.flip:
+            source = cv2.flip(source, 1, dst=self._source)
+        return cv2.resize(
+            source,
+            (self.width, self.height),
+            dst=self._output,
+            interpolation=self.interpolation,
+        )
+
+    def min_scale(self, width, height):
+        # Smallest fraction of a width x height frame that still gives at least
+        # one source pixel per display pixel, for decoders that can downscale
+        if not width or not height:
+            return 1.0
+        y0, y1, x0, x1 = self._crop_window(height, width)
+        return min(1.0, max(self.width / (x1 - x0), self.height / (y1 - y0)))
+
+    def _crop_window(self, h, w):
+        # Centre crop of the flipped frame, expressed in unflipped columns
+        y0, y1, x0, x1 = 0, h, 0, w
+        if self.crop:
+            aspect_ratio = self.width / self.height
+            if w / h > aspect_ratio:
+                crop_width = int(h * aspect_ratio)
+                offset = (w - crop_width) // 2
+                x0, x1 = offset, offset + crop_width
+                if self.flip:
+                    x0, x1 = w - offset - crop_width, w - offset
+            else:
+                crop_height = int(w / aspect_ratio)
+                offset = (h - crop_height) // 2
+                y0, y1 = offset, offset + crop_height
+        return y0, y1, x0, x1
+
+    def _build(self, shape):
+        h, w = shape[:2]
+        self._shape = shape
+        y0, y1, x0, x1 = self._crop_window(h, w)
+        self._window = (y0, y1, x0, x1)
+        crop_h, crop_w = y1 - y0, x1 - x0
+        self._source = np.empty((crop_h, crop_w) + shape[2:], np.uint8)
+
+        if self.rotate % 360 == 0:
+            self._matrix = None
+            return
+
+        # Rotation about the display centre, carried back to the crop's
+        # resolution: scale up, rotate, scale down, after the flip
+        scale = np.diag([self.width / crop_w, self.height / crop_h, 1.0])
+        rotation = np.vstack(
+            [
+                cv2.getRotationMatrix2D(
+                    (self.width / 2, self.height / 2), self.rotate, 1.0
+                ),
+                [0, 0, 1],
+            ]
+        )
+        flip = np.eye(3)
+        if self.flip:
+            flip = np.array([[-1.0, 0, crop_w - 1], [0, 1, 0], [0, 0, 1]])
+        self._matrix = (np.linalg.inv(scale) @ rotation @ scale @ flip)[:2]
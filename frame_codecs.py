@@ -0,0 +1,186 @@
+import cv2
+import numpy as np
+import protocol
+
+try:
+    from turbojpeg import TJPF_BGR, TJSAMP_420, TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+# Image codecs for frames on the wire. Both ends agree on one codec at connect
+# time; every enveloped message still names its own codec, so decoding always
+# follows the message. A codec:
+#   encode(image_bgr, quality) -> bytes-like, or None on failure
+#   decode(data, width=0, height=0, min_scale=1.0) -> BGR image, or None.
+#       width and height are the encoded size from the envelope. JPEG codecs
+#       may decode at 1/2, 1/4 or 1/8 size in the DCT domain as long as the
+#       result keeps at least min_scale of the full size
+
+
+def _reduction(min_scale, factors=(8, 4, 2)):
+    # Largest supported reduction that keeps at least min_scale
+    for factor in factors:
+        if 1 / factor >= min_scale:
+            return factor
+    return 1
+
+
+class JpegCodec:
+    name = "jpeg"
+    id = protocol.CODEC_JPEG
+    # IMREAD_REDUCED_* flags make libjpeg scale during decoding
+    REDUCED = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def encode(self, image, quality=90):
+        result, encoded = cv2.imencode(
+            ".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        )
+        return encoded.data if result else None
+
+    def decode(self, data, width=0, height=0, min_scale=1.0):
+        flags = self.REDUCED[_reduction(min_scale)]
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+
+class TurboJpegCodec:
+    # libjpeg-turbo through PyTurboJPEG (optional, see requirements.txt; the
+    # Docker image installs libturbojpeg). One TurboJPEG instance per codec
+    # loads the library once; PyTurboJPEG still opens a compress/decompress
+    # handle per call, which keeps the codec safe to share between worker
+    # threads. Same wire format and 4:2:0 subsampling as JpegCodec.
+    name = "jpeg"
+    id = protocol.CODEC_JPEG
+
+    def __init__(self):
+        if TurboJPEG is None:
+            raise ImportError("PyTurboJPEG is not installed")
+        self._jpeg = TurboJPEG()
+        self._factors = tuple(
+            sorted(
+                (d for n, d in self._jpeg.scaling_factors if n == 1 and d in (2, 4, 8)),
+                reverse=True,
+            )
+        )
+
+    def encode(self, image, quality=90):
+        return self._jpeg.encode(
+            image, quality=quality, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420
+        )
+
+    def decode(self, data, width=0, height=0, min_scale=1.0):
+        factor = _reduction(min_scale, self._factors)
+        try:
+            return self._jpeg.decode(
+                bytes(data), pixel_format=TJPF_BGR, scaling_factor=(1, factor)
+            )
+        except OSError:
+            return None
+
+
+class WebpCodec:
+    name = "webp"
+    id = protocol.CODEC_WEBP
+
+    def encode(self, image, quality=90):
+        result, encoded = cv2.imencode(
+            ".webp", image, [int(cv2.IMWRITE_WEBP_QUALITY), quality]
+        )
+        return encoded.data if result else None
+
+    def decode(self, data, width=0, height=0, min_scale=1.0):
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class PngCodec:
+    # Lossless; quality is ignored and the fastest compression level is used
+    name = "png"
+    id = protocol.CODEC_PNG
+
+    def encode(self, image, quality=90):
+        result, encoded = cv2.imencode(".png", image, [int(cv2.IMWRITE_PNG_COMPRESSION), 1])
+        return encoded.data if result else None
+
+    def decode(self, data, width=0, height=0, min_scale=1.0):
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class RawCodec:
+    # Uncompressed BGR pixels, sized by the envelope; for localhost links
+    name = "raw"
+    id = protocol.CODEC_RAW
+
+    def encode(self, image, quality=90):
+        return image.tobytes()
+
+    def decode(self, data, width=0, height=0, min_scale=1.0):
+        if len(data) != width * height * 3:
+            return None
+        return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+
+
+CODECS = {
+    "jpeg": JpegCodec,
+    "webp": WebpCodec,
+    "png": PngCodec,
+    "raw": RawCodec,
+}
+
+
+def available_codecs():
+    names = ["jpeg", "raw"]
+    for name, extension in (("webp", ".webp"), ("png", ".png")):
+        if cv2.haveImageWriter(extension):
+            names.insert(-1, name)
+    return names
+
+
+def get_codec(name, turbo=True):
+    # JPEG goes through libjpeg-turbo when PyTurboJPEG and the library are there
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec: {name}")
+    if name == "jpeg" and turbo and TurboJPEG is not None:
+        try:
+            return TurboJpegCodec()
+        except (ImportError, OSError, RuntimeError) as e:
+            print(f"Falling back to OpenCV JPEG: {e}")
+    return CODECS[name]()
+
+
+def negotiate(requested, supported=None):
+    # First codec in the client's preference order that this end supports
+    if supported is None:
+        supported = available_codecs()
+    for name in requested:
+        if name in supported:
+            return name
+    return "jpeg"
+
+
+class CodecSet:
+    # One instance of each codec, created on first use and looked up by name or
+    # by the id in a message envelope
+    def __init__(self, turbo=True):
+        self.turbo = turbo
+        self._by_name = {}
+        self._by_id = {}
+
+    def get(self, name):
+        codec = self._by_name.get(name)
+        if codec is None:
+            codec = self._by_name[name] = get_codec(name, self.turbo)
+            self._by_id[codec.id] = codec
+        return codec
+
+    def by_id(self, codec_id):
+        codec = self._by_id.get(codec_id)
+        if codec is not None:
+            return codec
+        for name, cls in CODECS.items():
+            if cls.id == codec_id:
+                return self.get(name)
+        raise ValueError(f"Unknown codec id: {codec_id}")
@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import time
+from tracing import span
+
+
+class DropFrame(Exception):
+    # Raised by a stage function to discard a frame without sending anything back
+    pass
+
+
+class Frame:
+    def __init__(self, seq, data):
+        self.seq = seq
+        self.data = data
+        self.received_at = time.time()
+        self.timings = {}
+        # Full-frame host copies made while processing, as reported by stages
+        self.copies = 0
+        self.error = None
+        self.dropped = False
+        # The backend skipped inference and the previous output stands
+        self.reused = False
+        # Protocol envelope the frame arrived in, None for raw JPEG messages
+        self.envelope = None
+        self.width = 0
+        self.height = 0
+        # Codec id of the encoded result
+        self.codec = 0
+        # Left as an image for the sink to encode as tiles, in order
+        self.tiled = False
+        # Trace spans, a list only while tracing
+        self.spans = None
+
+    def record(self, name, t_start):
+        # Stage time since t_start, plus a trace span when tracing
+        t_end = time.time()
+        self.timings[name] = t_end - t_start
+        if self.spans is not None:
+            self.spans.append(span(name, t_start, t_end))
+
+    def add_span(self, name, start, end, track=None):
+        if self.spans is not None:
+            self.spans.append(span(name, start, end, track))
+
+
+class Stage:
+    # With busy_key, the stage counts frame.timings[busy_key] as busy time instead
+    # of the whole call, for stages that mostly wait on shared work
+    def __init__(self, name, fn, executor, workers=1, busy_key=None):
+        self.name = name
+        self.fn = fn
+        self.executor = executor
+        self.workers = workers
+        self.busy_key = busy_key
+        self.busy_time = 0.0
+        self.frames = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, frame):
+        t_start = time.time()
+        try:
+            return self.fn(frame)
+        finally:
+            elapsed = time.time() - t_start
+            if self.busy_key is not None:
+                elapsed = frame.timings.get(self.busy_key, 0.0)
+            with self._lock:
+                self.busy_time += elapsed
+                self.frames += 1
+
+    def reset_stats(self):
+        with self._lock:
+            self.busy_time = 0.0
+            self.frames = 0
+
+
+class FramePipeline:
+    # Runs frames through a chain of executor-backed stages connected by bounded
+    # queues. Each queue holds futures in submission order, so a stage with several
+    # workers processes frames concurrently while downstream stages still see them
+    # in order. The sink coroutine runs on the event loop (e.g. websocket send);
+    # frames a stage dropped go to the optional on_drop coroutine instead. A frame
+    # the sink or on_drop fails on is logged and lost; the frames behind it still
+    # go out.
+    def __init__(self, stages, sink, queue_size=2, on_drop=None):
+        self.stages = stages
+        self.sink = sink
+        self.on_drop = on_drop
+        self.queue_size = queue_size
+        self.sink_time = 0.0
+        self.stats_start = time.time()
+        self.frames_out = 0
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self._tasks = []
+
+    def start(self):
+        for stage, in_queue, out_queue in zip(
+            self.stages, self._queues[:-1], self._queues[1:]
+        ):
+            self._tasks.append(
+                asyncio.ensure_future(self._run_stage(stage, in_queue, out_queue))
+            )
+        self._tasks.append(asyncio.ensure_future(self._run_sink(self._queues[-1])))
+        return self
+
+    async def submit(self, frame):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(frame)
+        await self._queues[0].put(future)
+
+    async def close(self):
+        await self._queues[0].put(None)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _run_stage(self, stage, in_queue, out_queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await in_queue.get()
+            if pending is None:
+                await out_queue.put(None)
+                return
+
+            frame = await pending
+            if frame.error is not None or frame.dropped:
+                await out_queue.put(pending)
+                continue
+
+            await out_queue.put(loop.run_in_executor(stage.executor, self._call, stage, frame))
+
+    def _call(self, stage, frame):
+        try:
+            stage(frame)
+        except DropFrame as e:
+            print(e)
+            frame.dropped = True
+        except Exception as e:
+            frame.error = e
+        return frame
+
+    async def _run_sink(self, in_queue):
+        while True:
+            pending = await in_queue.get()
+            if pending is None:
+                return
+
+            frame = await pending
+            try:
+                if frame.dropped:
+                    if self.on_drop is not None:
+                        await self.on_drop(frame)
+                    continue
+
+                t_start = time.time()
+                await self.sink(frame)
+            except Exception as e:
+                print(f"Failed to answer frame {frame.seq}: {e}")
+                continue
+            self.sink_time += time.time() - t_start
+            self.frames_out += 1
+
+    def stats(self):
+        elapsed = max(time.time() - self.stats_start, 1e-9)
+        stats = {}
+        for stage in self.stages:
+            stats[stage.name] = {
+                "busy": stage.busy_time,
+                "utilization": stage.busy_time / (elapsed * stage.workers),
+            }
+        stats["send"] = {
+            "busy": self.sink_time,
+            "utilization": self.sink_time / elapsed,
+        }
+        return {
+            "elapsed": elapsed,
+            "frames": self.frames_out,
+            "fps": self.frames_out / elapsed,
+            "stages": stats,
+            "bottleneck": max(stats, key=lambda name: stats[name]["utilization"]),
+        }
+
+    def reset_stats(self):
+        for stage in self.stages:
+            stage.reset_stats()
+        self.sink_time = 0.0
+        self.frames_out = 0
+        self.stats_start = time.time()
+
+
+class LatestFrameSlot:
+    # Single-slot mailbox: putting a frame while one is already waiting replaces
+    # it, so a slow consumer only ever sees the newest frame. put() returns the
+    # frame it replaced, if any
+    def __init__(self):
+        self.dropped = 0
+        self._frame = None
+        self._event = asyncio.Event()
+
+    def put(self, frame):
+        replaced = self._frame
+        if replaced is not None:
+            self.dropped += 1
+        self._frame = frame
+        self._event.set()
+        return replaced
+
+    async def get(self):
+        while self._frame is None:
+            self._event.clear()
+            await self._event.wait()
+        frame, self._frame = self._frame, None
+        return frame
@@ -0,0 +1,70 @@
+import time
+from collections import deque
+
+
+class InFlightWindow:
+    # Tracks frames sent to the server but not answered yet. At most
+    # max_in_flight frames hold a slot; a frame unanswered after `timeout`
+    # seconds gives its slot back but stays in the window, so a late response
+    # is still attributed to the frame it belongs to. The server answers frames
+    # in the order they were sent, so raw responses are matched first in, first
+    # out; enveloped responses carry the sequence number they answer.
+    def __init__(self, max_in_flight=2, timeout=1.0):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.next_seq = 0
+        self.in_flight = 0
+        self.expired = 0
+        self.late = 0
+        self._pending = deque()  # [seq, sent_at, expired]
+
+    def has_room(self):
+        self.expire()
+        return self.in_flight < self.max_in_flight
+
+    def sent(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        self._pending.append([seq, time.time(), False])
+        self.in_flight += 1
+        return seq
+
+    def expire(self):
+        now = time.time()
+        for entry in self._pending:
+            if not entry[2] and now - entry[1] > self.timeout:
+                entry[2] = True
+                self.in_flight -= 1
+                self.expired += 1
+        # Frames the server never answers (e.g. dropped) eventually leave the window
+        while self._pending and self._pending[0][2] and now - self._pending[0][1] > 10 * self.timeout:
+            self._pending.popleft()
+
+    def time_to_expiry(self):
+        # Seconds until the oldest frame holding a slot times out
+        for entry in self._pending:
+            if not entry[2]:
+                return max(0.0, entry[1] + self.timeout - time.time())
+        return self.timeout
+
+    def match(self, seq=None):
+        # Returns (seq, round trip time, was_late), or None if nothing matches.
+        # Frames sent before `seq` that are still pending were skipped by the
+        # server and leave the window.
+        if seq is not None:
+            while self._pending and self._pending[0][0] < seq:
+                entry = self._pending.popleft()
+                if not entry[2]:
+                    entry[2] = True
+                    self.in_flight -= 1
+                    self.expired += 1
+            if not self._pending or self._pending[0][0] != seq:
+                return None
+        if not self._pending:
+            return None
+        entry = self._pending.popleft()
+        if entry[2]:
+            self.late += 1
+        else:
+            self.in_flight -= 1
+        return entry[0], time.time() - entry[1], entry[2]
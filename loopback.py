@@ -0,0 +1,49 @@
+import asyncio
+import protocol
+
+
+class LoopbackConnection:
+    # Stands in for a websocket so frames reach a connection handler such as
+    # process_image without a socket: warmup, the replay benchmark, the
+    # router's workers and tests
+    def __init__(self):
+        self.inbound = asyncio.Queue()
+        self.outbound = asyncio.Queue()
+
+    # Server side
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.inbound.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def send(self, message):
+        await self.outbound.put(message)
+
+    # Client side
+    def client(self):
+        return LoopbackClient(self)
+
+
+class LoopbackClient:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def send(self, message):
+        await self.connection.inbound.put(message)
+
+    async def recv(self):
+        return await self.connection.outbound.get()
+
+    async def recv_frame(self):
+        # Skips JSON replies such as the protocol answer
+        while True:
+            message = await self.recv()
+            if isinstance(message, bytes):
+                return protocol.unpack(message)
+
+    async def close(self):
+        await self.connection.inbound.put(None)
@@ -0,0 +1,283 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, shared by every stage so they can be compared
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    # A named metric with one child per combination of label values. Children
+    # are created on first use and can be removed, e.g. when a connection
+    # closes, so per-connection series don't pile up.
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def remove(self, label, value):
+        # Drops every child whose label has this value
+        index = self.label_names.index(label)
+        with self._lock:
+            for key in [key for key in self._children if key[index] == str(value)]:
+                del self._children[key]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in sorted(children):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, label_names, values):
+        return [f"{name}{_label_text(label_names, values)} {self.value:g}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bound plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name, label_names, values):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        names = label_names + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.bounds + (float("inf"),), counts):
+            cumulative += bucket
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f"{name}_bucket{_label_text(names, values + (le,))} {cumulative}")
+        labels = _label_text(label_names, values)
+        lines.append(f"{name}_sum{labels} {total:g}")
+        lines.append(f"{name}_count{labels} {count}")
+        return lines
+
+
+class Histogram(_Metric):
+    # Fixed buckets: observing is a binary search and three additions
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Replaces the file atomically, e.g. for node_exporter's textfile
+        # collector
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+class ServerMetrics:
+    # Stage latencies and frame outcomes, for the whole server and per
+    # connection. Per-connection series are dropped when the connection closes.
+    def __init__(self, registry):
+        self.registry = registry
+        self.stage_seconds = registry.histogram(
+            "pablonet_stage_seconds", "Time frames spent in each server stage", ("stage",)
+        )
+        self.connection_stage_seconds = registry.histogram(
+            "pablonet_connection_stage_seconds",
+            "Time frames spent in each server stage, per connection",
+            ("connection", "stage"),
+        )
+        self.frames = registry.counter(
+            "pablonet_frames_total", "Frames by outcome", ("outcome",)
+        )
+        self.connection_frames = registry.counter(
+            "pablonet_connection_frames_total",
+            "Frames by outcome, per connection",
+            ("connection", "outcome"),
+        )
+        self.connections = registry.gauge("pablonet_connections", "Open connections")
+        self.connections.labels().set(0)
+
+    def observe(self, connection, timings):
+        for stage, seconds in timings.items():
+            self.stage_seconds.labels(stage).observe(seconds)
+            self.connection_stage_seconds.labels(connection, stage).observe(seconds)
+
+    def count(self, connection, outcome):
+        self.frames.labels(outcome).inc()
+        self.connection_frames.labels(connection, outcome).inc()
+
+    def opened(self, connection):
+        self.connections.labels().inc()
+
+    def closed(self, connection):
+        self.connections.labels().inc(-1)
+        self.connection_stage_seconds.remove("connection", connection)
+        self.connection_frames.remove("connection", connection)
+
+
+class ClientMetrics:
+    # Client stage latencies and frame outcomes, written to `path` every
+    # `interval` seconds when a path is given
+    def __init__(self, path=None, interval=10.0):
+        self.registry = MetricsRegistry()
+        self.path = path
+        self.interval = interval
+        self.stage_seconds = self.registry.histogram(
+            "pablonet_client_stage_seconds",
+            "Time frames spent in each client stage",
+            ("stage",),
+        )
+        self.frames = self.registry.counter(
+            "pablonet_client_frames_total", "Frames by outcome", ("outcome",)
+        )
+        self._written_at = time.time()
+
+    def observe(self, timings):
+        for stage, seconds in timings.items():
+            self.stage_seconds.labels(stage).observe(seconds)
+
+    def count(self, outcome, amount=1):
+        self.frames.labels(outcome).inc(amount)
+
+    def maybe_write(self, force=False):
+        if self.path is None:
+            return
+        if force or time.time() - self._written_at >= self.interval:
+            self.registry.write(self.path)
+            self._written_at = time.time()
+
+
+def start_http_server(port, host="0.0.0.0", routes=None):
+    # Serves GET requests from a daemon thread. routes maps a path to a
+    # function returning (status, content type, body)
+    routes = dict(routes or {})
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            route = routes.get(self.path.split("?", 1)[0])
+            if route is None:
+                self.send_error(404)
+                return
+            status, content_type, body = route()
+            body = body.encode("utf-8") if isinstance(body, str) else body
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+    return server
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Part of every snapshot key, bumped when the snapshot layout changes
+SNAPSHOT_VERSION = 1
+
+
+def _key(parts):
+    data = json.dumps(parts, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class ModelCache:
+    # Fully fused pipelines and the TensorRT engines built from them, under one
+    # directory so both live on the same persistent volume:
+    #   snapshots/<key>/  a saved pipeline with every LoRA fused in, plus the
+    #                     tiny VAE, keyed by the hashes of what went into it
+    #   <key>/            engines for one snapshot at one set of shapes
+    #   manifest.json     what each engine directory was built for
+    #   hashes.json       file hashes, reused while size and mtime match
+    def __init__(self, root):
+        self.root = root
+        self.snapshots_dir = os.path.join(root, "snapshots")
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        self._hashes_path = os.path.join(root, "hashes.json")
+        self._hashes = _read_json(self._hashes_path)
+
+    def fingerprint(self, path):
+        # Local files and directories are hashed by content; anything else is
+        # a hub id and keyed by name, so pass a local path to pin a revision
+        if path is None:
+            return None
+        if not os.path.exists(path):
+            return f"hub:{path}"
+        if os.path.isfile(path):
+            files = [(os.path.basename(path), path)]
+        else:
+            files = []
+            for directory, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                for name in sorted(names):
+                    if not name.startswith("."):
+                        file_path = os.path.join(directory, name)
+                        files.append((os.path.relpath(file_path, path), file_path))
+        digest = hashlib.sha256()
+        for name, file_path in files:
+            digest.update(name.encode("utf-8") + b"\0")
+            digest.update(self._file_hash(file_path).encode("utf-8"))
+        _write_json(self._hashes_path, self._hashes)
+        return digest.hexdigest()
+
+    def _file_hash(self, path):
+        stat = os.stat(path)
+        real_path = os.path.realpath(path)
+        known = self._hashes.get(real_path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        if known and (known["size"], known["mtime"]) == version:
+            return known["sha256"]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        self._hashes[real_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": digest.hexdigest(),
+        }
+        return digest.hexdigest()
+
+    def snapshot_key(self, **parts):
+        return _key(dict(parts, version=SNAPSHOT_VERSION))
+
+    def snapshot(self, key):
+        # Path of a complete snapshot, or None
+        path = os.path.join(self.snapshots_dir, key)
+        if os.path.exists(os.path.join(path, "snapshot.json")):
+            return path
+        return None
+
+    def save_snapshot(self, key, save, info):
+        # save(directory) writes the snapshot into a temporary directory that
+        # is renamed into place once complete, so an interrupted save or a
+        # concurrent one never leaves a partial snapshot behind
+        path = os.path.join(self.snapshots_dir, key)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            save(tmp_path)
+            _write_json(
+                os.path.join(tmp_path, "snapshot.json"),
+                dict(info, key=key, created=time.time()),
+            )
+            if self.snapshot(key) is None:
+                shutil.rmtree(path, ignore_errors=True)
+                os.replace(tmp_path, path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return path
+
+    def engine_dir(self, snapshot_key, **shape):
+        # Engines depend on the fused weights and on the shapes, batch size
+        # and GPU they were built for; each combination gets a directory
+        key = _key(dict(shape, snapshot=snapshot_key))
+        manifest_path = os.path.join(self.root, "manifest.json")
+        manifest = _read_json(manifest_path)
+        if key not in manifest:
+            manifest[key] = dict(shape, snapshot=snapshot_key, created=time.time())
+            _write_json(manifest_path, manifest)
+        return os.path.join(self.root, key)
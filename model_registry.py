@@ -0,0 +1,148 @@
+import gc
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def load_styles(path):
+    # A JSON object mapping style names to load_backend arguments, e.g.
+    #   {"anime": {"lora_path": "loras/anime.safetensors", "lora_scale": 0.8}}
+    # Missing arguments come from the server's command line
+    with open(path) as f:
+        styles = json.load(f)
+    if not isinstance(styles, dict) or not all(
+        isinstance(style, dict) for style in styles.values()
+    ):
+        raise ValueError(f"{path} must map style names to objects")
+    return styles
+
+
+class LoadedModel:
+    def __init__(self, name, backend, memory_bytes=0):
+        self.name = name
+        self.backend = backend
+        self.memory_bytes = memory_bytes
+        # Connections currently using it; models in use are never evicted
+        self.users = 0
+
+
+class ModelRegistry:
+    # Named styles, each a base model plus a LoRA at a scale, loaded on demand
+    # by load(**style) on a background thread so connections keep streaming
+    # with their current style meanwhile. Loaded models are kept in an LRU
+    # bounded by memory_budget bytes: before a load, unused models are evicted
+    # until the new one should fit. Models in use by a connection and the
+    # default model stay, even if that means going over budget.
+    def __init__(self, styles, load, memory_budget=None, default="default"):
+        self.styles = styles
+        self.load = load
+        self.memory_budget = memory_budget
+        self.default = default
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self._models = OrderedDict()
+        self._loading = {}
+        # Sizes of styles loaded before, to make room before loading again
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="model-load")
+
+    def names(self):
+        return [self.default] + [name for name in self.styles if name != self.default]
+
+    def add(self, name, backend):
+        # Registers an already loaded model, e.g. the default one
+        model = LoadedModel(name, backend, getattr(backend, "memory_bytes", 0))
+        with self._lock:
+            self._models[name] = model
+            self._sizes[name] = model.memory_bytes
+        return model
+
+    def request(self, name):
+        # Future of the LoadedModel for a style, loading it in the background
+        # if needed. Pass the result to acquire() before using it.
+        with self._lock:
+            model = self._models.get(name)
+            if model is not None:
+                self._models.move_to_end(name)
+                self.hits += 1
+                future = Future()
+                future.set_result(model)
+                return future
+            if name in self._loading:
+                return self._loading[name]
+            if name not in self.styles:
+                raise KeyError(f"Unknown style: {name}")
+            future = self._loading[name] = self._executor.submit(self._load, name)
+            return future
+
+    def acquire(self, model):
+        with self._lock:
+            model.users += 1
+            if self._models.get(model.name) is not model:
+                # Evicted between loading and use; it's back in the LRU now
+                self._models[model.name] = model
+            self._models.move_to_end(model.name)
+
+    def release(self, model):
+        if model is None:
+            return
+        with self._lock:
+            model.users -= 1
+
+    def _load(self, name):
+        try:
+            self._make_room(self._sizes.get(name, max(self._sizes.values(), default=0)))
+            t_start = time.time()
+            backend = self.load(**self.styles[name])
+            model = LoadedModel(name, backend, getattr(backend, "memory_bytes", 0))
+            print(
+                f"Style {name} loaded in {time.time() - t_start:.4f}s "
+                f"({model.memory_bytes / 2**30:.2f} GiB)"
+            )
+            with self._lock:
+                self._models[name] = model
+                self._sizes[name] = model.memory_bytes
+                self.loads += 1
+            return model
+        finally:
+            with self._lock:
+                del self._loading[name]
+
+    def _make_room(self, needed):
+        if self.memory_budget is None:
+            return
+        evicted = []
+        with self._lock:
+            for name, model in list(self._models.items()):
+                if self._used() + needed <= self.memory_budget:
+                    break
+                if model.users == 0 and name != self.default:
+                    evicted.append(self._models.pop(name))
+                    self.evictions += 1
+        for model in evicted:
+            print(f"Evicted style {model.name} ({model.memory_bytes / 2**30:.2f} GiB)")
+        if evicted:
+            # Frames still running on an evicted model keep it alive; the
+            # memory goes back once they finish
+            release = getattr(type(evicted[0].backend), "release_cached_memory", None)
+            evicted.clear()
+            gc.collect()
+            if release is not None:
+                release()
+
+    def _used(self):
+        return sum(model.memory_bytes for model in self._models.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": list(self._models),
+                "memory_gib": round(self._used() / 2**30, 2),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
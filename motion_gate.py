@@ -0,0 +1,52 @@
+import time
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    # Decides on the client whether a frame differs enough from the last one
+    # sent to be worth sending. Frames are compared as size x size luma
+    # thumbnails (area downsampling averages out sensor noise) by their mean
+    # absolute difference, as a fraction of full scale. The reference is the
+    # last frame that went out, so slow drift still adds up to a send. A frame
+    # is always sent once refresh_interval seconds have passed since the last
+    # one, which keeps the server's output and the client's timeouts alive.
+    def __init__(self, threshold=0.02, refresh_interval=1.0, size=32):
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self.size = size
+        self.checked = 0
+        self.suppressed = 0
+        self.difference = 0.0
+        self._reference = None
+        self._sent_at = 0.0
+        self._thumbnail = np.empty((size, size, 3), np.uint8)
+        self._luma = np.empty((size, size), np.uint8)
+
+    def __call__(self, frame):
+        # True if the frame should be sent; it then becomes the reference
+        self.checked += 1
+        thumbnail = cv2.resize(
+            frame, (self.size, self.size), dst=self._thumbnail, interpolation=cv2.INTER_AREA
+        )
+        luma = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY, dst=self._luma)
+        now = time.time()
+        if self._reference is not None:
+            self.difference = cv2.norm(luma, self._reference, cv2.NORM_L1) / (
+                luma.size * 255.0
+            )
+            if (
+                self.difference < self.threshold
+                and now - self._sent_at < self.refresh_interval
+            ):
+                self.suppressed += 1
+                return False
+            self._reference[:] = luma
+        else:
+            self._reference = luma.copy()
+        self._sent_at = now
+        return True
+
+    @property
+    def suppressed_ratio(self):
+        return self.suppressed / self.checked if self.checked else 0.0
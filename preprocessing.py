@@ -0,0 +1,163 @@
+import threading
+import cv2
+import numpy as np
+
+# Preprocessing operators, chained from a spec such as "blur:3,canny,tint".
+# Each registered factory takes the operator's ":"-separated arguments and
+# returns op(img, source, buffers) -> img, where `source` is the decoded frame
+# and `buffers` is scratch space private to the op and the calling thread.
+# Ops write into scratch buffers instead of allocating, so the returned image
+# is only valid until the same thread preprocesses its next frame.
+OPERATORS = {}
+
+
+def register(name):
+    def decorator(factory):
+        OPERATORS[name] = factory
+        return factory
+
+    return decorator
+
+
+def scratch(buffers, name, shape, dtype=np.uint8):
+    key = (name, shape)
+    buffer = buffers.get(key)
+    if buffer is None:
+        buffer = buffers[key] = np.empty(shape, dtype=dtype)
+    return buffer
+
+
+def _gray_shape(img):
+    return img.shape[:2]
+
+
+@register("blur")
+def blur(ksize=5):
+    ksize = int(ksize)
+
+    def op(img, source, buffers):
+        out = scratch(buffers, "out", img.shape)
+        return cv2.GaussianBlur(img, (ksize, ksize), 0, dst=out)
+
+    return op
+
+
+@register("canny")
+def canny(low=100, high=200):
+    low, high = float(low), float(high)
+
+    def op(img, source, buffers):
+        edges = scratch(buffers, "edges", _gray_shape(img))
+        out = scratch(buffers, "out", img.shape)
+        cv2.Canny(img, low, high, edges=edges)
+        return cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR, dst=out)
+
+    return op
+
+
+@register("tint")
+def tint(alpha=0.2, b=255, g=0, r=0):
+    # Paints black pixels of the current image with a colour and blends the
+    # result over the decoded frame
+    alpha = float(alpha)
+    color = (int(b), int(g), int(r))
+
+    def op(img, source, buffers):
+        mask = scratch(buffers, "mask", _gray_shape(img))
+        tinted = scratch(buffers, "tinted", img.shape)
+        out = scratch(buffers, "out", img.shape)
+        cv2.inRange(img, (0, 0, 0), (0, 0, 0), dst=mask)
+        np.copyto(tinted, img)
+        # Masked pixels are all zero, so OR-ing the colour writes it exactly
+        cv2.bitwise_or(tinted, color, dst=tinted, mask=mask)
+        return cv2.addWeighted(source, 1 - alpha, tinted, alpha, 0, dst=out)
+
+    return op
+
+
+@register("canny_blur_shift")
+def canny_blur_shift():
+    # Fused "blur:3,canny,tint": Canny only outputs 0 or 255, so the tinted
+    # edge image is 255 in the blue channel and the edge map in the others
+    def op(img, source, buffers):
+        blurred = scratch(buffers, "blurred", img.shape)
+        edges = scratch(buffers, "edges", _gray_shape(img))
+        tinted = scratch(buffers, "tinted", img.shape)
+        out = scratch(buffers, "out", img.shape)
+        cv2.GaussianBlur(img, (3, 3), 0, dst=blurred)
+        cv2.Canny(blurred, 100, 200, edges=edges)
+        cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR, dst=tinted)
+        tinted[:, :, 0] = 255
+        return cv2.addWeighted(img, 0.8, tinted, 0.2, 0, dst=out)
+
+    return op
+
+
+@register("gray")
+def gray():
+    def op(img, source, buffers):
+        gray_img = scratch(buffers, "gray", _gray_shape(img))
+        out = scratch(buffers, "out", img.shape)
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray_img)
+        return cv2.cvtColor(gray_img, cv2.COLOR_GRAY2BGR, dst=out)
+
+    return op
+
+
+@register("contrast")
+def contrast(clip_limit=2.0, tile_size=8):
+    clip_limit, tile_size = float(clip_limit), int(tile_size)
+
+    def op(img, source, buffers):
+        # CLAHE objects are not thread-safe, so each thread gets its own
+        clahe = buffers.get("clahe")
+        if clahe is None:
+            clahe = buffers["clahe"] = cv2.createCLAHE(
+                clipLimit=clip_limit, tileGridSize=(tile_size, tile_size)
+            )
+        gray_img = scratch(buffers, "gray", _gray_shape(img))
+        equalized = scratch(buffers, "equalized", _gray_shape(img))
+        out = scratch(buffers, "out", img.shape)
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray_img)
+        clahe.apply(gray_img, dst=equalized)
+        return cv2.cvtColor(equalized, cv2.COLOR_GRAY2BGR, dst=out)
+
+    return op
+
+
+def parse_spec(spec):
+    # Accepts "blur,canny,tint" or, as fire parses it, ("blur", "canny", "tint")
+    if spec is None:
+        return []
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    ops = []
+    for item in spec:
+        name, *args = str(item).strip().split(":")
+        if not name:
+            continue
+        if name not in OPERATORS:
+            raise ValueError(
+                f"Unknown preprocessing operator: {name} "
+                f"(available: {', '.join(sorted(OPERATORS))})"
+            )
+        ops.append(OPERATORS[name](*args))
+    return ops
+
+
+class Preprocessor:
+    def __init__(self, spec=None):
+        self.spec = spec
+        self.ops = parse_spec(spec)
+        self._local = threading.local()
+
+    def __call__(self, img):
+        if not self.ops:
+            return img
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = [{} for _ in self.ops]
+        source = img
+        for op, op_buffers in zip(self.ops, buffers):
+            img = op(img, source, op_buffers)
+        return img
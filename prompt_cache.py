@@ -0,0 +1,140 @@
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def clone_state(state):
+    # Tensors are cloned, other values (e.g. a similar-image filter) copied,
+    # so states made from one cache entry never share anything they update
+    return {
+        attr: value.clone() if hasattr(value, "clone") else copy.copy(value)
+        for attr, value in state.items()
+    }
+
+
+class PromptCache:
+    # LRU cache of prepared conditioning state keyed by
+    # (prompt, negative_prompt, guidance_scale, num_inference_steps). With a
+    # cache_dir, entries are also written to disk and reloaded on a memory miss,
+    # so they survive restarts. Disk entries are torch files; without torch
+    # the cache stays in memory.
+    def __init__(self, max_entries=32, cache_dir=None, max_disk_entries=256, map_location=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.map_location = map_location
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._torch = None
+        if cache_dir is not None:
+            try:
+                import torch
+            except ImportError:
+                print(
+                    f"Prompt cache: torch is not installed, "
+                    f"not persisting entries to {cache_dir}"
+                )
+                self.cache_dir = None
+            else:
+                self._torch = torch
+                os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        entry = self._load(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._insert(key, entry)
+        self._save(key, entry)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.pt")
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            saved = self._torch.load(path, map_location=self.map_location)
+        except Exception as e:
+            print(f"Failed to load cached prompt {path}: {e}")
+            return None
+        # Hash collisions are practically impossible but the key is cheap to check
+        if saved.get("key") != key:
+            return None
+        os.utime(path)
+        return saved["entry"]
+
+    def _save(self, key, entry):
+        if self.cache_dir is None:
+            return
+
+        # Generators can't be serialized; the stream keeps its current one
+        persistable = {
+            part: {
+                attr: value
+                for attr, value in state.items()
+                if not isinstance(value, self._torch.Generator)
+            }
+            for part, state in entry.items()
+        }
+        path = self._path(key)
+        try:
+            self._torch.save({"key": key, "entry": persistable}, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"Failed to save cached prompt {path}: {e}")
+            return
+        self._prune_disk()
+
+    def _prune_disk(self):
+        paths = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(".pt")
+        ]
+        if len(paths) <= self.max_disk_entries:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[: len(paths) - self.max_disk_entries]:
+            os.remove(path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,109 @@
+import struct
+
+# Binary frame envelope shared by the server and clients. Every binary message
+# starts with this little-endian header, followed by the payload:
+#   magic        2s  b"PN"
+#   version      B
+#   type         B   FRAME, RESULT, ERROR, DROPPED, UNCHANGED or TILES
+#   codec        B   payload codec
+#   flags        B   reserved
+#   width        H   image width, 0 if not an image
+#   height       H   image height, 0 if not an image
+#   seq          I   client sequence number, echoed by the server
+#   capture_ts   d   client capture time (seconds since epoch), echoed
+#   recv_ts      d   server receive time, set on responses
+#   send_ts      d   server send time, set on responses
+# Raw JPEG messages (the original format) never start with the magic, so both
+# can be told apart per message. Clients ask for the envelope by sending
+# "protocol": VERSION in their JSON configuration; the server answers with
+# the version it speaks, and writes that version into its headers.
+# Version 2 adds UNCHANGED; version 1 clients get the previous result again.
+MAGIC = b"PN"
+VERSION = 2
+HEADER = struct.Struct("<2sBBBBHHIddd")
+
+# Message types
+FRAME = 1  # Client frame to process
+RESULT = 2  # Processed frame
+ERROR = 3  # JSON error payload for the frame
+DROPPED = 4  # The server discarded the frame without processing it
+UNCHANGED = 5  # Same output as the previous result, no payload
+TILES = 6  # Changed tiles of the previous result, see tiles.py
+
+# Codecs
+CODEC_NONE = 0
+CODEC_JPEG = 1
+CODEC_WEBP = 2
+CODEC_PNG = 3
+CODEC_RAW = 4  # Uncompressed BGR, width x height x 3 bytes
+
+
+class Envelope:
+    __slots__ = (
+        "version",
+        "type",
+        "codec",
+        "flags",
+        "width",
+        "height",
+        "seq",
+        "capture_ts",
+        "recv_ts",
+        "send_ts",
+        "payload",
+    )
+
+    def __init__(self, fields, payload):
+        (
+            _,
+            self.version,
+            self.type,
+            self.codec,
+            self.flags,
+            self.width,
+            self.height,
+            self.seq,
+            self.capture_ts,
+            self.recv_ts,
+            self.send_ts,
+        ) = fields
+        self.payload = payload
+
+
+def pack(
+    msg_type,
+    payload=b"",
+    seq=0,
+    codec=CODEC_NONE,
+    width=0,
+    height=0,
+    capture_ts=0.0,
+    recv_ts=0.0,
+    send_ts=0.0,
+    flags=0,
+    version=VERSION,
+):
+    header = HEADER.pack(
+        MAGIC,
+        version,
+        msg_type,
+        codec,
+        flags,
+        width,
+        height,
+        seq & 0xFFFFFFFF,
+        capture_ts,
+        recv_ts,
+        send_ts,
+    )
+    return header + payload
+
+
+def unpack(message):
+    # Returns None for messages in the original raw format
+    if len(message) < HEADER.size or message[:2] != MAGIC:
+        return None
+    fields = HEADER.unpack_from(message)
+    if fields[1] > VERSION:
+        raise ValueError(f"Unsupported protocol version {fields[1]}")
+    return Envelope(fields, memoryview(message)[HEADER.size :])
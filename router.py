@@ -0,0 +1,540 @@
+import fire
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+import websockets
+import protocol
+from metrics import start_http_server
+from loopback import LoopbackConnection
+from server import create_server, run_warmup
+
+# Workers are spawned rather than forked so each one initializes CUDA itself
+_context = multiprocessing.get_context("spawn")
+
+
+class SlotPool:
+    # Fixed-size slots in one shared memory block carrying frames one way
+    # between the router and a worker. The writing side hands slots out; the
+    # reading side copies a payload out and gives its slot back with a "free"
+    # message, so only (slot, length) goes through the pipe
+    def __init__(self, slots, slot_size, name=None):
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=name is None, size=slots * slot_size
+        )
+        self.name = self.shm.name
+        self.free = list(range(slots))
+
+    def write(self, data):
+        # Slot now holding data, None when it's too large or all slots are taken
+        data = memoryview(data).cast("B")
+        if data.nbytes > self.slot_size or not self.free:
+            return None
+        slot = self.free.pop()
+        offset = slot * self.slot_size
+        self.shm.buf[offset : offset + data.nbytes] = data
+        return slot
+
+    def read(self, slot, length):
+        offset = slot * self.slot_size
+        return bytes(self.shm.buf[offset : offset + length])
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class PipeWriter:
+    # Sends on one end of a pipe from its own thread, in order. Both ends
+    # writing from their event loops could deadlock: with frames too large for
+    # a slot going through the pipe both ways, each side can block on a full
+    # pipe while the other, blocked too, never reads
+    def __init__(self, conn, name):
+        self._conn = conn
+        self._queue = queue.SimpleQueue()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def send(self, message):
+        self._queue.put(message)
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                return
+            try:
+                self._conn.send(message)
+            except OSError:
+                # The other end is gone; the health check takes care of it
+                pass
+
+
+class WorkerConnection(LoopbackConnection):
+    # A router client as the handler in a worker sees it. Messages from the
+    # router land in inbound; sends go back through the pipe and, for frames,
+    # the outbound shared memory
+    def __init__(self, cid, send, outbound):
+        super().__init__()
+        self.cid = cid
+        self._send = send
+        self._outbound = outbound
+
+    async def send(self, message):
+        if isinstance(message, str):
+            self._send(("text", self.cid, message))
+            return
+        slot = self._outbound.write(message)
+        if slot is None:
+            self._send(("bytes", self.cid, bytes(message)))
+        else:
+            self._send(("frame", self.cid, slot, memoryview(message).nbytes))
+
+
+def worker_main(
+    conn, inbound_name, outbound_name, slots, slot_size, device, server_args
+):
+    if device is not None:
+        # Before anything imports torch, so "cuda" is this worker's device
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+    inbound = SlotPool(slots, slot_size, inbound_name)
+    outbound = SlotPool(slots, slot_size, outbound_name)
+    try:
+        asyncio.run(_serve_worker(conn, inbound, outbound, server_args))
+    finally:
+        inbound.close()
+        outbound.close()
+
+
+async def _serve_worker(conn, inbound, outbound, server_args):
+    server_args = dict(server_args)
+    warmup_frames = server_args.pop("warmup_frames", 5)
+    warmup_size = server_args.pop("warmup_size", 256)
+    warmup_timeout = server_args.pop("warmup_timeout", 120.0)
+    handler, readiness = create_server(**server_args)
+
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    connections = {}
+    writer = PipeWriter(conn, "router-pipe")
+
+    async def serve(cid, connection):
+        try:
+            if await readiness.admit(connection):
+                await handler(connection)
+        finally:
+            del connections[cid]
+            writer.send(("closed", cid))
+
+    def receive():
+        while True:
+            try:
+                if not conn.poll():
+                    return
+                message = conn.recv()
+            except (EOFError, OSError):
+                # The router is gone
+                loop.remove_reader(conn.fileno())
+                stopped.set()
+                return
+            kind = message[0]
+            if kind == "ping":
+                # Answered from the event loop, so a stuck loop fails the check
+                writer.send(("pong", message[1]))
+            elif kind == "free":
+                outbound.free.append(message[1])
+            elif kind == "open":
+                cid = message[1]
+                connection = connections[cid] = WorkerConnection(
+                    cid, writer.send, outbound
+                )
+                asyncio.ensure_future(serve(cid, connection))
+            else:
+                connection = connections.get(message[1])
+                if kind == "frame":
+                    data = inbound.read(message[2], message[3])
+                    writer.send(("free", message[2]))
+                elif kind == "close":
+                    data = None
+                else:
+                    data = message[2]
+                if connection is not None:
+                    connection.inbound.put_nowait(data)
+
+    loop.add_reader(conn.fileno(), receive)
+    await run_warmup(
+        handler,
+        readiness,
+        warmup_frames,
+        warmup_size,
+        server_args.get("jpeg_quality", 90),
+        warmup_timeout,
+    )
+    writer.send(("ready", readiness.warmup))
+    await stopped.wait()
+    writer.close()
+
+
+def dropped_reply(message):
+    # What the worker would answer for a frame it dropped, None for raw frames
+    try:
+        envelope = protocol.unpack(message)
+    except ValueError:
+        return None
+    if envelope is None or envelope.type != protocol.FRAME:
+        return None
+    now = time.time()
+    return protocol.pack(
+        protocol.DROPPED,
+        seq=envelope.seq,
+        width=envelope.width,
+        height=envelope.height,
+        capture_ts=envelope.capture_ts,
+        recv_ts=now,
+        send_ts=now,
+        version=max(envelope.version, 1),
+    )
+
+
+class Client:
+    def __init__(self, cid, websocket):
+        self.cid = cid
+        self.websocket = websocket
+        self.worker = None
+        # Latest text message of each shape (config, prompt, style...),
+        # replayed to rebuild the connection on another worker
+        self.texts = {}
+        self.outbound = asyncio.Queue()
+
+    def remember(self, text):
+        try:
+            key = tuple(sorted(json.loads(text)))
+        except (ValueError, TypeError):
+            key = text
+        self.texts.pop(key, None)
+        self.texts[key] = text
+
+    async def forward(self):
+        # One sender per client keeps its replies in order
+        while True:
+            message = await self.outbound.get()
+            if message is None:
+                await self.websocket.close()
+                return
+            await self.websocket.send(message)
+
+
+class Worker:
+    # The router's side of one worker process: its pipe, a slot pool in each
+    # direction and the clients assigned to it
+    def __init__(self, index, device, slots, slot_size, server_args, on_ready):
+        self.index = index
+        self.device = device
+        self.slots = slots
+        self.slot_size = slot_size
+        self.server_args = server_args
+        self.on_ready = on_ready
+        self.clients = {}
+        self.process = None
+        self.ready = False
+        self.restarts = 0
+        # Deaths in a row before getting ready, to back off from crash loops
+        self.failures = 0
+        self.retry_at = 0.0
+        self.warmup = None
+
+    def start(self):
+        self.inbound = SlotPool(self.slots, self.slot_size)
+        self.outbound = SlotPool(self.slots, self.slot_size)
+        self.conn, child = _context.Pipe()
+        self.writer = PipeWriter(self.conn, f"worker-{self.index}-pipe")
+        self.process = _context.Process(
+            target=worker_main,
+            args=(
+                child,
+                self.inbound.name,
+                self.outbound.name,
+                self.slots,
+                self.slot_size,
+                self.device,
+                self.server_args,
+            ),
+            name=f"worker-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.ready = False
+        self.started_at = self.last_pong = time.time()
+        asyncio.get_event_loop().add_reader(self.conn.fileno(), self._receive)
+        print(
+            f"Worker {self.index} started "
+            f"(pid {self.process.pid}, device {self.device})"
+        )
+        # Clients kept through a restart wait here until it's ready
+        for client in self.clients.values():
+            self.open(client)
+
+    def stop(self):
+        if self.process is None:
+            return
+        asyncio.get_event_loop().remove_reader(self.conn.fileno())
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.process = None
+        self.ready = False
+        self.writer.close()
+        self.conn.close()
+        self.inbound.close(unlink=True)
+        self.outbound.close(unlink=True)
+
+    def send(self, message):
+        # Stopped workers get nothing; restarting sends their clients again
+        if self.process is not None:
+            self.writer.send(message)
+
+    def open(self, client):
+        self.send(("open", client.cid))
+        for text in client.texts.values():
+            self.send(("text", client.cid, text))
+
+    def send_frame(self, cid, data):
+        slot = self.inbound.write(data)
+        if slot is None:
+            self.send(("bytes", cid, data))
+        else:
+            self.send(("frame", cid, slot, len(data)))
+
+    def _receive(self):
+        while True:
+            try:
+                if not self.conn.poll():
+                    return
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # Exited; the health check restarts it
+                asyncio.get_event_loop().remove_reader(self.conn.fileno())
+                return
+            kind = message[0]
+            if kind == "pong":
+                self.last_pong = time.time()
+            elif kind == "free":
+                self.inbound.free.append(message[1])
+            elif kind == "ready":
+                self.ready = True
+                self.failures = 0
+                self.warmup = message[1]
+                self.last_pong = time.time()
+                print(
+                    f"Worker {self.index} ready in {time.time() - self.started_at:.4f}s"
+                )
+                self.on_ready()
+            else:
+                client = self.clients.get(message[1])
+                if kind == "frame":
+                    data = self.outbound.read(message[2], message[3])
+                    self.send(("free", message[2]))
+                elif kind == "closed":
+                    data = None
+                else:
+                    data = message[2]
+                if client is not None:
+                    client.outbound.put_nowait(data)
+
+    def status(self):
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process is not None else None,
+            "device": self.device,
+            "ready": self.ready,
+            "connections": len(self.clients),
+            "restarts": self.restarts,
+            "warmup": self.warmup,
+        }
+
+
+class Router:
+    # Shards connections across workers: each connection sticks to the ready
+    # worker with the fewest connections when it arrives, and only moves if
+    # that worker dies. Workers are pinged every health_interval and
+    # restarted when they exit, stop answering for health_timeout, or aren't
+    # ready startup_timeout after starting.
+    def __init__(
+        self,
+        workers,
+        devices,
+        slots,
+        slot_size,
+        server_args,
+        health_interval=1.0,
+        health_timeout=10.0,
+        startup_timeout=600.0,
+    ):
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.startup_timeout = startup_timeout
+        self._ready = asyncio.Event()
+        self._ids = itertools.count()
+        self.workers = []
+        for index in range(workers):
+            args = dict(server_args)
+            if args.get("metrics_port") is not None:
+                args["metrics_port"] += index
+            device = devices[index % len(devices)] if devices else None
+            self.workers.append(
+                Worker(index, device, slots, slot_size, args, self._ready.set)
+            )
+
+    def pick(self, exclude=None):
+        ready = [w for w in self.workers if w.ready and w is not exclude]
+        return min(ready, key=lambda worker: len(worker.clients), default=None)
+
+    def attach(self, client, worker):
+        client.worker = worker
+        worker.clients[client.cid] = client
+        if worker.process is not None:
+            worker.open(client)
+
+    async def handle(self, websocket):
+        client = Client(next(self._ids), websocket)
+        worker = self.pick()
+        if worker is None:
+            print("Connection waiting for a ready worker")
+        while worker is None:
+            self._ready.clear()
+            await self._ready.wait()
+            worker = self.pick()
+        self.attach(client, worker)
+        print(
+            f"Connection {client.cid} on worker {worker.index} "
+            f"({len(worker.clients)} connections)"
+        )
+        sender = asyncio.ensure_future(client.forward())
+        try:
+            async for message in websocket:
+                if isinstance(message, str):
+                    client.remember(message)
+                    client.worker.send(("text", client.cid, message))
+                elif client.worker.ready:
+                    client.worker.send_frame(client.cid, message)
+                else:
+                    # Its worker is restarting; answering keeps the client's
+                    # in-flight window from waiting on these frames
+                    reply = dropped_reply(message)
+                    if reply is not None:
+                        await websocket.send(reply)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+            client.worker.clients.pop(client.cid, None)
+            client.worker.send(("close", client.cid))
+            print(f"Connection {client.cid} closed")
+
+    def restart(self, worker, problem):
+        print(f"Worker {worker.index} {problem}, restarting")
+        if not worker.ready:
+            worker.failures += 1
+        clients = list(worker.clients.values())
+        worker.clients.clear()
+        worker.stop()
+        worker.restarts += 1
+        worker.retry_at = time.time()
+        if worker.failures:
+            worker.retry_at += min(2**worker.failures, 60)
+        # Connections carry on from their latest config on another ready
+        # worker, or wait for this one
+        for client in clients:
+            self.attach(client, self.pick(exclude=worker) or worker)
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            now = time.time()
+            for worker in self.workers:
+                if worker.process is None:
+                    if now >= worker.retry_at:
+                        worker.start()
+                    continue
+                if not worker.process.is_alive():
+                    self.restart(worker, f"exited with {worker.process.exitcode}")
+                elif not worker.ready:
+                    if now - worker.started_at > self.startup_timeout:
+                        self.restart(worker, "not ready in time")
+                elif now - worker.last_pong > self.health_timeout:
+                    self.restart(worker, "stopped answering")
+                else:
+                    worker.send(("ping", now))
+
+    def probe(self):
+        # For /ready: 200 while any worker can take connections
+        ready = any(worker.ready for worker in self.workers)
+        body = json.dumps(
+            {"ready": ready, "workers": [worker.status() for worker in self.workers]}
+        )
+        return (200 if ready else 503), "application/json", body
+
+
+def run_router(
+    host="0.0.0.0",
+    port=5678,
+    workers=2,
+    devices=None,
+    slots=8,
+    slot_size=2 << 20,
+    health_interval=1.0,
+    health_timeout=10.0,
+    startup_timeout=600.0,
+    health_port=None,
+    **server_args,
+):
+    # Remaining flags go to each worker's server, as for server.py; with
+    # --metrics_port, worker i serves its metrics on metrics_port + i.
+    # devices lists the GPUs to spread workers over, e.g. --devices=0,1
+    if devices is not None and not isinstance(devices, (list, tuple)):
+        devices = [devices]
+    server_args = dict(server_args, host=host, not_ready="queue")
+
+    loop = asyncio.get_event_loop()
+    router = Router(
+        workers,
+        devices,
+        slots,
+        slot_size,
+        server_args,
+        health_interval=health_interval,
+        health_timeout=health_timeout,
+        startup_timeout=startup_timeout,
+    )
+    for worker in router.workers:
+        worker.start()
+
+    if health_port is not None:
+        start_http_server(health_port, host, {"/ready": router.probe})
+        print(f"Worker health at http://{host}:{health_port}/ready")
+
+    loop.run_until_complete(websockets.serve(router.handle, host, port))
+    print(f"Router started at ws://{host}:{port} with {workers} workers")
+    loop.create_task(router.monitor())
+    # Stopping the loop runs the cleanup below, which unlinks shared memory
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        for worker in router.workers:
+            worker.stop()
+
+
+if __name__ == "__main__":
+    fire.Fire(run_router)
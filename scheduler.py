@@ -0,0 +1,234 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from prompt_cache import clone_state
+
+
+class StreamState:
+    # Per-connection view of the shared backend: its prompt conditioning and
+    # the temporal state (e.g. latent buffers) carried between its frames. New
+    # conditioning is staged in `pending` and swapped in by the scheduler
+    # thread right before a frame.
+    # `model` is the registry model the conditioning was prepared for, None
+    # for the scheduler's own backend; it changes together with the
+    # conditioning.
+    def __init__(self):
+        self.conditioning = {}
+        self.temporal = {}
+        self.model = None
+        self.pending = None
+        self.generation = 0
+
+    def stage(self, generation, conditioning, temporal, requested_at, model=None):
+        # A slower, older prompt update must not replace a newer one
+        if generation == self.generation:
+            self.pending = (conditioning, temporal, model, requested_at, time.time())
+
+    def swap_pending(self):
+        pending, self.pending = self.pending, None
+        if pending is None:
+            return
+        self.conditioning, self.temporal, self.model, requested_at, ready_at = pending
+        now = time.time()
+        print(
+            f"Prompt swapped in {now - requested_at:.4f}s after request "
+            f"(prepare: {ready_at - requested_at:.4f}s, swap: {now - ready_at:.4f}s)"
+        )
+
+
+class _Request:
+    def __init__(self, image, state, timings=None, on_start=None):
+        self.image = image
+        self.state = state
+        self.timings = timings
+        self.on_start = on_start
+        self.enqueued_at = time.time()
+        self.future = Future()
+
+
+class BatchScheduler:
+    # Owns the backend on a dedicated thread that runs the frames submitted
+    # from every connection. Backends with infer_batch() get batches: frames
+    # are collected until max_batch_size frames are pending or the oldest one
+    # has waited max_wait seconds, then go through one infer_batch() call.
+    # Other backends run frames one by one as they come, without waiting.
+    # Connections may run on other models from a registry: a batch only holds
+    # frames for one model, frames for another wait for the next batch.
+    def __init__(self, backend, max_batch_size=2, max_wait=0.005, prompt_cache=None):
+        self.backend = backend
+        self.prompt_cache = prompt_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.active_states = 0
+        self._queue = queue.Queue()
+        # Frames held back from a batch for another model, run first next time
+        self._held = deque()
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self._thread = threading.Thread(target=self._run, name="inference", daemon=True)
+        self._thread.start()
+
+    def register(self, state):
+        with self._lock:
+            self.active_states += 1
+
+    def unregister(self, state):
+        with self._lock:
+            self.active_states -= 1
+
+    def backend_for(self, state):
+        return state.model.backend if state.model is not None else self.backend
+
+    def infer(self, image, state, timings=None, on_start=None):
+        # Fills timings["queue_wait"] and timings["diffusion"] when given.
+        # on_start() is called from the inference thread when the frame's
+        # batch starts
+        request = _Request(image, state, timings, on_start)
+        self._queue.put(request)
+        return request.future.result()
+
+    def prepare(
+        self,
+        state,
+        prompt,
+        negative_prompt="",
+        num_inference_steps=50,
+        guidance_scale=1.2,
+        model=None,
+    ):
+        # Prepares conditioning for the state without touching the live backend:
+        # frames keep using the previous conditioning until the new one is
+        # swapped in before the state's next frame. Runs in the caller's thread
+        # and returns True when the conditioning came from the prompt cache.
+        # With a registry model, the state switches to it along with the
+        # conditioning.
+        requested_at = time.time()
+        state.generation += 1
+        generation = state.generation
+
+        name = model.name if model is not None else None
+        key = (name, prompt, negative_prompt, guidance_scale, num_inference_steps)
+        if self.prompt_cache is not None:
+            entry = self.prompt_cache.get(key)
+            if entry is not None:
+                state.stage(
+                    generation,
+                    entry["conditioning"],
+                    clone_state(entry["temporal"]),
+                    requested_at,
+                    model,
+                )
+                return True
+
+        backend = model.backend if model is not None else self.backend
+        conditioning, temporal = backend.prepare_state(
+            prompt, negative_prompt, num_inference_steps, guidance_scale
+        )
+        if self.prompt_cache is not None:
+            self.prompt_cache.put(
+                key,
+                {"conditioning": conditioning, "temporal": clone_state(temporal)},
+            )
+        state.stage(generation, conditioning, temporal, requested_at, model)
+        return False
+
+    def _next(self, timeout=None):
+        if self._held:
+            return self._held.popleft()
+        if timeout is None:
+            return self._queue.get()
+        if timeout > 0:
+            return self._queue.get(timeout=timeout)
+        return self._queue.get_nowait()
+
+    def _run(self):
+        while True:
+            request = self._next()
+            # Pending conditioning may switch the state to another model
+            request.state.swap_pending()
+            backend = self.backend_for(request.state)
+
+            # Waiting only pays off when other connections may contribute frames
+            # and the backend runs them together
+            batch_size = 1
+            if hasattr(backend, "infer_batch"):
+                batch_size = min(self.max_batch_size, max(self.active_states, 1))
+            batch = [request]
+            held = []
+            deadline = request.enqueued_at + self.max_wait
+            while len(batch) < batch_size:
+                try:
+                    request = self._next(deadline - time.time())
+                except queue.Empty:
+                    break
+                request.state.swap_pending()
+                if self.backend_for(request.state) is backend:
+                    batch.append(request)
+                else:
+                    held.append(request)
+
+            self._held.extend(held)
+            self._run_batch(backend, batch)
+
+    def _run_batch(self, backend, batch):
+        t_start = time.time()
+        wait_time = sum(t_start - request.enqueued_at for request in batch)
+        for request in batch:
+            if request.timings is not None:
+                request.timings["queue_wait"] = t_start - request.enqueued_at
+            if request.on_start is not None:
+                request.on_start()
+
+        if hasattr(backend, "infer_batch"):
+            try:
+                outputs = backend.infer_batch(
+                    [request.image for request in batch],
+                    [request.state for request in batch],
+                )
+                batch_time = time.time() - t_start
+                for request, output in zip(batch, outputs):
+                    self._set_diffusion_time(request, batch_time)
+                    request.future.set_result(output)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+        else:
+            for request in batch:
+                t_request = time.time()
+                try:
+                    output = backend.infer(request.image, request.state)
+                    self._set_diffusion_time(request, time.time() - t_request)
+                    request.future.set_result(output)
+                except Exception as e:
+                    request.future.set_exception(e)
+
+        with self._lock:
+            self.batches += 1
+            self.frames += len(batch)
+            self.busy_time += time.time() - t_start
+            self.wait_time += wait_time
+
+    def _set_diffusion_time(self, request, diffusion_time):
+        if request.timings is not None:
+            request.timings["diffusion"] = diffusion_time
+
+    def stats(self):
+        with self._lock:
+            elapsed = max(time.time() - self.stats_start, 1e-9)
+            return {
+                "batches": self.batches,
+                "frames": self.frames,
+                "avg_batch_size": self.frames / max(self.batches, 1),
+                "avg_wait": self.wait_time / max(self.frames, 1),
+                "utilization": self.busy_time / elapsed,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.batches = 0
+            self.frames = 0
+            self.busy_time = 0.0
+            self.wait_time = 0.0
+            self.stats_start = time.time()
@@ -1,222 +1,831 @@
 import fire
-import cv2
-import numpy as np
 import asyncio
+import functools
+import itertools
 import websockets
 import json
-import PIL.Image
+import statistics
 import time
-import torch
-from diffusers import AutoencoderTiny, StableDiffusionPipeline
-from streamdiffusion import StreamDiffusion
-from streamdiffusion.image_utils import postprocess_image
-from streamdiffusion.acceleration.tensorrt import accelerate_with_tensorrt
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import protocol
+from backends import REUSED, load_backend
+from frame_codecs import CodecSet, get_codec, negotiate
+from loopback import LoopbackConnection
+from frame_pipeline import DropFrame, Frame, FramePipeline, LatestFrameSlot, Stage
+from metrics import CONTENT_TYPE, MetricsRegistry, ServerMetrics, start_http_server
+from model_registry import ModelRegistry, load_styles
+from preprocessing import Preprocessor
+from prompt_cache import PromptCache
+from scheduler import BatchScheduler, StreamState
+from tiles import TileEncoder
+from tracing import Tracer
 
 
-def load_model(
-    base_model_path,
-    acceleration,
-    lora_path=None,
-    lora_scale=1.0,
-    t_index_list=None,
-    engines_dir="engines",
+def build_stages(
+    scheduler,
+    state,
+    preprocessor,
+    output_settings,
+    executors,
+    codecs,
+    on_inference_start=None,
 ):
-    t_start = time.time()
-    pipe = StableDiffusionPipeline.from_pretrained(base_model_path).to(
-        device=torch.device("cuda"),
-        dtype=torch.float16,
-    )
-    print(f"Pipeline load time: {time.time() - t_start:.4f}s")
+    def decode_stage(frame):
+        # Decode image, raw messages are always JPEG
+        t_start = time.time()
+        envelope = frame.envelope
+        if envelope is None:
+            img = codecs.get("jpeg").decode(frame.data)
+        else:
+            codec = codecs.by_id(envelope.codec)
+            img = codec.decode(frame.data, envelope.width, envelope.height)
+        frame.record("decode", t_start)
 
-    t_start = time.time()
-    stream = StreamDiffusion(
-        pipe,
-        t_index_list=t_index_list,
-        torch_dtype=torch.float16,
-        width=512,
-        height=512,
-    )
-    print(f"Stream initialization time: {time.time() - t_start:.4f}s")
+        if img is None:
+            raise DropFrame("Failed to decode received image")
 
-    t_start = time.time()
-    stream.enable_similar_image_filter(0.99, 5)
-    stream.load_lcm_lora()
-    stream.fuse_lora()
-    print(f"LCM LoRA setup time: {time.time() - t_start:.4f}s")
+        # Preprocessing
+        t_start = time.time()
+        img = preprocessor(img)
+        frame.record("preprocess", t_start)
 
-    if lora_path is not None:
+        # Convert to model input (a PIL image or an uploaded tensor). With
+        # styles the state's model can change between stages; all models
+        # share a backend class and resolution, so any of them converts
+        backend = scheduler.backend_for(state)
         t_start = time.time()
-        stream.load_lora(lora_path)
-        stream.fuse_lora(lora_scale=lora_scale)
-        print(f"Custom LoRA load time: {time.time() - t_start:.4f}s")
-        print(f"Using LoRA: {lora_path}")
+        frame.data = backend.to_input(img)
+        frame.copies += backend.input_copies
+        frame.record("to_pil", t_start)
 
-    t_start = time.time()
-    stream.vae = AutoencoderTiny.from_pretrained("madebyollin/taesd").to(
-        device=pipe.device, dtype=pipe.dtype
-    )
-    print(f"VAE load time: {time.time() - t_start:.4f}s")
+    def inference_stage(frame):
+        # Process through diffusion model
+        t_start = time.time()
+        on_start = None
+        if on_inference_start is not None:
+            on_start = functools.partial(on_inference_start, frame)
+        frame.data = scheduler.infer(frame.data, state, frame.timings, on_start)
+        if frame.spans is not None:
+            # The scheduler only reports durations: waiting comes first, then
+            # the batch the frame ran in on the inference thread
+            started = t_start + frame.timings["queue_wait"]
+            frame.add_span("queue_wait", t_start, started)
+            frame.add_span(
+                "diffusion", started, started + frame.timings["diffusion"], "inference"
+            )
 
-    t_start = time.time()
-    if acceleration == "tensorrt":
-        stream = accelerate_with_tensorrt(
-            stream,
-            engines_dir,
-            max_batch_size=2,
+    def encode_stage(frame):
+        if frame.data is REUSED:
+            # Nothing new to encode; the sink sends the previous result again
+            frame.reused = True
+            frame.data = None
+            frame.timings["postprocess"] = 0.0
+            frame.timings["encode"] = 0.0
+            return
+
+        # Post-process
+        backend = scheduler.backend_for(state)
+        t_start = time.time()
+        output_bgr = backend.postprocess(frame.data)
+        frame.copies += backend.output_copies
+        frame.height, frame.width = output_bgr.shape[:2]
+        frame.record("postprocess", t_start)
+
+        if output_settings["tiles"] is not None and frame.envelope is not None:
+            # Tiles are diffed against the previous result, so the sink encodes
+            # them in send order; the backend reuses the output buffer
+            frame.data = output_bgr.copy()
+            frame.tiled = True
+            return
+
+        # Encode output
+        t_start = time.time()
+        # Raw messages can only carry JPEG
+        codec = output_settings["codec"]
+        if frame.envelope is None:
+            codec = codecs.get("jpeg")
+        frame.data = codec.encode(output_bgr, output_settings["jpeg_quality"])
+        frame.codec = codec.id
+        if frame.data is None:
+            raise DropFrame("Failed to encode output image")
+        frame.record("encode", t_start)
+
+    return [
+        Stage("decode", decode_stage, executors.decode, executors.decode_workers),
+        Stage(
+            "inference", inference_stage, executors.inference, busy_key="diffusion"
+        ),
+        Stage("encode", encode_stage, executors.encode, executors.encode_workers),
+    ]
+
+
+# Identifies connections in per-connection metrics and traces
+connection_ids = itertools.count(1)
+
+
+class Executors:
+    def __init__(self, decode_workers=2, encode_workers=2, inference_waiters=16):
+        self.decode_workers = decode_workers
+        self.encode_workers = encode_workers
+        self.decode = ThreadPoolExecutor(decode_workers, thread_name_prefix="decode")
+        # The scheduler thread owns the backend; these threads only wait on it
+        self.inference = ThreadPoolExecutor(
+            inference_waiters, thread_name_prefix="inference-wait"
         )
-    else:
-        pipe.enable_xformers_memory_efficient_attention()
-    print(f"Acceleration setup time: {time.time() - t_start:.4f}s")
+        self.encode = ThreadPoolExecutor(encode_workers, thread_name_prefix="encode")
+        # Prompt preparation runs beside inference, one prompt at a time
+        self.prepare = ThreadPoolExecutor(1, thread_name_prefix="prepare")
+
 
-    return stream
+def print_timing_breakdown(frame, pipeline, scheduler, dropped, reused):
+    stats = pipeline.stats()
+    scheduler_stats = scheduler.stats()
+    print("\nServer Timing breakdown (seconds):")
+    print(f"Decode input: {frame.timings['decode']:.4f}")
+    print(f"Preprocessing: {frame.timings['preprocess']:.4f}")
+    print(f"Convert to model input: {frame.timings['to_pil']:.4f}")
+    print(f"Inference queue wait: {frame.timings['queue_wait']:.4f}")
+    print(f"Diffusion model: {frame.timings['diffusion']:.4f}")
+    print(f"Post-processing: {frame.timings['postprocess']:.4f}")
+    print(f"Encode output: {frame.timings['encode']:.4f}")
+    print(f"Send result: {frame.timings['send']:.4f}")
+    print(f"Total processing time: {frame.timings['total']:.4f}")
+    print(f"Host frame copies: {frame.copies}")
+    print("Stage utilization:")
+    for name, stage_stats in stats["stages"].items():
+        print(f"  {name}: {stage_stats['utilization'] * 100:.1f}%")
+    print(f"Bottleneck stage: {stats['bottleneck']}")
+    print(
+        f"Inference batches: {scheduler_stats['avg_batch_size']:.2f} frames avg, "
+        f"{scheduler_stats['avg_wait']:.4f}s avg wait, "
+        f"{scheduler_stats['utilization'] * 100:.1f}% busy"
+    )
+    print(f"Server FPS: {stats['fps']:.2f}")
+    print(f"Dropped frames: {dropped}")
+    print(f"Reused outputs: {reused}")
+    print("-" * 40)
 
 
 async def process_image(
     websocket,
-    stream,
+    scheduler,
     prompt,
+    executors,
     num_inference_steps=50,
-    preprocessing=None,
+    preprocessor=None,
     negative_prompt="",
     guidance_scale=1.2,
     jpeg_quality=90,
+    queue_size=2,
+    ingest="queue",
+    on_frame=None,
+    codecs=None,
+    tile_size=64,
+    tile_threshold=2.0,
+    keyframe_interval=30,
+    metrics=None,
+    tracer=None,
+    registry=None,
 ):
-    # Prepare the stream
-    t_start = time.time()
-    stream.prepare(
-        prompt,
-        num_inference_steps=num_inference_steps,
-        guidance_scale=guidance_scale,
-        negative_prompt=negative_prompt,
-    )
-    print(f"Initial stream preparation time: {time.time() - t_start:.4f}s")
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+    if codecs is None:
+        codecs = CodecSet()
+    loop = asyncio.get_running_loop()
+    connection = next(connection_ids)
+    frames_sent = 0
+    state = StreamState()
+    # Clients may change these during the session
+    output_settings = {
+        "jpeg_quality": jpeg_quality,
+        "codec": codecs.get("jpeg"),
+        "tiles": None,
+    }
+    protocol_version = 0
+    # Frame rate hints for clients, see send_result
+    hint = {"sent_at": time.time(), "dropped": 0, "frames": 0}
+    # Last result sent, for frames whose output the backend reused
+    last_result = {"data": None, "codec": 0, "width": 0, "height": 0, "reused": 0}
+    # Registry model for the connection's style, None without styles. While a
+    # style switch prepares its model, prompt updates already use it ("next")
+    style = {"model": None, "next": None}
+    style_lock = asyncio.Lock()
+    if registry is not None:
+        style["model"] = await asyncio.wrap_future(registry.request(registry.default))
+        registry.acquire(style["model"])
 
-    frame_count = 0
-    async for message in websocket:
-        if isinstance(message, str):
+    async def prepare(new_prompt, new_negative_prompt):
+        model = style["next"] or style["model"]
+        t_start = time.time()
+        cached = await loop.run_in_executor(
+            executors.prepare,
+            lambda: scheduler.prepare(
+                state,
+                new_prompt,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                negative_prompt=new_negative_prompt,
+                model=model,
+            ),
+        )
+        return time.time() - t_start, cached
+
+    async def update_prompt(new_prompt, new_negative_prompt):
+        try:
+            prepare_time, cached = await prepare(new_prompt, new_negative_prompt)
+        except Exception as e:
+            print(f"Prompt update failed: {e}")
+            return
+        print(
+            f"Prompt update time: {prepare_time:.4f}s "
+            f"({'cache hit' if cached else 'cache miss'})"
+        )
+        if scheduler.prompt_cache is not None:
+            print(f"Prompt cache: {scheduler.prompt_cache.stats()}")
+
+    async def switch_style(name):
+        # The model loads in the background while frames keep running on the
+        # current one; the new model and its conditioning are swapped in
+        # together before the next frame. The connection only lets go of the
+        # current model once the new one is prepared.
+        async with style_lock:
+            t_start = time.time()
             try:
-                t_start = time.time()
-                message_data = json.loads(message)
-                new_prompt = message_data.get("prompt", prompt)
-                new_negative_prompt = message_data.get(
-                    "negative_prompt", negative_prompt
+                # Shielded: other connections may be waiting on the same load
+                model = await asyncio.shield(
+                    asyncio.wrap_future(registry.request(name))
                 )
-                stream.prepare(
-                    prompt=new_prompt,
-                    num_inference_steps=num_inference_steps,
-                    guidance_scale=guidance_scale,
-                    negative_prompt=new_negative_prompt,
+            except Exception as e:
+                print(f"Style {name} failed to load: {e}")
+                await websocket.send(
+                    json.dumps({"style": style["model"].name, "error": str(e)})
                 )
-                print(f"Prompt update time: {time.time() - t_start:.4f}s")
-                continue
-            except json.JSONDecodeError:
-                print("Received invalid JSON configuration.")
-                continue
-
-        elif isinstance(message, bytes):
-            loop_start = time.time()
+                return
+            load_time = time.time() - t_start
+            registry.acquire(model)
+            style["next"] = model
             try:
-                # Decode image
-                t_start = time.time()
-                decimg = np.frombuffer(message, dtype=np.uint8)
-                img = cv2.imdecode(decimg, cv2.IMREAD_COLOR)
-                decode_time = time.time() - t_start
-
-                if img is None:
-                    print("Failed to decode received JPEG image")
-                    continue
+                prepare_time, cached = await prepare(prompt, negative_prompt)
+            except asyncio.CancelledError:
+                # The connection closed during the switch
+                registry.release(model)
+                raise
+            except Exception as e:
+                print(f"Style switch failed: {e}")
+                registry.release(model)
+                await websocket.send(
+                    json.dumps({"style": style["model"].name, "error": str(e)})
+                )
+                return
+            finally:
+                style["next"] = None
+            previous, style["model"] = style["model"], model
+            registry.release(previous)
+        print(
+            f"Style {name} ready in {time.time() - t_start:.4f}s "
+            f"(load: {load_time:.4f}s, prepare: {prepare_time:.4f}s, "
+            f"{'cache hit' if cached else 'cache miss'})"
+        )
+        print(f"Models: {registry.stats()}")
+        await websocket.send(json.dumps({"style": name}))
 
-                # Preprocessing
-                t_start = time.time()
-                if preprocessing == "canny":
-                    img = cv2.Canny(img, 100, 200)
-                    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-                elif preprocessing == "canny_blur_shift":
-                    blur_img = cv2.GaussianBlur(img, (3, 3), 0)
-                    canny_img = cv2.Canny(blur_img, 100, 200)
-                    canny_img = cv2.cvtColor(canny_img, cv2.COLOR_GRAY2BGR)
-                    canny_img[np.where((canny_img == [0, 0, 0]).all(axis=2))] = [
-                        255,
-                        0,
-                        0,
-                    ]
-                    img = cv2.addWeighted(img, 0.8, canny_img, 0.2, 0)
-                elif preprocessing == "blur":
-                    img = cv2.GaussianBlur(img, (5, 5), 0)
-                elif preprocessing == "gray":
-                    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-                elif preprocessing == "contrast":
-                    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-                    img = clahe.apply(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
-                    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-                preprocess_time = time.time() - t_start
-
-                # Convert to PIL
-                t_start = time.time()
-                img_pil = PIL.Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-                to_pil_time = time.time() - t_start
-
-                # Process through diffusion model
-                t_start = time.time()
-                x_output = stream(img_pil)
-                diffusion_time = time.time() - t_start
-
-                # Post-process
-                t_start = time.time()
-                output = postprocess_image(x_output, output_type="pil")[0]
-                output_array = np.array(output)
-                postprocess_time = time.time() - t_start
-
-                # Encode output
-                t_start = time.time()
-                output_bgr = cv2.cvtColor(output_array, cv2.COLOR_RGB2BGR)
-                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
-                result, encimg = cv2.imencode(".jpg", output_bgr, encode_param)
-                if not result:
-                    print("Failed to encode output image")
-                    continue
-                encode_time = time.time() - t_start
+    # Prepare the stream
+    prepare_time, cached = await prepare(prompt, negative_prompt)
+    print(
+        f"Initial stream preparation time: {prepare_time:.4f}s "
+        f"({'cache hit' if cached else 'cache miss'})"
+    )
 
-                # Send result
-                t_start = time.time()
-                jpeg_bytes = encimg.tobytes()
-                await websocket.send(jpeg_bytes)
-                send_time = time.time() - t_start
+    def reply(frame, msg_type, payload=b"", codec=protocol.CODEC_NONE):
+        # Responses echo the frame's sequence number and capture time
+        envelope = frame.envelope
+        return protocol.pack(
+            msg_type,
+            payload,
+            seq=envelope.seq,
+            codec=codec,
+            width=frame.width,
+            height=frame.height,
+            capture_ts=envelope.capture_ts,
+            recv_ts=frame.received_at,
+            send_ts=time.time(),
+            # Envelopes from clients that never asked get version 1 headers
+            version=max(protocol_version, 1),
+        )
 
-                total_time = time.time() - loop_start
+    def count(outcome):
+        if metrics is not None:
+            metrics.count(connection, outcome)
 
-                # Print timing every 30 frames
-                frame_count += 1
-                if frame_count % 30 == 0:
-                    torch.cuda.synchronize()  # Ensure GPU operations are complete
-                    print("\nServer Timing breakdown (seconds):")
-                    print(f"Decode input: {decode_time:.4f}")
-                    print(f"Preprocessing: {preprocess_time:.4f}")
-                    print(f"Convert to PIL: {to_pil_time:.4f}")
-                    print(f"Diffusion model: {diffusion_time:.4f}")
-                    print(f"Post-processing: {postprocess_time:.4f}")
-                    print(f"Encode output: {encode_time:.4f}")
-                    print(f"Send result: {send_time:.4f}")
-                    print(f"Total processing time: {total_time:.4f}")
-                    print(f"Server FPS: {1/total_time:.2f}")
-                    print("-" * 40)
+    def trace(frame, outcome):
+        if tracer is not None:
+            tracer.add_frame(
+                f"connection {connection}",
+                frame.seq,
+                frame.received_at,
+                time.time(),
+                frame.spans,
+                connection=connection,
+                outcome=outcome,
+            )
 
-            except Exception as e:
-                print(f"Error processing image: {e}")
-                error_message = json.dumps({"error": str(e)})
-                await websocket.send(error_message.encode("utf-8"))
+    async def send_dropped(frame):
+        count("dropped")
+        trace(frame, "dropped")
+        # Legacy clients get nothing back for dropped frames
+        if frame.envelope is not None:
+            await websocket.send(reply(frame, protocol.DROPPED))
 
+    async def send_result(frame):
+        if frame.error is not None:
+            count("error")
+            trace(frame, "error")
+            print(f"Error processing image: {frame.error}")
+            error_message = json.dumps({"error": str(frame.error)}).encode("utf-8")
+            if frame.envelope is not None:
+                error_message = reply(frame, protocol.ERROR, error_message)
+            await websocket.send(error_message)
+            return
+
+        msg_type = protocol.RESULT
+        if frame.tiled:
+            t_start = time.time()
+            codec = output_settings["codec"]
+            keyframe, frame.data = await loop.run_in_executor(
+                executors.encode,
+                output_settings["tiles"].encode,
+                frame.data,
+                codec,
+                output_settings["jpeg_quality"],
+            )
+            frame.record("encode", t_start)
+            if frame.data is None:
+                print("Failed to encode output tiles")
+                await send_dropped(frame)
+                return
+            frame.codec = codec.id
+            if not keyframe:
+                msg_type = protocol.TILES
+
+        if frame.reused:
+            if last_result["data"] is None or (
+                frame.envelope is None and last_result["codec"] != protocol.CODEC_JPEG
+            ):
+                await send_dropped(frame)
+                return
+            last_result["reused"] += 1
+            count("reused")
+            frame.width, frame.height = last_result["width"], last_result["height"]
+            frame.codec = last_result["codec"]
         else:
-            print("Received unknown message type.")
+            last_result.update(
+                data=frame.data, codec=frame.codec, width=frame.width, height=frame.height
+            )
 
+        # Send result
+        t_start = time.time()
+        if frame.reused and frame.envelope is not None and protocol_version >= 2:
+            # The client keeps the frame it shows
+            await websocket.send(reply(frame, protocol.UNCHANGED))
+        elif frame.reused:
+            # Clients that don't know UNCHANGED get the previous result again
+            if frame.envelope is not None:
+                await websocket.send(
+                    reply(frame, protocol.RESULT, last_result["data"], frame.codec)
+                )
+            else:
+                await websocket.send(bytes(last_result["data"]))
+        elif frame.envelope is not None:
+            await websocket.send(reply(frame, msg_type, frame.data, frame.codec))
+        else:
+            # Codecs hand back the encoder's buffer; raw replies are the message
+            await websocket.send(bytes(frame.data))
+        frame.record("send", t_start)
+        frame.timings["total"] = time.time() - frame.received_at
+        if metrics is not None:
+            metrics.observe(connection, frame.timings)
+            metrics.count(connection, "sent")
+        trace(frame, "reused" if frame.reused else "sent")
+        if on_frame is not None:
+            on_frame(frame)
 
-def run_server(
-    base_model_path,
-    acceleration,
+        # Print timing every 30 frames
+        nonlocal frames_sent
+        frames_sent += 1
+        if frames_sent % 30 == 0:
+            scheduler.backend.synchronize()  # Ensure GPU operations are complete
+            print_timing_breakdown(
+                frame, pipeline, scheduler, latest_frame.dropped, last_result["reused"]
+            )
+            if output_settings["tiles"] is not None:
+                print(f"Tile updates: {output_settings['tiles'].stats()}")
+            pipeline.reset_stats()
+
+        hint_interval = time.time() - hint["sent_at"]
+        if protocol_version and hint_interval >= 2.0:
+            # While frames queue up for inference or get dropped, tells the
+            # client the rate this connection actually gets
+            max_fps = None
+            if (
+                latest_frame.dropped > hint["dropped"]
+                or frame.timings["queue_wait"] > frame.timings["diffusion"]
+            ):
+                max_fps = round((frames_sent - hint["frames"]) / hint_interval, 2)
+            hint.update(
+                sent_at=time.time(), dropped=latest_frame.dropped, frames=frames_sent
+            )
+            await websocket.send(json.dumps({"max_fps": max_fps}))
+
+    # In "latest" ingest mode frames go through a single slot that a feeder task
+    # drains into the pipeline one frame at a time: the next frame is taken
+    # once the previous one starts diffusion (or leaves the pipeline early),
+    # so it is decoded meanwhile but never queues behind older frames of this
+    # connection. Frames arriving in between replace each other and are
+    # dropped before being decoded.
+    latest_frame = LatestFrameSlot()
+    feed_ready = asyncio.Event()
+    feed_ready.set()
+    # The frame last fed from the slot, until it starts diffusion or leaves
+    feeding = {"frame": None}
+    # DROPPED replies for frames replaced in the slot wait until every frame
+    # submitted before them has been answered, so replies keep seq order
+    order = {"submitted": 0, "answered": 0}
+    held_drops = deque()
+
+    def release_feed(frame):
+        if frame is feeding["frame"]:
+            feeding["frame"] = None
+            feed_ready.set()
+
+    def inference_started(frame):
+        loop.call_soon_threadsafe(release_feed, frame)
+
+    async def answered(send, frame):
+        try:
+            await send(frame)
+        finally:
+            # Even if the answer failed, the frame has left the pipeline
+            release_feed(frame)
+            order["answered"] += 1
+        while held_drops and held_drops[0][0] <= order["answered"]:
+            await send_dropped(held_drops.popleft()[1])
+
+    async def drop_replaced(frame):
+        if order["answered"] < order["submitted"]:
+            held_drops.append((order["submitted"], frame))
+        else:
+            await send_dropped(frame)
+
+    async def submit(frame):
+        order["submitted"] += 1
+        await pipeline.submit(frame)
+
+    async def feed_latest():
+        while True:
+            await feed_ready.wait()
+            frame = await latest_frame.get()
+            feed_ready.clear()
+            feeding["frame"] = frame
+            await submit(frame)
+
+    pipeline = FramePipeline(
+        build_stages(
+            scheduler,
+            state,
+            preprocessor,
+            output_settings,
+            executors,
+            codecs,
+            on_inference_start=inference_started,
+        ),
+        lambda frame: answered(send_result, frame),
+        queue_size=queue_size,
+        on_drop=lambda frame: answered(send_dropped, frame),
+    ).start()
+
+    feeder = asyncio.ensure_future(feed_latest())
+
+    frame_count = 0
+    prompt_tasks = set()
+    scheduler.register(state)
+    if metrics is not None:
+        metrics.opened(connection)
+    try:
+        async for message in websocket:
+            if isinstance(message, str):
+                try:
+                    message_data = json.loads(message)
+                    if not isinstance(message_data, dict):
+                        raise TypeError("configuration must be a JSON object")
+                    if message_data.get("ingest") in ("queue", "latest"):
+                        ingest = message_data["ingest"]
+                        print(f"Ingest mode: {ingest}")
+                    if "protocol" in message_data:
+                        # Clients that get no answer keep sending raw JPEG
+                        protocol_version = min(
+                            int(message_data["protocol"]), protocol.VERSION
+                        )
+                        await websocket.send(json.dumps({"protocol": protocol_version}))
+                        print(f"Protocol version: {protocol_version}")
+                    if "codecs" in message_data and protocol_version:
+                        codec = negotiate(message_data["codecs"])
+                        output_settings["codec"] = codecs.get(codec)
+                        await websocket.send(json.dumps({"codec": codec}))
+                        print(f"Codec: {codec}")
+                    if "jpeg_quality" in message_data:
+                        output_settings["jpeg_quality"] = int(message_data["jpeg_quality"])
+                        print(f"Output JPEG quality: {output_settings['jpeg_quality']}")
+                    if message_data.get("tiles") and protocol_version >= 2:
+                        output_settings["tiles"] = TileEncoder(
+                            tile_size, tile_threshold, keyframe_interval
+                        )
+                        await websocket.send(json.dumps({"tiles": tile_size}))
+                        print(f"Tile updates: {tile_size}px tiles")
+                    if message_data.get("keyframe") and output_settings["tiles"]:
+                        # The client has nothing to patch tiles into
+                        output_settings["tiles"].force_keyframe = True
+                    if "style" in message_data:
+                        if registry is None:
+                            await websocket.send(
+                                json.dumps({"error": "This server has no styles"})
+                            )
+                        else:
+                            prompt_tasks.add(
+                                asyncio.ensure_future(
+                                    switch_style(message_data["style"])
+                                )
+                            )
+                    if (
+                        "prompt" not in message_data
+                        and "negative_prompt" not in message_data
+                    ):
+                        continue
+
+                    # Frames keep flowing with the current prompt while the new
+                    # one is prepared in the background
+                    prompt = message_data.get("prompt", prompt)
+                    negative_prompt = message_data.get(
+                        "negative_prompt", negative_prompt
+                    )
+                    prompt_tasks.add(
+                        asyncio.ensure_future(update_prompt(prompt, negative_prompt))
+                    )
+                    prompt_tasks = {task for task in prompt_tasks if not task.done()}
+                    continue
+                except json.JSONDecodeError:
+                    print("Received invalid JSON configuration.")
+                    continue
+                except (ValueError, TypeError, KeyError) as e:
+                    # A bad value only rejects the rest of this message
+                    print(f"Received invalid configuration: {e}")
+                    await websocket.send(
+                        json.dumps({"error": f"Invalid configuration: {e}"})
+                    )
+                    continue
+
+            elif isinstance(message, bytes):
+                try:
+                    envelope = protocol.unpack(message)
+                except ValueError as e:
+                    print(f"Received invalid frame: {e}")
+                    continue
+                if envelope is None:
+                    frame = Frame(frame_count, message)
+                elif envelope.type == protocol.FRAME:
+                    frame = Frame(envelope.seq, envelope.payload)
+                    frame.envelope = envelope
+                else:
+                    print(f"Received unexpected message type {envelope.type}")
+                    continue
+
+                if tracer is not None:
+                    frame.spans = []
+                count("received")
+                if ingest == "latest":
+                    replaced = latest_frame.put(frame)
+                    if replaced is not None:
+                        await drop_replaced(replaced)
+                else:
+                    await submit(frame)
+                frame_count += 1
+
+            else:
+                print("Received unknown message type.")
+    finally:
+        # Style switches still running would swap models after the release
+        for task in prompt_tasks:
+            task.cancel()
+        await asyncio.gather(*prompt_tasks, return_exceptions=True)
+        scheduler.unregister(state)
+        if registry is not None:
+            registry.release(style["model"])
+        if metrics is not None:
+            metrics.closed(connection)
+        feeder.cancel()
+        pipeline.cancel()
+        print(
+            f"Connection closed, dropped {latest_frame.dropped}/{frame_count} frames, "
+            f"reused {last_result['reused']} outputs"
+        )
+
+
+def create_handler(
+    model,
     prompt,
+    num_inference_steps=50,
+    preprocessing=None,
+    negative_prompt="",
+    guidance_scale=1.2,
+    jpeg_quality=90,
+    decode_workers=2,
+    encode_workers=2,
+    queue_size=2,
+    ingest="queue",
+    max_batch_size=2,
+    max_batch_wait=0.005,
+    prompt_cache_size=32,
+    prompt_cache_dir=None,
+    on_frame=None,
+    turbo_jpeg=True,
+    tile_size=64,
+    tile_threshold=2.0,
+    keyframe_interval=30,
+    metrics=None,
+    tracer=None,
+    registry=None,
+):
+    # Builds the state shared by all connections and returns the websocket handler
+    preprocessor = Preprocessor(preprocessing)
+    executors = Executors(decode_workers, encode_workers)
+    codecs = CodecSet(turbo_jpeg)
+    prompt_cache = None
+    if prompt_cache_size > 0:
+        prompt_cache = PromptCache(
+            prompt_cache_size, prompt_cache_dir, map_location=model.device
+        )
+    scheduler = BatchScheduler(model, max_batch_size, max_batch_wait, prompt_cache)
+
+    def handler(websocket):
+        return process_image(
+            websocket,
+            scheduler,
+            prompt,
+            executors,
+            num_inference_steps,
+            preprocessor,
+            negative_prompt=negative_prompt,
+            guidance_scale=guidance_scale,
+            jpeg_quality=jpeg_quality,
+            queue_size=queue_size,
+            ingest=ingest,
+            on_frame=on_frame,
+            codecs=codecs,
+            tile_size=tile_size,
+            tile_threshold=tile_threshold,
+            keyframe_interval=keyframe_interval,
+            metrics=metrics,
+            tracer=tracer,
+            registry=registry,
+        )
+
+    return handler
+
+
+class Readiness:
+    # Whether warmup has finished. Until then frame connections wait for it
+    # ("queue") or are closed with 1013, try again later ("refuse")
+    def __init__(self, not_ready="queue"):
+        if not_ready not in ("queue", "refuse"):
+            raise ValueError(f"Unknown not_ready mode: {not_ready}")
+        self.not_ready = not_ready
+        self.ready = False
+        self.warmup = None
+        self._event = asyncio.Event()
+
+    def set(self, warmup=None):
+        self.warmup = warmup
+        self.ready = True
+        self._event.set()
+
+    async def admit(self, websocket):
+        # Returns False for connections refused while warming up
+        if self.ready:
+            return True
+        if self.not_ready == "refuse":
+            await websocket.close(1013, "Warming up")
+            return False
+        print("Connection waiting for warmup")
+        await self._event.wait()
+        return True
+
+    def probe(self):
+        # For /ready: 200 once warm, 503 before
+        body = json.dumps({"ready": self.ready, "warmup": self.warmup})
+        return (200 if self.ready else 503), "application/json", body
+
+
+async def warmup(handler, frames=5, size=256, jpeg_quality=90, timeout=120.0):
+    # Runs noise frames one at a time through a connection on the handler, so
+    # the default prompt gets prepared (and cached) and the first frames'
+    # one-off costs (allocations, kernel selection, thread pools) are paid
+    # before clients connect. Returns cold (first frame) and warm timings.
+    # Fails if a frame gets no reply within `timeout` seconds or the
+    # connection ends without one, e.g. because preparing the prompt failed.
+    connection = LoopbackConnection()
+    client = connection.client()
+    session = asyncio.ensure_future(handler(connection))
+
+    async def recv_reply():
+        reply = asyncio.ensure_future(client.recv_frame())
+        done, _ = await asyncio.wait(
+            {reply, session}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if reply in done:
+            return reply.result()
+        reply.cancel()
+        if session in done:
+            session.result()
+            raise RuntimeError("Warmup connection ended without a reply")
+        raise TimeoutError(f"No warmup reply within {timeout}s")
+
+    await client.send(json.dumps({"protocol": protocol.VERSION}))
+    codec = get_codec("jpeg")
+    rng = np.random.default_rng(0)
+    totals = []
+    server_times = []
+    t_warmup = time.time()
+    try:
+        for seq in range(frames):
+            # Fresh noise every frame so similar-image filters don't skip it
+            image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+            t_start = time.time()
+            await client.send(
+                protocol.pack(
+                    protocol.FRAME,
+                    codec.encode(image, jpeg_quality),
+                    seq=seq,
+                    codec=codec.id,
+                    width=size,
+                    height=size,
+                    capture_ts=t_start,
+                )
+            )
+            reply = await recv_reply()
+            if reply.type == protocol.ERROR:
+                raise RuntimeError(json.loads(bytes(reply.payload))["error"])
+            totals.append(time.time() - t_start)
+            server_times.append(reply.send_ts - reply.recv_ts)
+    finally:
+        await client.close()
+        try:
+            await asyncio.wait_for(session, timeout)
+        except asyncio.TimeoutError:
+            print("Warmup connection did not close")
+
+    # The first frame also waits for the prompt preparation
+    return {
+        "frames": frames,
+        "size": size,
+        "elapsed_s": time.time() - t_warmup,
+        "cold_s": totals[0],
+        "cold_server_s": server_times[0],
+        "warm_s": statistics.median(totals[1:]) if frames > 1 else None,
+        "warm_server_s": statistics.median(server_times[1:]) if frames > 1 else None,
+    }
+
+
+async def run_warmup(
+    handler, readiness, frames=5, size=256, jpeg_quality=90, timeout=120.0
+):
+    warm = None
+    if frames > 0:
+        print(f"Warming up with {frames} frames of {size}px...")
+        try:
+            warm = await warmup(handler, frames, size, jpeg_quality, timeout)
+            print(
+                f"Warmup time: {warm['elapsed_s']:.4f}s, "
+                f"cold frame: {warm['cold_s']:.4f}s "
+                f"(server {warm['cold_server_s']:.4f}s)"
+            )
+            if warm["warm_s"] is not None:
+                print(
+                    f"Warm frame: {warm['warm_s']:.4f}s "
+                    f"(server {warm['warm_server_s']:.4f}s)"
+                )
+        except Exception as e:
+            # Clients would hit the same failure, so they get served and see it
+            print(f"Warmup failed: {e}")
+            warm = {"error": str(e)}
+    readiness.set(warm)
+
+
+def create_server(
+    base_model_path=None,
+    acceleration="none",
+    prompt="",
     host="0.0.0.0",
-    port=5678,
     num_inference_steps=50,
     preprocessing=None,
     negative_prompt="",
@@ -226,32 +835,230 @@ def run_server(
     t_index_list=None,
     jpeg_quality=90,
     engines_dir="engines",
+    decode_workers=2,
+    encode_workers=2,
+    queue_size=2,
+    ingest="queue",
+    max_batch_size=2,
+    max_batch_wait=0.005,
+    prompt_cache_size=32,
+    prompt_cache_dir=None,
+    backend="streamdiffusion",
+    cpu_latency=0.05,
+    cpu_style="stylization",
+    zero_copy=True,
+    cpu_similar_threshold=0.0,
+    turbo_jpeg=True,
+    tile_size=64,
+    tile_threshold=2.0,
+    keyframe_interval=30,
+    metrics_port=None,
+    health_port=None,
+    trace_size=0,
+    model_cache=True,
+    not_ready="queue",
+    styles=None,
+    model_memory_budget=None,
+    cpu_model_memory=0.0,
 ):
+    # Everything run_server serves, without listening: the model, styles,
+    # metrics and the connection handler with its readiness gate
     print("Loading model...")
     t_start = time.time()
-    stream = load_model(
-        base_model_path, acceleration, lora_path, lora_scale, t_index_list, engines_dir
+    backend_args = dict(
+        backend=backend,
+        base_model_path=base_model_path,
+        acceleration=acceleration,
+        lora_path=lora_path,
+        lora_scale=lora_scale,
+        t_index_list=t_index_list,
+        engines_dir=engines_dir,
+        cpu_latency=cpu_latency,
+        cpu_style=cpu_style,
+        zero_copy=zero_copy,
+        cpu_similar_threshold=cpu_similar_threshold,
+        model_cache=model_cache,
+        cpu_model_memory=cpu_model_memory,
+        max_batch_size=max_batch_size,
     )
+    model = load_backend(**backend_args)
     print(f"Total model load time: {time.time() - t_start:.4f}s")
 
-    start_server = websockets.serve(
-        lambda ws: process_image(
-            ws,
-            stream,
-            prompt,
-            num_inference_steps,
-            preprocessing,
-            negative_prompt=negative_prompt,
-            guidance_scale=guidance_scale,
-            jpeg_quality=jpeg_quality,
-        ),
-        host,
-        port,
+    # Named styles clients can switch to, each overriding some of the model
+    # arguments above; the model loaded above is the "default" style
+    registry = None
+    if styles is not None:
+        memory_budget = None
+        if model_memory_budget is not None:
+            memory_budget = int(model_memory_budget * 2**30)
+        registry = ModelRegistry(
+            load_styles(styles),
+            lambda **style: load_backend(**dict(backend_args, **style)),
+            memory_budget,
+        )
+        registry.add(registry.default, model)
+        print(f"Styles: {', '.join(registry.names())}")
+
+    readiness = Readiness(not_ready)
+
+    # Per-frame spans of the last trace_size stages, served with the metrics
+    tracer = Tracer(trace_size) if trace_size > 0 else None
+
+    metrics = None
+    if metrics_port is not None:
+        metrics = ServerMetrics(MetricsRegistry())
+        routes = {
+            "/metrics": lambda: (200, CONTENT_TYPE, metrics.registry.render()),
+            "/ready": readiness.probe,
+        }
+        if tracer is not None:
+            routes["/trace"] = lambda: (200, "application/json", tracer.render())
+        start_http_server(metrics_port, host, routes)
+        print(f"Metrics at http://{host}:{metrics_port}/metrics")
+        if tracer is not None:
+            print(f"Trace at http://{host}:{metrics_port}/trace")
+    elif tracer is not None:
+        print("Tracing needs --metrics_port to serve /trace")
+    if health_port is not None:
+        # /ready on its own, for readiness probes without metrics
+        start_http_server(health_port, host, {"/ready": readiness.probe})
+        print(f"Readiness at http://{host}:{health_port}/ready")
+
+    handler = create_handler(
+        model,
+        prompt,
+        num_inference_steps,
+        preprocessing,
+        negative_prompt=negative_prompt,
+        guidance_scale=guidance_scale,
+        jpeg_quality=jpeg_quality,
+        decode_workers=decode_workers,
+        encode_workers=encode_workers,
+        queue_size=queue_size,
+        ingest=ingest,
+        max_batch_size=max_batch_size,
+        max_batch_wait=max_batch_wait,
+        prompt_cache_size=prompt_cache_size,
+        prompt_cache_dir=prompt_cache_dir,
+        turbo_jpeg=turbo_jpeg,
+        tile_size=tile_size,
+        tile_threshold=tile_threshold,
+        keyframe_interval=keyframe_interval,
+        metrics=metrics,
+        tracer=tracer,
+        registry=registry,
     )
+    return handler, readiness
 
-    asyncio.get_event_loop().run_until_complete(start_server)
+
+def run_server(
+    base_model_path=None,
+    acceleration="none",
+    prompt="",
+    host="0.0.0.0",
+    port=5678,
+    num_inference_steps=50,
+    preprocessing=None,
+    negative_prompt="",
+    guidance_scale=1.2,
+    lora_path=None,
+    lora_scale=1.0,
+    t_index_list=None,
+    jpeg_quality=90,
+    engines_dir="engines",
+    decode_workers=2,
+    encode_workers=2,
+    queue_size=2,
+    ingest="queue",
+    max_batch_size=2,
+    max_batch_wait=0.005,
+    prompt_cache_size=32,
+    prompt_cache_dir=None,
+    backend="streamdiffusion",
+    cpu_latency=0.05,
+    cpu_style="stylization",
+    zero_copy=True,
+    cpu_similar_threshold=0.0,
+    turbo_jpeg=True,
+    tile_size=64,
+    tile_threshold=2.0,
+    keyframe_interval=30,
+    metrics_port=None,
+    health_port=None,
+    trace_size=0,
+    model_cache=True,
+    warmup_frames=5,
+    warmup_size=256,
+    warmup_timeout=120.0,
+    not_ready="queue",
+    styles=None,
+    model_memory_budget=None,
+    cpu_model_memory=0.0,
+):
+    handler, readiness = create_server(
+        base_model_path=base_model_path,
+        acceleration=acceleration,
+        prompt=prompt,
+        host=host,
+        num_inference_steps=num_inference_steps,
+        preprocessing=preprocessing,
+        negative_prompt=negative_prompt,
+        guidance_scale=guidance_scale,
+        lora_path=lora_path,
+        lora_scale=lora_scale,
+        t_index_list=t_index_list,
+        jpeg_quality=jpeg_quality,
+        engines_dir=engines_dir,
+        decode_workers=decode_workers,
+        encode_workers=encode_workers,
+        queue_size=queue_size,
+        ingest=ingest,
+        max_batch_size=max_batch_size,
+        max_batch_wait=max_batch_wait,
+        prompt_cache_size=prompt_cache_size,
+        prompt_cache_dir=prompt_cache_dir,
+        backend=backend,
+        cpu_latency=cpu_latency,
+        cpu_style=cpu_style,
+        zero_copy=zero_copy,
+        cpu_similar_threshold=cpu_similar_threshold,
+        turbo_jpeg=turbo_jpeg,
+        tile_size=tile_size,
+        tile_threshold=tile_threshold,
+        keyframe_interval=keyframe_interval,
+        metrics_port=metrics_port,
+        health_port=health_port,
+        trace_size=trace_size,
+        model_cache=model_cache,
+        not_ready=not_ready,
+        styles=styles,
+        model_memory_budget=model_memory_budget,
+        cpu_model_memory=cpu_model_memory,
+    )
+
+    async def serve(websocket):
+        # Warmup runs on handler directly, clients wait for it here
+        if await readiness.admit(websocket):
+            await handler(websocket)
+
+    start_server = websockets.serve(serve, host, port)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(start_server)
     print(f"Server started at ws://{host}:{port}")
-    asyncio.get_event_loop().run_forever()
+
+    loop.run_until_complete(
+        run_warmup(
+            handler,
+            readiness,
+            warmup_frames,
+            warmup_size,
+            jpeg_quality,
+            warmup_timeout,
+        )
+    )
+    print("Server ready")
+    loop.run_forever()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.capture_transform import (  # noqa: E402
+    CASES,
+    legacy_transform,
+    make_frames,
+)
+from capture_transform import CaptureTransform  # noqa: E402
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+@pytest.mark.parametrize("width,height,crop_size,offset,rotation,size", CASES)
+def test_matches_the_pil_path(
+    width, height, crop_size, offset, rotation, size, channels
+):
+    transform = CaptureTransform(crop_size, offset, rotation, size)
+    for frame in make_frames(width, height, channels):
+        expected = legacy_transform(frame, crop_size, offset, rotation, size)
+        np.testing.assert_array_equal(transform(frame), expected)
@@ -0,0 +1,41 @@
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_pipeline import DropFrame, Frame, FramePipeline, Stage  # noqa: E402
+
+
+async def run_frames(count, sink, on_drop=None):
+    def work(frame):
+        if frame.seq == 3:
+            raise DropFrame(f"Dropping frame {frame.seq}")
+
+    with ThreadPoolExecutor(2) as executor:
+        pipeline = FramePipeline(
+            [Stage("work", work, executor, workers=2)],
+            sink,
+            queue_size=1,
+            on_drop=on_drop,
+        ).start()
+        for seq in range(count):
+            await pipeline.submit(Frame(seq, b""))
+        await pipeline.close()
+
+
+def test_sink_failure_loses_only_that_frame():
+    answered = []
+
+    async def sink(frame):
+        if frame.seq in (1, 4):
+            raise ConnectionError("send failed")
+        answered.append(frame.seq)
+
+    async def on_drop(frame):
+        raise ConnectionError("send failed")
+
+    # More frames than the queues hold, so a dead sink would block submit
+    asyncio.run(asyncio.wait_for(run_frames(8, sink, on_drop), 5.0))
+    assert answered == [0, 2, 5, 6, 7]
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol  # noqa: E402
+from backends import load_backend  # noqa: E402
+from frame_codecs import get_codec  # noqa: E402
+from inflight import InFlightWindow  # noqa: E402
+from loopback import LoopbackConnection  # noqa: E402
+from server import create_handler  # noqa: E402
+
+
+async def send_frames(client, window, count, codec, images):
+    for _ in range(count):
+        seq = window.sent()
+        await client.send(
+            protocol.pack(
+                protocol.FRAME,
+                bytes(codec.encode(images[seq % len(images)], 90)),
+                seq=seq,
+                codec=codec.id,
+                width=64,
+                height=64,
+            )
+        )
+        await asyncio.sleep(0.01)
+
+
+async def burst_then_replace():
+    model = load_backend(backend="cpu", cpu_latency=0.2, cpu_style="none")
+    handler = create_handler(model, "", queue_size=2)
+    connection = LoopbackConnection()
+    client = connection.client()
+    session = asyncio.ensure_future(handler(connection))
+    await client.send(json.dumps({"protocol": 2, "ingest": "latest"}))
+    # Answered once the stream is prepared
+    assert json.loads(await client.recv()) == {"protocol": 2}
+
+    codec = get_codec("jpeg", turbo=False)
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (64, 64, 3), dtype=np.uint8) for _ in range(4)]
+    window = InFlightWindow(max_in_flight=32, timeout=30.0)
+    # A burst replaces frames while earlier ones are still in the pipeline.
+    # Then, while a frame is in diffusion, two more frames arrive and the
+    # second replaces the first
+    await send_frames(client, window, 15, codec, images)
+    await asyncio.sleep(0.3)
+    await send_frames(client, window, 2, codec, images)
+
+    replies = []
+    while len(replies) < window.next_seq:
+        replies.append(await asyncio.wait_for(client.recv_frame(), 10.0))
+    await client.close()
+    await session
+    return window, replies
+
+
+def test_replies_match_their_frames_after_a_burst():
+    window, replies = asyncio.run(burst_then_replace())
+    types = [reply.type for reply in replies]
+    assert protocol.RESULT in types
+    assert protocol.DROPPED in types
+    # Replies come back in seq order, so none of them arrives after the
+    # client gave its frame up as skipped
+    assert [reply.seq for reply in replies] == sorted(reply.seq for reply in replies)
+    for reply in replies:
+        assert window.match(reply.seq) is not None
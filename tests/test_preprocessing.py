@@ -0,0 +1,19 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.preprocessing import CASES, legacy_preprocess, make_frames  # noqa: E402
+from preprocessing import Preprocessor  # noqa: E402
+
+
+@pytest.mark.parametrize("size", [150, 256, 512])
+@pytest.mark.parametrize("mode,spec", CASES)
+def test_matches_the_legacy_mode(mode, spec, size):
+    preprocessor = Preprocessor(spec)
+    for img in make_frames(size):
+        expected = legacy_preprocess(img.copy(), mode)
+        np.testing.assert_array_equal(preprocessor(img.copy()), expected)
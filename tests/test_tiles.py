@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_codecs import RawCodec  # noqa: E402
+from tiles import TileCanvas, TileEncoder  # noqa: E402
+
+
+class FailingCodec(RawCodec):
+    # Fails the encode calls whose (0-based) index is in fail
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = 0
+
+    def encode(self, image, quality=90):
+        self.calls += 1
+        if self.calls - 1 in self.fail:
+            return None
+        return super().encode(image, quality)
+
+
+def send(encoder, canvas, image, codec):
+    keyframe, payload = encoder.encode(image, codec, 90)
+    if payload is None:
+        return None
+    height, width = image.shape[:2]
+    if keyframe:
+        return canvas.keyframe(codec.decode(bytes(payload), width, height).copy())
+    return canvas.patch(payload, codec, width, height)
+
+
+def test_tiles_patch_canvas_to_result():
+    encoder = TileEncoder(tile_size=64, threshold=1.0)
+    canvas = TileCanvas()
+    codec = RawCodec()
+    image = np.zeros((150, 200, 3), np.uint8)
+    send(encoder, canvas, image, codec)
+    image[70:100, 130:200] = 200
+    shown = send(encoder, canvas, image, codec)
+    assert encoder.keyframes == 1
+    assert np.array_equal(shown, image)
+
+
+def test_failed_tile_encode_leaves_reference_untouched():
+    encoder = TileEncoder(tile_size=64, threshold=1.0)
+    canvas = TileCanvas()
+    image = np.zeros((128, 128, 3), np.uint8)
+    send(encoder, canvas, image, RawCodec())
+
+    # Two of the four tiles change; the second one fails to encode, so the
+    # frame is not sent and the client keeps showing the keyframe
+    changed = image.copy()
+    changed[:64, :64] = 100
+    changed[64:, 64:] = 200
+    assert send(encoder, canvas, changed, FailingCodec(fail=[1])) is None
+
+    shown = send(encoder, canvas, changed, RawCodec())
+    assert encoder.keyframes == 1
+    assert np.array_equal(shown, changed)
@@ -0,0 +1,139 @@
+import struct
+import cv2
+import numpy as np
+
+# Payload of a TILES message: the tiles of the result that changed since the
+# previous one, each encoded on its own with the message's codec.
+#   tile size  H
+#   count      H
+# then per tile:
+#   x, y       H H   top-left corner in pixels
+#   length     I     encoded size in bytes, followed by the encoded tile
+# Tiles at the right and bottom edges are cut to the frame size given in the
+# envelope.
+HEADER = struct.Struct("<HH")
+TILE = struct.Struct("<HHI")
+
+
+class TileEncoder:
+    # Server side, one per connection, fed results in send order. A result is
+    # compared with what the client should be showing tile by tile, by mean
+    # absolute difference per pixel and channel, and only tiles above
+    # threshold are sent. The reference only takes in the tiles that were
+    # sent, and only once the whole frame encoded, so slow changes add up
+    # until they cross the threshold. A full keyframe goes out first, every
+    # keyframe_interval results, when the size changes, when most tiles
+    # changed anyway, or when the client asks.
+    def __init__(self, tile_size=64, threshold=2.0, keyframe_interval=30, max_changed=0.5):
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.max_changed = max_changed
+        self.force_keyframe = False
+        self.frames = 0
+        self.keyframes = 0
+        self.tiles_sent = 0
+        self.tiles_total = 0
+        self._reference = None
+        self._since_keyframe = 0
+
+    def encode(self, image, codec, quality):
+        # Returns (keyframe, payload): a whole encoded frame or a tile payload
+        self.frames += 1
+        height, width = image.shape[:2]
+        rows = np.arange(0, height, self.tile_size)
+        cols = np.arange(0, width, self.tile_size)
+        keyframe = (
+            self.force_keyframe
+            or self._reference is None
+            or self._reference.shape != image.shape
+            or self._since_keyframe >= self.keyframe_interval
+        )
+
+        changed = None
+        if not keyframe:
+            # Per-tile sums of the absolute difference from an integral image
+            integral = cv2.integral(cv2.absdiff(image, self._reference))
+            edges_y = np.append(rows, height)
+            edges_x = np.append(cols, width)
+            corners = integral[edges_y][:, edges_x].sum(axis=2)
+            sums = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+            areas = np.diff(edges_y)[:, None] * np.diff(edges_x)[None, :] * image.shape[2]
+            means = sums / areas
+            changed = np.argwhere(means > self.threshold)
+            self.tiles_total += means.size
+            keyframe = len(changed) > self.max_changed * means.size
+
+        if keyframe:
+            payload = codec.encode(image, quality)
+            if payload is None:
+                return True, None
+            self._reference = image.copy()
+            self._since_keyframe = 0
+            self.force_keyframe = False
+            self.keyframes += 1
+            return True, payload
+
+        parts = [HEADER.pack(self.tile_size, len(changed))]
+        tiles = []
+        for row, col in changed:
+            y, x = int(rows[row]), int(cols[col])
+            tile = image[y : y + self.tile_size, x : x + self.tile_size]
+            data = codec.encode(np.ascontiguousarray(tile), quality)
+            if data is None:
+                return False, None
+            parts.append(TILE.pack(x, y, len(data)))
+            parts.append(bytes(data))
+            tiles.append((y, x, tile))
+        # Only once every tile encoded: a frame that is not sent must leave
+        # the reference matching what the client shows
+        for y, x, tile in tiles:
+            self._reference[y : y + self.tile_size, x : x + self.tile_size] = tile
+        self._since_keyframe += 1
+        self.tiles_sent += len(changed)
+        return False, b"".join(parts)
+
+    def stats(self):
+        sent = self.tiles_sent / self.tiles_total if self.tiles_total else 0.0
+        return {
+            "frames": self.frames,
+            "keyframes": self.keyframes,
+            "tiles_sent": f"{sent * 100:.1f}%",
+        }
+
+
+class TileCanvas:
+    # Client side: the last full result, patched in place by TILES messages.
+    # Every RESULT and TILES message has to go through it, including those
+    # for frames the client already gave up on, or later patches land on a
+    # stale picture.
+    def __init__(self):
+        self.image = None
+        self.keyframes = 0
+        self.patches = 0
+
+    def keyframe(self, image):
+        if not image.flags.writeable:
+            image = image.copy()
+        self.image = image
+        self.keyframes += 1
+        return image
+
+    def patch(self, payload, codec, width, height):
+        # Returns the patched image, or None if there is no keyframe to patch
+        if self.image is None or self.image.shape[:2] != (height, width):
+            return None
+        tile_size, count = HEADER.unpack_from(payload)
+        offset = HEADER.size
+        for _ in range(count):
+            x, y, length = TILE.unpack_from(payload, offset)
+            offset += TILE.size
+            tile_w = min(tile_size, width - x)
+            tile_h = min(tile_size, height - y)
+            tile = codec.decode(payload[offset : offset + length], tile_w, tile_h)
+            offset += length
+            if tile is None or tile.shape[:2] != (tile_h, tile_w):
+                return None
+            self.image[y : y + tile_h, x : x + tile_w] = tile
+        self.patches += 1
+        return self.image
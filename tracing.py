@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Spans are (name, start, end, track) with wall clock times in seconds; track
+# is the timeline row, e.g. the thread that ran the stage. They are exported in
+# the Chrome trace event format, which chrome://tracing and ui.perfetto.dev open.
+
+
+class Tracer:
+    # Bounded ring buffer of trace events: once full, the oldest ones go. Each
+    # frame adds its stage spans plus one span for its whole lifetime, all
+    # tagged with the frame's sequence number, under a process such as
+    # "connection 3" or "client".
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._events = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def add_spans(self, process, seq, spans):
+        with self._lock:
+            for name, start, end, track in spans:
+                self._events.append(("X", process, name, start, end, track, seq, {}))
+
+    def add_frame(self, process, seq, start, end, spans=(), **args):
+        # The frame span crosses tracks, so it is an async event keyed by seq
+        self.add_spans(process, seq, spans)
+        with self._lock:
+            self._events.append(
+                ("frame", process, "frame", start, end, None, seq, args)
+            )
+
+    def chrome_trace(self):
+        with self._lock:
+            events = list(self._events)
+        pids = {}
+        tids = {}
+        trace_events = []
+
+        def ids(process, track):
+            if process not in pids:
+                pids[process] = len(pids) + 1
+                trace_events.append(
+                    _metadata("process_name", pids[process], 0, process)
+                )
+            pid = pids[process]
+            if track is None:
+                return pid, 0
+            if (process, track) not in tids:
+                tids[(process, track)] = len(tids) + 1
+                trace_events.append(
+                    _metadata("thread_name", pid, tids[(process, track)], track)
+                )
+            return pid, tids[(process, track)]
+
+        for kind, process, name, start, end, track, seq, args in events:
+            pid, tid = ids(process, track)
+            args = dict(args, process=process)
+            if seq is not None:
+                args["seq"] = seq
+            if kind == "X":
+                trace_events.append(
+                    {
+                        "name": name,
+                        "cat": "stage",
+                        "ph": "X",
+                        "ts": start * 1e6,
+                        "dur": max(end - start, 0.0) * 1e6,
+                        "pid": pid,
+                        "tid": tid,
+                        "args": args,
+                    }
+                )
+            else:
+                event = {"name": f"{name} {seq}", "cat": "frame", "id": f"{pid}:{seq}"}
+                trace_events.append(
+                    dict(event, ph="b", ts=start * 1e6, pid=pid, tid=tid, args=args)
+                )
+                trace_events.append(dict(event, ph="e", ts=end * 1e6, pid=pid, tid=tid))
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def render(self):
+        return json.dumps(self.chrome_trace())
+
+    def write(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+def _metadata(kind, pid, tid, name):
+    return {"name": kind, "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+
+
+def span(name, start, end=None, track=None):
+    # A span for Tracer.add_frame, on the calling thread's track by default
+    if end is None:
+        end = time.time()
+    if track is None:
+        track = threading.current_thread().name
+    return (name, start, end, track)